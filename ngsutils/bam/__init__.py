@@ -1,28 +1,754 @@
 import sys
 import os
 import re
+import stat
+import struct
+import bisect
+import collections
+import heapq
+import multiprocessing
+import tempfile
 import pysam
 from eta import ETA
 import ngsutils.support
+from ngsutils.support.bgzip import BGZFWriter, BGZFReader, read_block, inflate_block
 
 
 def bam_open(fname, mode='r', *args, **kwargs):
+    '''
+    Opens a SAM/BAM file. If fname is '-', this reads from stdin (SAM or BAM)
+    or writes an uncompressed BAM file to stdout (to be piped to another
+    program).
+    '''
+    if fname == '-':
+        if mode == 'r':
+            return pysam.Samfile(fname, mode, *args, **kwargs)
+        return pysam.Samfile(fname, '%sbu' % mode, *args, **kwargs)
     if fname.lower()[-4:] == '.bam':
         return pysam.Samfile(fname, '%sb' % mode, *args, **kwargs)
     return pysam.Samfile(fname, '%s' % mode, *args, **kwargs)
 
 
+class ThreadedBamWriter(object):
+    '''
+    Writes a BAM file with BGZF compression done in a pool of threads.
+
+    pysam writes an uncompressed (level 0) BAM stream into a pipe. A helper
+    process reads the stored blocks from the pipe and passes the data to a
+    BGZFWriter, which compresses it at the requested level using a pool of
+    threads. (A helper process is used instead of a thread, because pysam can
+    block on a full pipe while holding the GIL.)
+
+    pysam opens the pipe by name (/dev/fd/N), so this needs a /dev/fd
+    filesystem (Linux, OS X). bam_open_writer falls back to pysam's own
+    (single threaded) compression when /dev/fd isn't available. close() raises
+    an IOError if the helper process failed.
+
+    Other than write/close, attributes are passed through to the pysam.Samfile
+    object (references, getrname, etc).
+    '''
+    def __init__(self, fname, threads=2, level=-1, *args, **kwargs):
+        r, w = os.pipe()
+
+        self._pid = os.fork()
+        if self._pid == 0:
+            os.close(w)
+            _bgzf_pump(r, fname, level, threads)
+
+        os.close(r)
+
+        try:
+            self._bam = pysam.Samfile('/dev/fd/%d' % w, 'wbu', *args, **kwargs)
+        except:
+            # let the helper see the end of the stream, so it exits
+            os.close(w)
+            os.waitpid(self._pid, 0)
+            raise
+        os.close(w)
+
+        self.write = self._bam.write
+
+    def __getattr__(self, name):
+        return getattr(self._bam, name)
+
+    def close(self):
+        self._bam.close()
+        pid, status = os.waitpid(self._pid, 0)
+        if status != 0:
+            raise IOError("Error compressing BAM output (status: %s)" % status)
+
+
+def _bgzf_pump(fd, fname, level, threads):
+    'Runs in the forked helper process (never returns)'
+    status = 0
+    try:
+        # close all other inherited files (such as the pipes for other
+        # writers), so that those writers will see the end of their streams
+        os.closerange(3, fd)
+        os.closerange(fd + 1, 65536)
+
+        pipe = os.fdopen(fd, 'rb')
+        writer = BGZFWriter(fname, level=level, threads=threads)
+
+        while True:
+            block = read_block(pipe)
+            if not block:
+                break
+            bsize, cdata, crc, isize = block
+            if isize:
+                writer.write(inflate_block(cdata))
+
+        writer.close()
+        pipe.close()
+    except Exception, e:
+        sys.stderr.write('Error compressing BAM output: %s\n' % e)
+        status = 1
+
+    os._exit(status)
+
+
+def bam_open_writer(fname, threads=1, level=None, *args, **kwargs):
+    '''
+    Opens a BAM file for writing.
+
+    threads - the number of threads to use for compression
+    level   - the zlib compression level (0-9). Level 0 writes an uncompressed
+              BAM file (useful when piping the output to another program).
+
+    If fname is '-', the file is written to stdout (uncompressed, unless a
+    level is given).
+
+    Threads and levels other than 0 use a ThreadedBamWriter, which needs
+    /dev/fd. Without it, the file is written by pysam with one thread (at the
+    default level, unless level is 0).
+    '''
+    if fname == '-' and level is None:
+        level = 0
+
+    if threads > 1 or (level is not None and level not in [-1, 0]):
+        if os.path.isdir('/dev/fd'):
+            return ThreadedBamWriter(fname, threads, level if level is not None else -1, *args, **kwargs)
+        sys.stderr.write('/dev/fd is missing, writing %s with one thread\n' % fname)
+
+    if level == 0:
+        return pysam.Samfile(fname, 'wbu', *args, **kwargs)
+
+    return pysam.Samfile(fname, 'wb', *args, **kwargs)
+
+
+_raw_struct = struct.Struct('<iiBBHHHiiii')
+_raw_size = struct.Struct('<i')
+_aux_formats = {'A': '<c', 'c': '<b', 'C': '<B', 's': '<h', 'S': '<H', 'i': '<i', 'I': '<I', 'f': '<f'}
+
+
+class RawRead(object):
+    '''
+    A BAM record that hasn't been decoded by pysam.
+
+    Only the fixed-length fields are unpacked (the read name and CIGAR are
+    unpacked when they are used), so records can be checked for flags,
+    reference, position, or mapping quality and written out unchanged with a
+    RawBamWriter. Attribute names match pysam.AlignedRead.
+    '''
+    __slots__ = ['data', 'tid', 'pos', 'mapq', 'flag', 'rlen', 'mrnm', 'mpos', 'isize', '_l_qname', '_n_cigar']
+
+    def __init__(self, data):
+        self.data = data
+        (self.tid, self.pos, self._l_qname, self.mapq, bin_, self._n_cigar, self.flag, self.rlen, self.mrnm, self.mpos, self.isize) = _raw_struct.unpack_from(data, 4)
+
+    @property
+    def qname(self):
+        return self.data[36:35 + self._l_qname]
+
+    @property
+    def cigar(self):
+        if not self._n_cigar:
+            return []
+        vals = struct.unpack_from('<%dI' % self._n_cigar, self.data, 36 + self._l_qname)
+        return [(x & 0xf, x >> 4) for x in vals]
+
+    def opt(self, tag):
+        '''
+        Returns the value of an optional tag (raises KeyError if it's
+        missing, like pysam)
+        '''
+        data = self.data
+        pos = 36 + self._l_qname + 4 * self._n_cigar + (self.rlen + 1) / 2 + self.rlen
+
+        while pos < len(data):
+            name = data[pos:pos + 2]
+            valtype = data[pos + 2]
+            pos += 3
+
+            if valtype in _aux_formats:
+                if name == tag:
+                    return struct.unpack_from(_aux_formats[valtype], data, pos)[0]
+                pos += struct.calcsize(_aux_formats[valtype])
+            elif valtype in 'ZH':
+                end = data.index('\0', pos)
+                if name == tag:
+                    return data[pos:end]
+                pos = end + 1
+            elif valtype == 'B':
+                subtype = data[pos]
+                count, = struct.unpack_from('<i', data, pos + 1)
+                fmt = '<%d%s' % (count, _aux_formats[subtype][1])
+                if name == tag:
+                    return list(struct.unpack_from(fmt, data, pos + 5))
+                pos += 5 + struct.calcsize(fmt)
+            else:
+                raise ValueError("Unknown tag type: %s" % valtype)
+
+        raise KeyError(tag)
+
+    @property
+    def aend(self):
+        '''
+        The end position of the read on the reference (same as htslib's
+        bam_endpos)
+        '''
+        if self.flag & 0x4 or not self._n_cigar:
+            return self.pos + 1
+
+        end = self.pos
+        for op, length in self.cigar:
+            if op in [0, 2, 3, 7, 8]:
+                end += length
+        return end
+
+    is_paired = property(lambda self: self.flag & 0x1 != 0)
+    is_proper_pair = property(lambda self: self.flag & 0x2 != 0)
+    is_unmapped = property(lambda self: self.flag & 0x4 != 0)
+    mate_is_unmapped = property(lambda self: self.flag & 0x8 != 0)
+    is_reverse = property(lambda self: self.flag & 0x10 != 0)
+    mate_is_reverse = property(lambda self: self.flag & 0x20 != 0)
+    is_read1 = property(lambda self: self.flag & 0x40 != 0)
+    is_read2 = property(lambda self: self.flag & 0x80 != 0)
+    is_secondary = property(lambda self: self.flag & 0x100 != 0)
+    is_qcfail = property(lambda self: self.flag & 0x200 != 0)
+    is_duplicate = property(lambda self: self.flag & 0x400 != 0)
+
+
+class RawBamReader(object):
+    '''
+    Reads the records from a BAM file as RawReads (without decoding them).
+
+    Blocks are inflated with a BGZFReader, so 'threads' threads can be used.
+    This has the same basic interface as a pysam.Samfile (iteration, tell,
+    seek, references, getrname, fetch), so it can be used with bam_iter.
+    fetch() requires a BAM index (.bai).
+    '''
+    def __init__(self, fname, threads=1):
+        self.filename = fname
+        self._reader = BGZFReader(fname, threads=threads)
+
+        magic = self._reader.read(4)
+        if magic != 'BAM\1':
+            raise ValueError("%s is not a valid BAM file" % fname)
+
+        header = [magic]
+        buf = self._reader.read(4)
+        header.append(buf)
+        l_text, = struct.unpack('<i', buf)
+        self.text = self._reader.read(l_text)
+        header.append(self.text)
+
+        buf = self._reader.read(4)
+        header.append(buf)
+        n_ref, = struct.unpack('<i', buf)
+
+        references = []
+        lengths = []
+        for i in xrange(n_ref):
+            buf = self._reader.read(4)
+            header.append(buf)
+            l_name, = struct.unpack('<i', buf)
+            name = self._reader.read(l_name)
+            buf = self._reader.read(4)
+            header.extend([name, buf])
+            references.append(name[:-1])
+            lengths.append(struct.unpack('<i', buf)[0])
+
+        self.references = tuple(references)
+        self.lengths = tuple(lengths)
+        self.nreferences = n_ref
+        self.header_data = ''.join(header)
+        self._tids = dict([(name, i) for i, name in enumerate(references)])
+        self._index = None
+
+        self._buf = ''
+        self._off = 0
+        self._rec = 0
+        self._blocks = []
+        self._starts = []
+        self._block_iter = None
+
+    def getrname(self, tid):
+        return self.references[tid]
+
+    def gettid(self, name):
+        return self._tids.get(name, -1)
+
+    def tell(self):
+        return self._voffset(self._off)
+
+    def tell_read(self):
+        '''
+        Returns the virtual offset of the start of the last record returned
+        by next()
+        '''
+        return self._voffset(self._rec)
+
+    def _voffset(self, off):
+        # find the block that holds this position in the buffer
+        idx = bisect.bisect_right(self._starts, off) - 1
+        if idx < 0:
+            return self._reader.tell()
+
+        start, coffset, shift, length, end = self._blocks[idx]
+        if off - start >= length:
+            return end << 16
+        return (coffset << 16) | (off - start + shift)
+
+    def seek(self, offset):
+        self._reader.seek(offset)
+        self._buf = ''
+        self._off = 0
+        self._rec = 0
+        self._blocks = []
+        self._starts = []
+        self._block_iter = None
+
+    def _fill(self, size):
+        '''
+        Loads blocks from the BGZFReader until there are at least 'size'
+        bytes after the current position. Returns False if there isn't
+        enough data left in the file.
+
+        For each block in the buffer, we track where it starts (in the
+        buffer), its offset in the file, and the offset of the next block,
+        so that virtual offsets can be calculated.
+        '''
+        off = self._off
+        buf = [self._buf[off:]]
+        have = len(buf[0])
+        blocks = [(start - off, coffset, shift, length, end) for start, coffset, shift, length, end in self._blocks if start + length > off]
+
+        if not self._block_iter:
+            voffset = self._reader.tell()
+            self._block_iter = self._reader.iter_blocks()
+        else:
+            voffset = None
+
+        while have < size:
+            try:
+                coffset, data = self._block_iter.next()
+            except StopIteration:
+                break
+
+            if not data:
+                continue
+
+            shift = 0
+            if voffset is not None and coffset == voffset >> 16:
+                # first block after a seek
+                shift = voffset & 0xFFFF
+            voffset = None
+
+            blocks.append((have, coffset, shift, len(data), self._reader.tell() >> 16))
+            buf.append(data)
+            have += len(data)
+
+        self._buf = ''.join(buf)
+        self._off = 0
+        self._blocks = blocks
+        self._starts = [x[0] for x in blocks]
+
+        return have >= size
+
+    def skip(self, count):
+        '''
+        Skips over the next 'count' records (without creating RawReads).
+        Returns the number of records that were skipped.
+        '''
+        skipped = 0
+        while skipped < count:
+            buf = self._buf
+            off = self._off
+            buflen = len(buf)
+            while skipped < count and buflen - off >= 4:
+                end = off + 4 + _raw_size.unpack_from(buf, off)[0]
+                if end > buflen:
+                    break
+                off = end
+                skipped += 1
+
+            self._off = off
+            if skipped < count:
+                if buflen - off >= 4:
+                    size = 4 + _raw_size.unpack_from(buf, off)[0]
+                else:
+                    size = 4
+                if not self._fill(size):
+                    if len(self._buf) > self._off:
+                        raise ValueError("Truncated BAM record")
+                    break
+
+        return skipped
+
+    def name_offsets(self):
+        '''
+        Yields (qname, virtual offset) for the first record of each group of
+        records with the same read name. This is faster than reading RawReads,
+        for finding where read names start in a large file.
+        '''
+        last = None
+        while True:
+            buf = self._buf
+            off = self._off
+            buflen = len(buf)
+            while buflen - off >= 4:
+                end = off + 4 + _raw_size.unpack_from(buf, off)[0]
+                if end > buflen:
+                    break
+
+                # l_read_name is at byte 12, the name (NUL terminated) at 36
+                qname = buf[off + 36:off + 35 + ord(buf[off + 12])]
+                if qname != last:
+                    self._off = off
+                    yield (qname, self.tell())
+                    last = qname
+                off = end
+
+            self._off = off
+            if buflen - off >= 4:
+                size = 4 + _raw_size.unpack_from(buf, off)[0]
+            else:
+                size = 4
+            if not self._fill(size):
+                if len(self._buf) > self._off:
+                    raise ValueError("Truncated BAM record")
+                return
+
+    def __iter__(self):
+        '''
+        Yields the remaining records (the same as calling next(), but the
+        records that are already in the buffer are split in one loop)
+        '''
+        unpack = _raw_size.unpack_from
+        while True:
+            buf = self._buf
+            off = self._off
+            buflen = len(buf)
+            while buflen - off >= 4:
+                end = off + 4 + unpack(buf, off)[0]
+                if end > buflen:
+                    break
+
+                self._off = end
+                self._rec = off
+                yield RawRead(buf[off:end])
+
+                if self._off != end or self._buf is not buf:
+                    # next() or seek() was called
+                    break
+                off = end
+
+            # the next record needs more data
+            try:
+                read = self.next()
+            except StopIteration:
+                return
+            yield read
+
+    def next(self):
+        buf = self._buf
+        off = self._off
+        if len(buf) - off < 4:
+            if not self._fill(4):
+                if len(self._buf) > self._off:
+                    raise ValueError("Truncated BAM record")
+                raise StopIteration
+            buf = self._buf
+            off = 0
+
+        end = off + 4 + _raw_size.unpack_from(buf, off)[0]
+        if len(buf) < end:
+            if not self._fill(end - off):
+                raise ValueError("Truncated BAM record")
+            buf = self._buf
+            end -= off
+            off = 0
+
+        self._off = end
+        self._rec = off
+        return RawRead(buf[off:end])
+
+    def fetch(self, chrom, start=None, end=None):
+        '''
+        Returns the reads that overlap chrom:start-end (using the BAM index)
+        '''
+        if not self._index:
+            self._index = BamIndex('%s.bai' % self.filename)
+
+        tid = self.gettid(chrom)
+        if tid < 0:
+            raise ValueError("Missing reference: %s" % chrom)
+
+        if start is None:
+            start = 0
+        if end is None:
+            end = self.lengths[tid]
+
+        cur = 0
+        for chunk_start, chunk_end in self._index.chunks(tid, start, end):
+            if chunk_start > cur:
+                self.seek(chunk_start)
+
+            while self.tell() < chunk_end:
+                try:
+                    read = self.next()
+                except StopIteration:
+                    break
+
+                if read.tid != tid or read.pos >= end:
+                    break
+
+                if read.aend > start:
+                    yield read
+
+            cur = self.tell()
+
+    def close(self):
+        self._reader.close()
+
+
+class RawBamWriter(object):
+    '''
+    Writes RawReads to a BAM file, without re-encoding them.
+
+    header_data is the raw BAM header to write (see: RawBamReader.header_data).
+    If append is True, the reads are added to the end of an existing file
+    that was closed with eof=False (and the header isn't written again).
+    '''
+    def __init__(self, fname, header_data, threads=1, level=None, append=False, pool=None):
+        self.filename = fname
+        level = level if level is not None else -1
+
+        if append:
+            self._out = BGZFWriter(fileobj=open(fname, 'ab'), level=level, threads=threads, pool=pool)
+        else:
+            self._out = BGZFWriter(fname, level=level, threads=threads, pool=pool)
+            self._out.write(header_data)
+            self._out.flush()
+
+    def write(self, read):
+        self._out.write(read.data)
+
+    def copy_range(self, fname, start, end=None):
+        '''
+        Copies the records between two virtual offsets in another BAM file
+        (start inclusive, end exclusive, or to the end of the file if end is
+        None). Only the first and last blocks are inflated; the blocks in
+        between are copied without being decompressed.
+        '''
+        cstart = start >> 16
+        ustart = start & 0xFFFF
+        if end is not None:
+            cend = end >> 16
+            uend = end & 0xFFFF
+        else:
+            cend = None
+            uend = None
+
+        with open(fname, 'rb') as f:
+            f.seek(cstart)
+            coffset = cstart
+            while cend is None or coffset <= cend:
+                block = read_block(f)
+                if not block:
+                    break
+
+                bsize, cdata, crc, isize = block
+                if coffset == cstart or coffset == cend:
+                    data = inflate_block(cdata)
+                    if coffset == cend:
+                        data = data[:uend]
+                    if coffset == cstart:
+                        data = data[ustart:]
+                    self._out.write(data)
+                elif isize:
+                    self._out.write_block(cdata, crc, isize)
+
+                coffset += bsize
+
+    def close(self, eof=True):
+        self._out.close(eof)
+
+
+class BamIndex(object):
+    '''
+    A BAM index (.bai)
+
+    For each reference, the bins (bin => list of chunk virtual offsets) and
+    the linear index (16kb windows) are loaded.
+    '''
+    def __init__(self, fname):
+        with open(fname, 'rb') as f:
+            data = f.read()
+
+        if data[:4] != 'BAI\1':
+            raise ValueError("%s is not a valid BAM index" % fname)
+
+        n_ref, = struct.unpack_from('<i', data, 4)
+        pos = 8
+
+        self.bins = []
+        self.linear = []
+        self.meta = []
+
+        for i in xrange(n_ref):
+            bins = {}
+            meta = None
+            n_bin, = struct.unpack_from('<i', data, pos)
+            pos += 4
+            for j in xrange(n_bin):
+                bin_num, n_chunk = struct.unpack_from('<Ii', data, pos)
+                pos += 8
+                vals = struct.unpack_from('<%dQ' % (n_chunk * 2), data, pos)
+                pos += 16 * n_chunk
+
+                if bin_num == 37450:
+                    # pseudo-bin: (ref_beg, ref_end), (n_mapped, n_unmapped)
+                    meta = vals
+                else:
+                    bins[bin_num] = zip(vals[::2], vals[1::2])
+
+            n_intv, = struct.unpack_from('<i', data, pos)
+            pos += 4
+            self.linear.append(struct.unpack_from('<%dQ' % n_intv, data, pos))
+            pos += 8 * n_intv
+
+            self.bins.append(bins)
+            self.meta.append(meta)
+
+        self.nreferences = n_ref
+        if pos + 8 <= len(data):
+            self.n_no_coor, = struct.unpack_from('<Q', data, pos)
+        else:
+            self.n_no_coor = None
+
+    def chunks(self, tid, start, end):
+        '''
+        Returns the (merged, sorted) list of virtual offset ranges that could
+        hold reads overlapping tid:start-end.
+        '''
+        if tid < 0 or tid >= self.nreferences:
+            return []
+
+        min_offset = 0
+        linear = self.linear[tid]
+        if linear:
+            min_offset = linear[min(start >> 14, len(linear) - 1)]
+
+        chunks = []
+        bins = self.bins[tid]
+        for bin_num in _reg2bins(start, end):
+            if bin_num in bins:
+                for chunk_start, chunk_end in bins[bin_num]:
+                    if chunk_end > min_offset:
+                        chunks.append((max(chunk_start, min_offset), chunk_end))
+
+        chunks.sort()
+        merged = []
+        for chunk_start, chunk_end in chunks:
+            if merged and chunk_start <= merged[-1][1]:
+                if chunk_end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], chunk_end)
+            else:
+                merged.append((chunk_start, chunk_end))
+
+        return merged
+
+    def offsets(self):
+        'Returns all of the virtual offsets in the index'
+        offsets = []
+        for bins in self.bins:
+            for chunks in bins.values():
+                for chunk in chunks:
+                    offsets.extend(chunk)
+        for linear in self.linear:
+            offsets.extend(linear)
+        return offsets
+
+    def read_count(self):
+        '''
+        Returns the total number of reads in the BAM file (mapped, unmapped and
+        without coordinates), or None if the index doesn't have the counts.
+        '''
+        if self.n_no_coor is None:
+            return None
+
+        total = self.n_no_coor
+        for bins, meta in zip(self.bins, self.meta):
+            if meta:
+                total += meta[2] + meta[3]
+            elif bins:
+                return None
+        return total
+
+
+def _reg2bins(start, end):
+    '''
+    Returns the bins that may hold reads overlapping start-end (from the SAM spec)
+
+    >>> _reg2bins(0, 1)
+    [0, 1, 9, 73, 585, 4681]
+    >>> _reg2bins(16384, 32769)[-3:]
+    [585, 4682, 4683]
+    '''
+    bins = [0]
+    end -= 1
+    for shift, offset in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        bins.extend(xrange(offset + (start >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+def bam_exists(fname):
+    "Returns True if fname is an existing file, or '-' (stdin)"
+    return fname == '-' or os.path.exists(fname)
+
+
+def bam_file_size(bam):
+    '''
+    Returns the size of the file that a SAM/BAM file is being read from, or
+    None if it isn't a regular file (stdin, a pipe, etc), so that progress
+    can't be shown.
+    '''
+    fname = getattr(bam, 'filename', None)
+    if not fname or fname == '-':
+        return None
+
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st.st_size
+
+
 def bam_pileup_iter(bam, mask=1796, quiet=False, callback=None):
-    if not quiet and bam.filename:
-        eta = ETA(os.stat(bam.filename).st_size)
+    fsize = bam_file_size(bam)
+    if not quiet and fsize:
+        eta = ETA(fsize)
     else:
         eta = None
 
     for pileup in bam.pileup(mask=mask):
-        pos = bam.tell()
-        bgz_offset = pos >> 16
-
-        if not quiet:
+        if eta:
+            bgz_offset = bam.tell() >> 16
             if callback:
                 eta.print_status(bgz_offset, extra=callback(pileup))
             else:
@@ -48,14 +774,13 @@ def bam_iter(bam, quiet=False, show_ref_pos=False, ref=None, start=None, end=Non
     eta = None
 
     if not ref:
-        if not quiet and bam.filename:
-            eta = ETA(os.stat(bam.filename).st_size)
+        fsize = bam_file_size(bam)
+        if not quiet and fsize:
+            eta = ETA(fsize)
 
         for read in bam:
-            pos = bam.tell()
-            bgz_offset = pos >> 16
-
-            if not quiet and eta:
+            if eta:
+                bgz_offset = bam.tell() >> 16
                 if callback:
                     eta.print_status(bgz_offset, extra=callback(read))
                 elif (show_ref_pos):
@@ -121,6 +846,121 @@ def bam_batch_reads(bam, quiet=False):
         yield reads
 
 
+def bam_batch_range(bam, start, end):
+    'Yields batches of reads (by name) in the virtual offset range [start, end)'
+    bam.seek(start)
+
+    batch = []
+    pos = start
+    for read in bam:
+        if end is not None and pos >= end:
+            break
+        if batch and read.qname != batch[0].qname:
+            yield batch
+            batch = []
+        batch.append(read)
+        pos = bam.tell()
+
+    if batch:
+        yield batch
+
+
+def bam_batch_offsets(fname, reads=20000, threads=1):
+    '''
+    Splits a name-grouped BAM file into ranges of about 'reads' records (each
+    range is extended to the end of the records for its last read name, so
+    all of the reads for a name are in the same range). Yields (start, end)
+    virtual offsets (end is None for the last range).
+
+    Only the record sizes are read (and the read names at the end of each
+    range), using 'threads' threads to inflate the file. The ranges are
+    found as they are needed, so this can be given to bam_pool_map directly
+    and the workers can start before the whole file has been scanned.
+    See: bam_batch_range, bam_pool_map.
+    '''
+    bam = RawBamReader(fname, threads=threads)
+    start = bam.tell()
+
+    while bam.skip(reads - 1) == reads - 1:
+        # the first name is the last read in the range, the next one starts
+        # the next range
+        names = bam.name_offsets()
+        try:
+            names.next()
+            qname, pos = names.next()
+        except StopIteration:
+            break
+
+        yield (start, pos)
+        start = pos
+
+    bam.close()
+    yield (start, None)
+
+
+def bam_tmpname(tmpdir=None):
+    'Returns the name of a new (empty) temporary BAM file in tmpdir'
+    tmp = tempfile.NamedTemporaryFile(prefix='.tmp', suffix='.bam', dir=tmpdir, delete=False)
+    tmp.close()
+    return tmp.name
+
+
+def bam_pool_map(func, tasks, outnames, procs, levels=None):
+    '''
+    Processes ranges of a name-grouped BAM file in a pool of processes (for
+    commands that handle each read name on its own, like best or pair).
+
+    tasks can be a generator (like bam_batch_offsets). It is read in a
+    background thread as the workers run.
+
+    func(task) is called in a worker process. It should write its reads to
+    temporary BAM files (one for each file in outnames, at the compression
+    level in levels for that file) and return (tmpnames, result). As they
+    finish, the temporary files are added to the output files in task order
+    (by copying the compressed blocks) and removed, so the output is the same
+    as if the tasks were run one after the other.
+
+    Returns the list of results (in task order).
+    '''
+    if levels is None:
+        levels = [None] * len(outnames)
+
+    pool = multiprocessing.Pool(procs)
+    outs = None
+    results = []
+
+    try:
+        for tmpnames, result in pool.imap(func, tasks):
+            if outs is None:
+                outs = []
+                for outname, tmpname, level in zip(outnames, tmpnames, levels):
+                    tmp = RawBamReader(tmpname)
+                    outs.append(RawBamWriter(outname, tmp.header_data, level=level))
+                    tmp.close()
+
+            for out, tmpname in zip(outs, tmpnames):
+                tmp = RawBamReader(tmpname)
+                start = tmp.tell()
+                tmp.close()
+
+                out.copy_range(tmpname, start)
+                os.unlink(tmpname)
+
+            results.append(result)
+
+        pool.close()
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if outs:
+        for out in outs:
+            out.close()
+
+    return results
+
+
 bam_cigar = ['M', 'I', 'D', 'N', 'S', 'H', 'P', '=', 'X']
 bam_cigar_op = {
     'M': 0,
@@ -535,7 +1375,66 @@ def read_calc_mismatches_ref(ref, read, chrom):
     return edits
 
 
-__region_cache = {}
+def parse_region_name(name):
+    '''
+    Parses a region/junction reference name (chrom:start-end,start-end,...)
+
+    returns: (chrom, fragments, offsets)
+
+    offsets are the cumulative starting positions of each fragment within
+    the region reference (used to find the fragment for a position with bisect).
+
+    >>> parse_region_name('chr1:1000-1050,2000-2050,3000-4000')
+    ('chr1', [(1000, 1050), (2000, 2050), (3000, 4000)], [0, 50, 100])
+    '''
+    c1 = name.split(':')
+    chrom = c1[0]
+
+    fragments = []
+    offsets = []
+    acc = 0
+    for fragment in c1[1].split(','):
+        s, e = fragment.split('-')
+        s = int(s)
+        e = int(e)
+        fragments.append((s, e))
+        offsets.append(acc)
+        acc += e - s
+
+    return (chrom, fragments, offsets)
+
+
+class RegionCache(object):
+    '''
+    Bounded (LRU) cache of parsed region reference names.
+
+    Entries are keyed by the reference id (tid) of the region BAM file, so the
+    reference name string is only parsed the first time a tid is seen (or
+    after it has been evicted).
+    '''
+    def __init__(self, references=None, maxsize=100000):
+        self.references = references
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+
+    def get(self, key, name=None):
+        if key in self._cache:
+            val = self._cache.pop(key)
+        else:
+            val = parse_region_name(name if name is not None else self.references[key])
+            while len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+
+        self._cache[key] = val
+        return val
+
+    def region_pos_to_genomic_pos(self, tid, start, cigar):
+        'see region_pos_to_genomic_pos'
+        chrom, fragments, offsets = self.get(tid)
+        return _region_pos_to_genomic_pos(self.references[tid], chrom, fragments, offsets, start, cigar)
+
+
+__region_cache = RegionCache(maxsize=10000)
 
 
 def region_pos_to_genomic_pos(name, start, cigar):
@@ -566,43 +1465,29 @@ def region_pos_to_genomic_pos(name, start, cigar):
     >>> region_pos_to_genomic_pos('chr7:16829153-16829246,16829246-16829339', 62, cigar_fromstr('83M18S'))
     ('chr7', 16829215, [(0, 31), (3, 0), (0, 52), (4, 18)])
 
+    >>> region_pos_to_genomic_pos('chr1:1000-1050,2000-2050', 60, [(0, 30)])
+    ('chr1', 2010, [(0, 30)])
 
-    '''
-
-    if name in __region_cache:
-        chrom, fragments = __region_cache[name]
-    else:
-        c1 = name.split(':')
-        chrom = c1[0]
 
-        fragments = []
-        for fragment in c1[1].split(','):
-            s, e = fragment.split('-')
-            fragments.append((int(s), int(e)))
+    '''
 
-        __region_cache[name] = (chrom, fragments)
+    # no tid available here, so this cache is keyed by name
+    chrom, fragments, offsets = __region_cache.get(name, name)
+    return _region_pos_to_genomic_pos(name, chrom, fragments, offsets, start, cigar)
 
-    chr_cigar = []
-    chr_start = fragments[0][0]
 
+def _region_pos_to_genomic_pos(name, chrom, fragments, offsets, start, cigar):
     read_start = int(start)
 
-    frag_idx = 0
-    frag_start = 0
-    frag_end = 0
+    # find the fragment that contains the starting position
+    frag_idx = bisect.bisect_right(offsets, read_start) - 1
+    if frag_idx >= len(fragments):
+        frag_idx = len(fragments) - 1
 
-    for i, (s, e) in enumerate(fragments):
-        if chr_start + read_start < e:
-            chr_start += read_start
-            frag_idx = i
-            frag_start = s
-            frag_end = e
-            break
-
-        else:
-            chr_start += (e - s)
-            read_start -= (e - s)
+    frag_start, frag_end = fragments[frag_idx]
+    chr_start = frag_start + read_start - offsets[frag_idx]
 
+    chr_cigar = []
     cur_pos = chr_start
 
     for op, length in cigar:
@@ -812,6 +1697,10 @@ def cleancigar(cigar):
 
     return None
 
+# importing the ngsutils.bam.cleancigar module replaces the 'cleancigar'
+# attribute of this package, so keep a private reference to the function.
+_cleancigar = cleancigar
+
 
 def read_cleancigar(read):
     '''
@@ -824,7 +1713,7 @@ def read_cleancigar(read):
 
     newcigar = []
 
-    newcigar = cleancigar(read.cigar)
+    newcigar = _cleancigar(read.cigar)
 
     if newcigar:
         read.cigar = newcigar
@@ -870,6 +1759,91 @@ def read_to_unmapped(read, ref=None):
     return newread
 
 
+def read_coord_key(read):
+    '''
+    Sort key for coordinate ordering. Reads without a reference (tid -1) are
+    placed at the end of the file.
+    '''
+    if read.tid < 0:
+        return (sys.maxint, 0)
+    return (read.tid, read.pos)
+
+
+def bam_write_sorted_run(reads, header, tmpdir=None, key=read_coord_key):
+    '''
+    Sorts a list of reads (in place) and writes them to a temporary BAM file.
+    The sort is stable, so reads with the same key keep their input order.
+    If key is None, the reads are written as-is.
+
+    Returns the name of the temporary file.
+    '''
+    if key:
+        reads.sort(key=key)
+
+    tmpname = bam_tmpname(tmpdir)
+
+    out = pysam.Samfile(tmpname, 'wb', header=header)
+    for read in reads:
+        out.write(read)
+    out.close()
+
+    return tmpname
+
+
+def bam_merge_sorted_runs(fnames, key=read_coord_key, raw=False):
+    '''
+    Heap-based k-way merge of sorted BAM files. Yields reads in sorted order.
+
+    Ties are broken by the order of the files, then by the order of the reads
+    in each file (so a merge of sorted runs is stable). If raw is True, the
+    files are read with RawBamReaders (and RawReads are returned).
+    '''
+    if raw:
+        bams = [RawBamReader(fname) for fname in fnames]
+    else:
+        bams = [pysam.Samfile(fname, 'rb') for fname in fnames]
+
+    def _keyed(i, bam):
+        for j, read in enumerate(bam):
+            yield (key(read), i, j, read)
+
+    for k, i, j, read in heapq.merge(*[_keyed(i, bam) for i, bam in enumerate(bams)]):
+        yield read
+
+    for bam in bams:
+        bam.close()
+
+
+def bam_merge_run_groups(runs, key=read_coord_key, tmpdir=None, max_files=64, level=1):
+    '''
+    Merges groups of max_files sorted runs (temporary BAM files) until there
+    are at most max_files left, so that the final merge doesn't run out of
+    file handles. Groups are merged in order, so the merge is still stable.
+    The merged runs are removed and 'runs' is updated in place.
+    '''
+    while len(runs) > max_files:
+        merged = []
+        for i in xrange(0, len(runs), max_files):
+            group = runs[i:i + max_files]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+
+            tmp = RawBamReader(group[0])
+            header_data = tmp.header_data
+            tmp.close()
+
+            tmpname = bam_tmpname(tmpdir)
+            merged.append(tmpname)
+            out = RawBamWriter(tmpname, header_data, level=level)
+            for read in bam_merge_sorted_runs(group, key, raw=True):
+                out.write(read)
+            out.close()
+
+            for run in group:
+                os.unlink(run)
+        runs[:] = merged
+
 
 if __name__ == '__main__':
     import doctest
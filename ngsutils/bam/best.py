@@ -12,7 +12,6 @@ should be kept and which should be discarded. The tag should be a numeric
 
 import os
 import sys
-import pysam
 import ngsutils.bam
 
 
@@ -32,56 +31,124 @@ Options
 
   -fail filename.bam    Write all failed mappings to this file.
 
+  -p N        Use N processes (input.bam must be a file, not stdin)
+              [default: 1]
+
+  -T dir      Use this directory for temporary files (-p only)
+              [default: same directory as output.bam]
+
 """
     sys.exit(1)
 
 
-def bam_best(infile, outfile, failfile=None, tags=['AS+', 'NM-'], quiet=False):
-    inbam = pysam.Samfile(infile, "rb")
-    outbam = pysam.Samfile('%s.tmp' % outfile, "wb", template=inbam)
+def best_reads(reads, tags=['AS+', 'NM-']):
+    '''
+    Picks the best mappings for a read (all of the mappings with the best tag
+    values). Returns (best, failed) (unmapped reads are in neither).
+    '''
+    best_val = None
+    best = []
+    failed = []
 
-    if failfile:
-        failbam = pysam.Samfile('%s.tmp' % failfile, "wb", template=inbam)
+    for read in reads:
+        if not read.is_unmapped:
+            tag_val = []
+            for tag in tags:
+                val = float(read.opt(tag[:2]))
+                if tag[-1] == '-':
+                    val = -val
+                tag_val.append(val)
 
-    for reads in ngsutils.bam.bam_batch_reads(inbam, quiet=quiet):
-        best_val = None
-        best_reads = []
-        failed = []
+            if not best_val or tag_val > best_val:
+                failed.extend(best)
+                best_val = tag_val
+                best = [read]
 
-        for read in reads:
-            if not read.is_unmapped:
-                tag_val = []
-                for tag in tags:
-                    val = float(read.opt(tag[:2]))
-                    if tag[-1] == '-':
-                        val = -val
-                    tag_val.append(val)
+            elif tag_val == best_val:
+                best.append(read)
 
-                if not best_val or tag_val > best_val:
-                    if best_reads and failfile:
-                        failed.extend(best_reads)
+            else:
+                failed.append(read)
 
-                    best_val = tag_val
-                    best_reads = [read]
+    return best, failed
 
-                elif tag_val == best_val:
-                    best_reads.append(read)
 
-                elif failfile:
-                    failed.append(read)
+def _best_batches(batches, outbam, failbam, tags):
+    for reads in batches:
+        best, failed = best_reads(reads, tags)
 
-        for read in best_reads:
+        for read in best:
             outbam.write(read)
 
-        if failfile:
+        if failbam:
             for read in failed:
                 failbam.write(read)
 
+
+def _best_worker(args):
+    infile, start, end, tmpdir, has_failed, tags, level = args
+
+    inbam = ngsutils.bam.bam_open(infile)
+    tmpnames = [ngsutils.bam.bam_tmpname(tmpdir)]
+    outbam = ngsutils.bam.bam_open_writer(tmpnames[0], level=level, template=inbam)
+
+    failbam = None
+    if has_failed:
+        tmpnames.append(ngsutils.bam.bam_tmpname(tmpdir))
+        failbam = ngsutils.bam.bam_open_writer(tmpnames[1], template=inbam)
+
+    _best_batches(ngsutils.bam.bam_batch_range(inbam, start, end), outbam, failbam, tags)
+
+    inbam.close()
     outbam.close()
-    os.rename('%s.tmp' % outfile, outfile)
+    if failbam:
+        failbam.close()
+
+    return tmpnames, None
+
+
+def bam_best(infile, outfile, failfile=None, tags=['AS+', 'NM-'], quiet=False, procs=1, tmpdir=None, batch_size=20000):
+    '''
+    If procs > 1, ranges of read names are processed in a pool of processes
+    (infile must be a BAM file, not stdin). Each range has about batch_size
+    reads.
+    '''
+    outname = outfile if outfile == '-' else '%s.tmp' % outfile
+
+    if procs > 1 and infile != '-':
+        if tmpdir is None and outfile != '-':
+            tmpdir = os.path.dirname(os.path.abspath(outfile))
+
+        outnames = [outname]
+        if failfile:
+            outnames.append('%s.tmp' % failfile)
+
+        # the workers compress the output at the final level (stdout is
+        # uncompressed)
+        level = 0 if outfile == '-' else None
+        # (the ranges are found while the workers run)
+        tasks = ((infile, start, end, tmpdir, failfile is not None, tags, level) for start, end in ngsutils.bam.bam_batch_offsets(infile, batch_size, procs))
+        ngsutils.bam.bam_pool_map(_best_worker, tasks, outnames, procs, [level, None])
+
+    else:
+        inbam = ngsutils.bam.bam_open(infile)
+        outbam = ngsutils.bam.bam_open_writer(outname, template=inbam)
+
+        failbam = None
+        if failfile:
+            failbam = ngsutils.bam.bam_open_writer('%s.tmp' % failfile, template=inbam)
+
+        _best_batches(ngsutils.bam.bam_batch_reads(inbam, quiet=quiet), outbam, failbam, tags)
+
+        inbam.close()
+        outbam.close()
+        if failbam:
+            failbam.close()
+
+    if outname != outfile:
+        os.rename(outname, outfile)
 
     if failfile:
-        failbam.close()
         os.rename('%s.tmp' % failfile, failfile)
 
 
@@ -89,6 +156,8 @@ if __name__ == '__main__':
     infile = None
     outfile = None
     failfile = None
+    procs = 1
+    tmpdir = None
     last = None
     tags = []
 
@@ -101,9 +170,15 @@ if __name__ == '__main__':
         elif last == '-fail':
             failfile = arg
             last = None
-        elif arg in ['-tag', '-fail']:
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif last == '-T':
+            tmpdir = arg
+            last = None
+        elif arg in ['-tag', '-fail', '-p', '-T']:
             last = arg
-        elif not infile and os.path.exists(arg):
+        elif not infile and ngsutils.bam.bam_exists(arg):
             infile = arg
         elif not outfile:
             outfile = arg
@@ -116,4 +191,4 @@ if __name__ == '__main__':
     if not infile or not outfile:
         usage()
     else:
-        bam_best(infile, outfile, failfile, tags)
+        bam_best(infile, outfile, failfile, tags, procs=procs, tmpdir=tmpdir)
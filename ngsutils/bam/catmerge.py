@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+## category General
+## desc Merges coordinate sorted BAM files into one sorted file
+'''
+Merges coordinate sorted BAM files into one sorted file
+
+This is for combining the sorted shards from parallel jobs (for combining the
+best alignments from separate mappings, see: bamutils merge). All of the files
+must have the same references (in the same order). The header is taken from
+the first file.
+
+Reads are merged without being decoded. If the files are indexed, the reads
+for a reference that only one file has reads on are copied as compressed
+blocks (only the first and last block are inflated), so shards that cover
+different references are just concatenated. References that are in more than
+one file are merged. Reads without a reference are written at the end, in
+the order of the input files.
+'''
+
+import heapq
+import os
+import sys
+
+import pysam
+
+from ngsutils.bam import RawBamReader, RawBamWriter, BamIndex, bam_exists, read_coord_key
+
+
+def _check_references(infiles, bams):
+    for fname, bam in zip(infiles[1:], bams[1:]):
+        if bam.references != bams[0].references or bam.lengths != bams[0].lengths:
+            raise ValueError('%s has different references than %s' % (fname, infiles[0]))
+
+
+def _load_indexes(infiles):
+    '''
+    Returns the BAM indexes for the files, or None if any of the files aren't
+    indexed (or the index doesn't have the reference ranges).
+    '''
+    indexes = []
+    for fname in infiles:
+        if not os.path.exists('%s.bai' % fname):
+            return None
+        index = BamIndex('%s.bai' % fname)
+        if index.read_count() is None:
+            return None
+        indexes.append(index)
+    return indexes
+
+
+def _plan_segments(bams, indexes):
+    '''
+    Splits the output into segments, each a list of (file, start, end) virtual
+    offset ranges that are merged together. Without indexes, there is one
+    segment with all of the files. Returns a list of (is_ref, segment), where
+    is_ref is False for the reads without a reference.
+    '''
+    if indexes is None:
+        return [(True, [(i, bam.tell(), None) for i, bam in enumerate(bams)])]
+
+    segments = []
+    for tid in xrange(bams[0].nreferences):
+        segment = [(i, index.meta[tid][0], index.meta[tid][1]) for i, index in enumerate(indexes) if index.meta[tid]]
+        if segment:
+            segments.append((True, segment))
+
+    # Reads without a reference all have the same sort key, so merging them
+    # just writes them in file order.
+    for i, (bam, index) in enumerate(zip(bams, indexes)):
+        ends = [meta[1] for meta in index.meta if meta]
+        segments.append((False, [(i, max(ends) if ends else bam.tell(), None)]))
+
+    return segments
+
+
+def _range_reads(bam, i, start, end):
+    'Yields (key, file, n, read) for the reads in a virtual offset range'
+    bam.seek(start)
+    last = None
+    n = 0
+    while end is None or bam.tell() < end:
+        try:
+            read = bam.next()
+        except StopIteration:
+            break
+
+        key = read_coord_key(read)
+        if last is not None and key < last:
+            raise ValueError('%s is not sorted by coordinate' % bam.filename)
+        last = key
+
+        yield (key, i, n, read)
+        n += 1
+
+
+def bam_catmerge(infiles, outfile, threads=1, level=None, read_threads=1, index=True):
+    '''
+    Merges coordinate sorted BAM files. Returns the number of references
+    that were copied and merged (or (0, 1) if the files aren't indexed).
+
+    threads      - the number of threads to use to compress the output
+    read_threads - the number of threads to use to inflate each input file
+    '''
+    bams = [RawBamReader(fname, threads=read_threads) for fname in infiles]
+    _check_references(infiles, bams)
+
+    if outfile == '-' and level is None:
+        level = 0
+
+    tmpname = outfile if outfile == '-' else '%s.tmp' % outfile
+    out = RawBamWriter(tmpname, bams[0].header_data, threads, level)
+
+    copied = 0
+    merged = 0
+
+    try:
+        for is_ref, segment in _plan_segments(bams, _load_indexes(infiles)):
+            if len(segment) == 1:
+                i, start, end = segment[0]
+                out.copy_range(infiles[i], start, end)
+                if is_ref:
+                    copied += 1
+            else:
+                for key, i, n, read in heapq.merge(*[_range_reads(bams[i], i, start, end) for i, start, end in segment]):
+                    out.write(read)
+                merged += 1
+
+        out.close()
+
+    except:
+        out.close()
+        if tmpname != outfile:
+            os.unlink(tmpname)
+        raise
+
+    for bam in bams:
+        bam.close()
+
+    if tmpname != outfile:
+        os.rename(tmpname, outfile)
+
+        if index:
+            pysam.index(outfile)
+
+    return copied, merged
+
+
+def usage(msg=None):
+    if msg:
+        print msg
+        print
+    print __doc__
+    print """\
+Usage: bamutils catmerge {opts} out.bam in1.bam in2.bam...
+
+Use '-' to write to stdout (uncompressed, unless -level is given). The input
+files must be named (seekable) BAM files, not stdin.
+
+Options:
+  -f             Force overwriting an existing out.bam file
+
+  -noindex       Don't index the output file
+
+  -threads N     Use N threads to compress the output BAM file [default: 1]
+
+  -rthreads N    Use N threads to inflate each of the input files
+                 [default: 1]
+
+  -level N       Compression level for the output BAM file (0-9). Use 0 for
+                 uncompressed output that will be piped to another program.
+                 [default: 6]
+"""
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    outfile = None
+    infiles = []
+    force = False
+    index = True
+    threads = 1
+    read_threads = 1
+    level = None
+    last = None
+
+    for arg in sys.argv[1:]:
+        if last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-rthreads':
+            read_threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
+        elif arg == '-h':
+            usage()
+        elif arg in ['-threads', '-rthreads', '-level']:
+            last = arg
+        elif arg == '-f':
+            force = True
+        elif arg == '-noindex':
+            index = False
+        elif not outfile:
+            outfile = arg
+        elif arg == '-':
+            # the inputs are re-opened and seeked to copy/merge each reference
+            usage('Input files can\'t be read from stdin (-)')
+        elif bam_exists(arg):
+            infiles.append(arg)
+        else:
+            usage('Missing file: %s' % arg)
+
+    if not outfile or not infiles:
+        usage()
+
+    if outfile != '-' and not force and os.path.exists(outfile):
+        sys.stderr.write('ERROR: %s already exists! Not overwriting without force (-f)\n\n' % outfile)
+        sys.exit(1)
+
+    copied, merged = bam_catmerge(infiles, outfile, threads, level, read_threads, index)
+    sys.stderr.write('references copied: %s\nreferences merged: %s\n' % (copied, merged))
@@ -3,17 +3,140 @@
 ## desc Checks a BAM file for corruption
 '''
 Checks a BAM file for corruption
+
+By default, every read in the file is decoded. In fast mode (-fast), only
+the BGZF blocks are checked: each block is inflated and its CRC32 and size
+are verified (in parallel with -threads), the EOF marker must be present,
+and if there is a BAM index (.bai), it must match the file. Reads from a
+sample of positions can then be decoded with -sample.
 '''
 import sys
 import os
+import struct
+import zlib
 
+import pysam
 import ngsutils.bam
+from ngsutils.support.bgzip import BGZFReader, BGZF_EOF
+
+
+def bam_check_blocks(fname, threads=1, sample=0, sample_reads=100):
+    '''
+    Checks a BAM file without decoding all of the reads.
+
+    Each BGZF block is inflated and its CRC32 and ISIZE are verified (using
+    'threads' threads), the file must end with an EOF marker, and the
+    header must be valid. If the file has an index, every offset in the index
+    must point to a valid position in the file.
+
+    If sample is > 0, then 'sample_reads' reads are decoded from 'sample'
+    evenly spaced positions in the index (or from the start of the file, if
+    there is no index).
+
+    Returns None if the file is OK, otherwise an error message.
+    '''
+    fsize = os.stat(fname).st_size
+    if fsize < len(BGZF_EOF):
+        return 'file is too small'
+
+    with open(fname, 'rb') as f:
+        f.seek(-len(BGZF_EOF), 2)
+        if f.read() != BGZF_EOF:
+            return 'missing EOF marker (truncated file?)'
+
+    # block offset => uncompressed size
+    blocks = {}
+    reader = BGZFReader(fname, threads=threads, check=True)
+    try:
+        for offset, data in reader.iter_blocks():
+            blocks[offset] = len(data)
+
+        reader.seek(0)
+        if reader.read(4) != 'BAM\1':
+            return 'invalid BAM header (bad magic)'
+        l_text, = struct.unpack('<i', reader.read(4))
+        reader.read(l_text)
+        n_ref, = struct.unpack('<i', reader.read(4))
+        for i in xrange(n_ref):
+            l_name, = struct.unpack('<i', reader.read(4))
+            reader.read(l_name + 4)
+
+    except (ValueError, zlib.error, struct.error) as e:
+        return 'block at offset %s: %s' % (reader.tell() >> 16, e)
+
+    finally:
+        reader.close()
+
+    linear = []
+    if os.path.exists('%s.bai' % fname):
+        try:
+            index = ngsutils.bam.BamIndex('%s.bai' % fname)
+        except (ValueError, struct.error) as e:
+            return 'index: %s' % e
 
+        if index.nreferences != n_ref:
+            return 'index: number of references doesn\'t match the BAM header'
 
-def bam_check(fname, quiet=False):
+        linear = []
+        for vals in index.linear:
+            linear.extend(vals)
+
+        for voffset in index.offsets():
+            coffset = voffset >> 16
+            uoffset = voffset & 0xFFFF
+            if coffset == fsize and not uoffset:
+                continue
+            if coffset not in blocks or uoffset > blocks[coffset]:
+                return 'index: invalid offset %s (out of date index?)' % voffset
+
+    if sample > 0:
+        try:
+            bamfile = pysam.Samfile(fname, 'rb')
+            if linear:
+                offsets = sorted(set([x for x in linear if x]))
+                step = max(1, len(offsets) / sample)
+                offsets = offsets[::step][:sample]
+            else:
+                offsets = [bamfile.tell()]
+                sample_reads = sample_reads * sample
+
+            for offset in offsets:
+                bamfile.seek(offset)
+                for i in xrange(sample_reads):
+                    try:
+                        bamfile.next()
+                    except StopIteration:
+                        break
+            bamfile.close()
+        except Exception as e:
+            return 'unable to decode reads: %s' % e
+
+    return None
+
+
+def bam_check(fname, quiet=False, fast=False, threads=1, sample=0):
     if not quiet:
         sys.stdout.write('%s: ' % fname)
         sys.stdout.flush()
+
+    # stdin can't be checked without reading all of it
+    if fast and fname != '-':
+        try:
+            msg = bam_check_blocks(fname, threads, sample)
+        except KeyboardInterrupt:
+            if not quiet:
+                sys.stdout.write('\n')
+            sys.exit(-1)
+
+        if msg:
+            if not quiet:
+                sys.stdout.write('ERROR! (%s)\n' % msg)
+            return False
+
+        if not quiet:
+            sys.stdout.write('OK\n')
+        return True
+
     fail = False
     i = 1
     try:
@@ -42,16 +165,40 @@ def bam_check(fname, quiet=False):
 
 def usage():
     print __doc__
-    print "Usage: bamutils check bamfile..."
+    print """Usage: bamutils check {options} bamfile...
+
+Use '-' to check a file from stdin (all reads are decoded, even with -fast).
+
+Options:
+  -fast        Check the BGZF blocks (and index) without decoding reads
+  -threads N   Use N threads to inflate and verify blocks (-fast only)
+               [default: 1]
+  -sample N    Decode reads from N positions in the file (-fast only)
+               [default: 0]
+"""
     sys.exit(-1)
 
 if __name__ == "__main__":
     fnames = []
+    fast = False
+    threads = 1
+    sample = 0
+    last = None
 
     for arg in sys.argv[1:]:
-        if arg == "-h":
+        if last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-sample':
+            sample = int(arg)
+            last = None
+        elif arg == "-h":
             usage()
-        elif os.path.exists(arg):
+        elif arg == "-fast":
+            fast = True
+        elif arg in ['-threads', '-sample']:
+            last = arg
+        elif ngsutils.bam.bam_exists(arg):
             fnames.append(arg)
         else:
             sys.stderr.write("File: %s not found!\n" % arg)
@@ -62,7 +209,7 @@ if __name__ == "__main__":
 
     fail = False
     for f in fnames:
-        if not bam_check(f):
+        if not bam_check(f, fast=fast, threads=threads, sample=sample):
             fail = True
 
     if fail:
@@ -20,6 +20,7 @@ See: Zhang and Darnell, Nature Biotechnology (2011)
 import os
 import sys
 from ngsutils.bam import bam_pileup_iter
+from ngsutils.support.refcache import CachedFastaFile
 import pysam
 
 
@@ -71,7 +72,7 @@ class BEDEmitter(object):
 class FASTAEmitter(object):
     def __init__(self, ref_fname, flanking=12, out=None):
         self.num = 1
-        self.ref = pysam.Fastafile(ref_fname)
+        self.ref = CachedFastaFile(ref_fname)
         assert flanking > 0
         self.flanking = flanking
 
@@ -81,6 +82,7 @@ class FASTAEmitter(object):
             self.out = sys.stdout
 
     def close(self):
+        sys.stderr.write('Reference cache: %s\n' % self.ref.stats())
         self.ref.close()
         if self.out != sys.stdout:
             self.out.close()
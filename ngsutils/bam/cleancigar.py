@@ -6,14 +6,13 @@ Fixes BAM files where the CIGAR alignment has a zero length element
 '''
 import sys
 import os
-import pysam
 
-from ngsutils.bam import bam_iter, read_cleancigar
+from ngsutils.bam import bam_iter, bam_open, bam_open_writer, bam_exists, read_cleancigar
 
 
 def bam_cleancigar(infile, outfile):
-    bam = pysam.Samfile(infile, "rb")
-    out = pysam.Samfile(outfile, "wb", template=bam)
+    bam = bam_open(infile)
+    out = bam_open_writer(outfile, template=bam)
     total = 0
     count = 0
     for read in bam_iter(bam):
@@ -33,6 +32,8 @@ def usage():
     print __doc__
     print """Usage: bamutils cleancigar {-f} inbamfile outbamfile
 
+Use '-' to read from stdin or write to stdout.
+
 Options:
   -f     Force overwriting an existing outfile
 """
@@ -49,7 +50,7 @@ if __name__ == "__main__":
         elif arg == "-f":
             force = True
         elif not infile:
-            if os.path.exists(os.path.expanduser(arg)):
+            if bam_exists(os.path.expanduser(arg)):
                 infile = os.path.expanduser(arg)
             else:
                 sys.stderr.write("File: %s not found!" % arg)
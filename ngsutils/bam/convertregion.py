@@ -30,6 +30,7 @@ chr1    1025    25M950N50M950M25M
 
 import os
 import sys
+import multiprocessing
 import pysam
 import ngsutils.bam
 
@@ -37,10 +38,13 @@ import ngsutils.bam
 def usage():
     print __doc__
     print """
-Usage: bamutils convertregion {-overlap} in.bam out.bam [chrom.sizes]
+Usage: bamutils convertregion {opts} in.bam out.bam [chrom.sizes]
 
 (Note: A samtools faidx file can be used for the chrom.sizes file.)
 
+Use '-' to read from stdin (SAM or BAM) or write to stdout (uncompressed BAM,
+unless -level is given). Reads from stdin are converted in one process.
+
 Options:
   -f             Force overwriting an existing out.bam file
   -unmapped      Keep all unmapped reads in the output file (including invalid junction reads)
@@ -56,83 +60,92 @@ Options:
                  If -validateonly is set, then the chrom.sizes file isn't
                  required.
 
-"""
-    sys.exit(1)
-
-
-def bam_convertregion(infile, outfname, chrom_sizes=None, overlap=4, validateonly=False, keep_unmapped=False, quiet=False):
-    bamfile = pysam.Samfile(infile, "rb")
+  -nosort        Write the reads in the same order as in.bam (junction
+                 reference order), instead of coordinate sorting them. (By
+                 default, the converted reads are sorted in chunks that are
+                 merged together, so a separate sort isn't required.)
 
-    if validateonly:
-        outfile = pysam.Samfile('%s.tmp' % outfname, "wb", template=bamfile)
+  -p N           Use N processes to convert reads in parallel [default 1]
 
-    else:
-        if not chrom_sizes:
-            ValueError("Missing chrom_sizes file!")
+  -T dir         Use this directory for temporary files
+                 [default: same directory as out.bam]
 
-        header = bamfile.header
-        header['SQ'] = []
+  -cs N          Sort at most N reads in memory per process [default 1000000]
 
-        with open(chrom_sizes) as f:
-            for line in f:
-                if line[0] != '#':
-                    cols = line.strip().split('\t')
-                    header['SQ'].append({'LN': int(cols[1]), 'SN': cols[0]})
+  -threads N     Use N threads to compress the output BAM file [default 1]
 
-        outfile = pysam.Samfile('%s.tmp' % outfname, "wb", header=header)
+  -level N       Compression level for the output BAM file (0-9). Use 0 for
+                 uncompressed output that will be piped to another program.
+                 [default 6]
 
-    converted_count = 0
-    invalid_count = 0
-    unmapped_count = 0
+"""
+    sys.exit(1)
 
-    inreferences = list(bamfile.references)
-    outreferences = {}
-    for i, name in enumerate(outfile.references):
-        outreferences[name] = i
 
-    for batch in ngsutils.bam.bam_batch_reads(bamfile):
+class RegionConverter(object):
+    '''
+    Converts batches of reads (all mappings for one read name) from region
+    coordinates to genomic coordinates.
+    '''
+    def __init__(self, inreferences, outreferences, overlap=4, validateonly=False, keep_unmapped=False):
+        self.inreferences = inreferences
+        self.regions = ngsutils.bam.RegionCache(inreferences)
+        self.outreferences = {}
+        for i, name in enumerate(outreferences):
+            self.outreferences[name] = i
+
+        self.overlap = overlap
+        self.validateonly = validateonly
+        self.keep_unmapped = keep_unmapped
+
+        self.converted_count = 0
+        self.invalid_count = 0
+        self.unmapped_count = 0
+
+    def convert(self, batch):
+        'Returns a list of the reads that should be written for this batch'
+        out = []
         outreads = []
         unmapped_read = None
 
         for read in batch:
             if read.is_unmapped and not read.is_secondary:
                 # read is unmapped, so there aren't multiple mappings to deal with
-                unmapped_count += 1
-                if not overlap or keep_unmapped:
-                    outfile.write(read)
+                self.unmapped_count += 1
+                if not self.overlap or self.keep_unmapped:
+                    out.append(read)
                 continue
 
-            chrom, pos, cigar = ngsutils.bam.region_pos_to_genomic_pos(inreferences[read.tid], read.pos, read.cigar)
+            chrom, pos, cigar = self.regions.region_pos_to_genomic_pos(read.tid, read.pos, read.cigar)
 
-            if not validateonly:
+            if not self.validateonly:
                 read.pos = pos
                 try:
                     read.cigar = cigar
                 except:
-                    print "Error trying to set CIGAR: %s to %s (%s, %s, %s)" % (read.cigar, cigar, read.qname, bamfile.getrname(read.tid), read.pos)
+                    print "Error trying to set CIGAR: %s to %s (%s, %s, %s)" % (read.cigar, cigar, read.qname, self.inreferences[read.tid], read.pos)
 
-                if not chrom in outreferences:
+                if not chrom in self.outreferences:
                     print "Can't find chrom: %s" % chrom
                     sys.exit(1)
 
-                read.tid = outreferences[chrom]
-
+                read.tid = self.outreferences[chrom]
 
             # just do a conversion, don't check it...
-            if not overlap:
-                if not validateonly:
+            if not self.overlap:
+                if not self.validateonly:
                     ngsutils.bam.read_cleancigar(read)
-                outfile.write(read)
+                out.append(read)
                 continue
 
-            valid, reason = ngsutils.bam.is_junction_valid(cigar, overlap)
+            valid, reason = ngsutils.bam.is_junction_valid(cigar, self.overlap)
             if valid:
-                converted_count += 1
+                self.converted_count += 1
                 outreads.append(read)
             else:
                 if not unmapped_read:
-                    unmapped_read = ngsutils.bam.read_to_unmapped(read, inreferences[read.tid])
-                invalid_count += 1
+                    unmapped_read = ngsutils.bam.read_to_unmapped(read, self.inreferences[read.tid])
+                self.invalid_count += 1
 
         if outreads:
             for i, read in enumerate(outreads):
@@ -154,42 +167,210 @@ def bam_convertregion(infile, outfname, chrom_sizes=None, overlap=4, validateonl
                     newtags.append(('NH', len(outreads)))
 
                 read.tags = newtags
-                if not validateonly:
+                if not self.validateonly:
                     ngsutils.bam.read_cleancigar(read)
-                outfile.write(read)
+                out.append(read)
         elif unmapped_read:
-            outfile.write(unmapped_read)
+            out.append(unmapped_read)
 
         #
         # If a read doesn't overlap, just skip it in the output, don't reset the values
         #
-        # else:
-        #     read = pysam.AlignedRead()
-        #     read.is_unmapped = True
-        #     read.qname = batch[0].qname
-        #     read.rname = -1
-        #     read.mrnm = -1
-        #     read.mpos = -1
-        #     read.pos = -1
-        #     read.mapq = 0
-        #     read.isize = 0
-        #     read.seq = batch[0].seq
-        #     read.qual = batch[0].qual
-        #     if batch[0].opt('CS'):
-        #         # for some reason, pysam doesn't like it if you don't set them all at once
-        #         read.tags = [('PG',batch[0].opt('PG')),('AS',2147483649),('NH',0),("IH",1),("HI",1),('CS',batch[0].opt('CS')),('CQ',batch[0].opt('CQ'))]
-        #     else:
-        #         read.tags = [('PG',batch[0].opt('PG')),('AS',2147483649),('NH',0),("IH",1),("HI",1),]
-        #
-        #     outfile.write(read)
+
+        return out
+
+
+def _convertregion_header(bamfile, chrom_sizes, validateonly):
+    header = bamfile.header
+
+    if validateonly:
+        return header
+
+    if not chrom_sizes:
+        ValueError("Missing chrom_sizes file!")
+
+    header['SQ'] = []
+
+    with open(chrom_sizes) as f:
+        for line in f:
+            if line[0] != '#':
+                cols = line.strip().split('\t')
+                header['SQ'].append({'LN': int(cols[1]), 'SN': cols[0]})
+
+    return header
+
+
+def _convert_batches(converter, batches, outfile):
+    'Converts the batches of reads and writes them to outfile (in input order)'
+    for batch in batches:
+        for read in converter.convert(batch):
+            outfile.write(read)
+
+
+def _convertregion_worker(args):
+    'Converts a range of reads into sorted temporary runs (-sort)'
+    infile, start, end, header, opts, tmpdir, chunksize = args
+
+    bamfile = pysam.Samfile(infile, "rb")
+    result = _convert_runs(bamfile, ngsutils.bam.bam_batch_range(bamfile, start, end), header, opts, tmpdir, chunksize)
+    bamfile.close()
+
+    return result
+
+
+def _convertregion_pool_worker(args):
+    'Converts a range of reads into one temporary BAM file (see: bam_pool_map)'
+    infile, start, end, header, opts, tmpdir, level = args
+    overlap, validateonly, keep_unmapped, sort = opts
+
+    bamfile = pysam.Samfile(infile, "rb")
+    tmpname = ngsutils.bam.bam_tmpname(tmpdir)
+    outfile = ngsutils.bam.bam_open_writer(tmpname, level=level, header=header)
+    converter = RegionConverter(list(bamfile.references), outfile.references, overlap, validateonly, keep_unmapped)
+
+    _convert_batches(converter, ngsutils.bam.bam_batch_range(bamfile, start, end), outfile)
 
     bamfile.close()
     outfile.close()
 
+    return [tmpname], (converter.converted_count, converter.invalid_count, converter.unmapped_count)
+
+
+def _convert_runs(bamfile, batches, header, opts, tmpdir, chunksize):
+    'Converts the batches of reads into (sorted) temporary runs'
+    overlap, validateonly, keep_unmapped, sort = opts
+
+    outreferences = [sq['SN'] for sq in header['SQ']]
+    converter = RegionConverter(list(bamfile.references), outreferences, overlap, validateonly, keep_unmapped)
+
+    runs = []
+    buf = []
+
+    for batch in batches:
+        buf.extend(converter.convert(batch))
+
+        if sort and len(buf) >= chunksize:
+            runs.append(ngsutils.bam.bam_write_sorted_run(buf, header, tmpdir))
+            buf = []
+
+    if buf or not runs:
+        runs.append(ngsutils.bam.bam_write_sorted_run(buf, header, tmpdir, key=ngsutils.bam.read_coord_key if sort else None))
+
+    return runs, converter.converted_count, converter.invalid_count, converter.unmapped_count
+
+
+def bam_convertregion(infile, outfname, chrom_sizes=None, overlap=4, validateonly=False, keep_unmapped=False, quiet=False, procs=1, sort=True, tmpdir=None, chunksize=1000000, threads=1, level=None, batch_size=20000, max_files=64):
+    '''
+    If procs > 1, the input file is split into ranges of read names that are
+    converted in separate processes (see: bam_batch_offsets). Without sort,
+    each range has about batch_size reads, and the converted ranges are
+    copied to the output in order (see: bam_pool_map). If sort is set, each
+    range has about chunksize reads, and each process writes sorted temporary
+    runs (of at most chunksize reads) that are then merged into a coordinate
+    sorted output file (at most max_files runs are opened at once).
+
+    infile and outfname can be '-' for stdin/stdout (stdin is converted in
+    one process).
+    '''
+    bamfile = ngsutils.bam.bam_open(infile)
+    header = _convertregion_header(bamfile, chrom_sizes, validateonly)
+    tmpname = outfname if outfname == '-' else '%s.tmp' % outfname
+
+    if infile == '-':
+        procs = 1
+
+    if procs < 2 and not sort:
+        outfile = ngsutils.bam.bam_open_writer(tmpname, threads, level, header=header)
+        converter = RegionConverter(list(bamfile.references), outfile.references, overlap, validateonly, keep_unmapped)
+
+        _convert_batches(converter, ngsutils.bam.bam_batch_reads(bamfile), outfile)
+
+        bamfile.close()
+        outfile.close()
+
+        converted_count = converter.converted_count
+        invalid_count = converter.invalid_count
+        unmapped_count = converter.unmapped_count
+
+    elif not sort:
+        # procs > 1: the ranges are found as the workers run, and the
+        # temporary files are copied to the output by compressed block
+        bamfile.close()
+
+        if tmpdir is None:
+            tmpdir = os.path.dirname(os.path.abspath(outfname))
+
+        opts = (overlap, validateonly, keep_unmapped, sort)
+        if level is None and outfname == '-':
+            level = 0
+
+        tasks = ((infile, start, end, header, opts, tmpdir, level) for start, end in ngsutils.bam.bam_batch_offsets(infile, batch_size, procs))
+        results = ngsutils.bam.bam_pool_map(_convertregion_pool_worker, tasks, [tmpname], procs, [level])
+
+        converted_count = sum([x[0] for x in results])
+        invalid_count = sum([x[1] for x in results])
+        unmapped_count = sum([x[2] for x in results])
+
+    else:
+        if tmpdir is None:
+            tmpdir = os.path.dirname(os.path.abspath(outfname))
+
+        opts = (overlap, validateonly, keep_unmapped, sort)
+
+        if infile == '-':
+            # stdin can't be re-opened (or split)
+            results = [_convert_runs(bamfile, ngsutils.bam.bam_batch_reads(bamfile), header, opts, tmpdir, chunksize)]
+            bamfile.close()
+        else:
+            if procs > 1:
+                # each range is about one sorted run
+                ranges = ngsutils.bam.bam_batch_offsets(infile, chunksize, procs)
+            else:
+                ranges = [(bamfile.tell(), None)]
+
+            bamfile.close()
+
+            tasks = ((infile, start, end, header, opts, tmpdir, chunksize) for start, end in ranges)
+
+            if procs > 1:
+                pool = multiprocessing.Pool(procs)
+                results = list(pool.imap(_convertregion_worker, tasks))
+                pool.close()
+                pool.join()
+            else:
+                results = [_convertregion_worker(task) for task in tasks]
+
+        runs = []
+        converted_count = 0
+        invalid_count = 0
+        unmapped_count = 0
+
+        for r_runs, r_converted, r_invalid, r_unmapped in results:
+            runs.extend(r_runs)
+            converted_count += r_converted
+            invalid_count += r_invalid
+            unmapped_count += r_unmapped
+
+        if 'HD' in header:
+            header['HD']['SO'] = 'coordinate'
+        else:
+            header['HD'] = {'VN': '1.0', 'SO': 'coordinate'}
+
+        ngsutils.bam.bam_merge_run_groups(runs, tmpdir=tmpdir, max_files=max_files)
+
+        outfile = ngsutils.bam.bam_open_writer(tmpname, threads, level, header=header)
+        for read in ngsutils.bam.bam_merge_sorted_runs(runs):
+            outfile.write(read)
+        outfile.close()
+
+        for run in runs:
+            os.unlink(run)
+
     if not quiet:
         sys.stderr.write("converted:%d\ninvalid:%d\nunmapped:%d\n" % (converted_count, invalid_count, unmapped_count))
 
-    os.rename('%s.tmp' % outfname, outfname)
+    if tmpname != outfname:
+        os.rename(tmpname, outfname)
 
 
 if __name__ == '__main__':
@@ -200,6 +381,12 @@ if __name__ == '__main__':
     validateonly = False
     force = False
     keep_unmapped = False
+    sort = True
+    procs = 1
+    tmpdir = None
+    chunksize = 1000000
+    threads = 1
+    level = None
 
     last = None
 
@@ -211,13 +398,30 @@ if __name__ == '__main__':
             if overlap < 0:
                 overlap = 0
             last = None
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif last == '-T':
+            tmpdir = arg
+            last = None
+        elif last == '-cs':
+            chunksize = int(arg)
+            last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
         elif arg == '-f':
             force = True
         elif arg == '-validateonly':
             validateonly = True
         elif arg == '-unmapped':
             keep_unmapped = True
-        elif arg in ['-overlap']:
+        elif arg == '-nosort':
+            sort = False
+        elif arg in ['-overlap', '-p', '-T', '-cs', '-threads', '-level']:
             last = arg
         elif not infile:
             infile = arg
@@ -235,4 +439,4 @@ if __name__ == '__main__':
         sys.exit(1)
 
     else:
-        bam_convertregion(infile, outfile, chrom_sizes, overlap, validateonly, keep_unmapped)
+        bam_convertregion(infile, outfile, chrom_sizes, overlap, validateonly, keep_unmapped, procs=procs, sort=sort, tmpdir=tmpdir, chunksize=chunksize, threads=threads, level=level)
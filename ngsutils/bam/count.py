@@ -101,6 +101,7 @@ import os
 
 import count
 from ngsutils.bam import bam_open
+from ngsutils.support.nameset import NameSet, read_names
 
 
 def usage(msg=None):
@@ -204,19 +205,13 @@ if __name__ == '__main__':
             multiple = arg
             last = None
         elif last == '-whitelist':
-            whitelist = []
             if not os.path.exists(arg):
                 usage('Whitelist file does not exist: %s' % arg)
-            with open(arg) as f:
-                for line in f:
-                    whitelist.append(line.strip())
+            whitelist = NameSet(read_names(arg))
         elif last == '-blacklist':
-            blacklist = []
             if not os.path.exists(arg):
                 usage('Blacklist file does not exist: %s' % arg)
-            with open(arg) as f:
-                for line in f:
-                    blacklist.append(line.strip())
+            blacklist = NameSet(read_names(arg))
         elif arg in ['-%s' % x for x in count.models]:
             model = arg[1:]
             last = arg
@@ -1,4 +1,5 @@
 import ngsutils.support.stats
+from ngsutils.support.nameset import NameSet
 import sys
 import tempfile
 import ngsutils
@@ -484,7 +485,7 @@ def _find_mapped_count(bam, whitelist=None, blacklist=None, quiet=False):
         sys.stderr.write('Finding number of mapped reads\n')
     bam.seek(0)
     mapped_count = 0
-    multinames = set()
+    multinames = NameSet()
     for read in bam.fetch():
         if blacklist and read.qname in blacklist:
             continue
@@ -11,7 +11,8 @@ reference, the mapped position, and the CIGAR alignment string for a read.
 
 import sys
 import os
-from ngsutils.bam import bam_iter, cigar_tostr, bam_open
+from ngsutils.bam import bam_iter, cigar_tostr, bam_open, bam_exists
+from ngsutils.support.nameset import NameSet, read_names
 
 
 def bam_export(bam, mapped=True, unmapped=True, whitelist=None, blacklist=None, fields=None, out=sys.stdout, quiet=False):
@@ -100,6 +101,8 @@ def usage():
     print """\
 Usage: bamutils export {opts} {fields} bamfile
 
+Use '-' to read from stdin.
+
 Options:
   -mapped              Output only mapped reads
   -unmapped            Output only unmapped reads
@@ -145,15 +148,13 @@ if __name__ == "__main__":
             if not os.path.exists(arg):
                 print "Error: %s missing!" % arg
                 usage()
-            with open(arg) as f:
-                wl = [x.strip() for x in f]
+            wl = NameSet(read_names(arg))
             last = None
         elif last == '-blacklist':
             if not os.path.exists(arg):
                 print "Error: %s missing!" % arg
                 usage()
-            with open(arg) as f:
-                bl = [x.strip() for x in f]
+            bl = NameSet(read_names(arg))
             last = None
         elif arg in ['-blacklist', '-whitelist']:
             last = arg
@@ -163,7 +164,7 @@ if __name__ == "__main__":
             unmapped = True
         elif arg == '-mapped':
             mapped = True
-        elif os.path.exists(arg):
+        elif bam_exists(arg):
             fname = arg
         elif arg[0] == '-':
             fields.append(arg)
@@ -10,8 +10,7 @@ manner, so they may represent novel or known transcripts. This is also helpful
 for peak-finding in ChIP-seq experiments.
 '''
 import sys
-import os
-from ngsutils.bam import bam_pileup_iter, bam_open
+from ngsutils.bam import bam_pileup_iter, bam_open, bam_exists
 
 import pysam
 
@@ -120,6 +119,8 @@ def usage():
     print """\
 Usage: bamutils expressed {options} bamfile
 
+Use '-' to read from stdin.
+
 Options:
 -ns             Ignore strandedness when creating regions
                 (default: false)
@@ -159,7 +160,7 @@ if __name__ == "__main__":
             nostrand = True
         elif arg in ['-dist', '-mincount']:
             last = arg
-        elif not fname and os.path.exists(arg):
+        elif not fname and bam_exists(arg):
             fname = arg
         else:
             print 'Unknown argument: %s' % arg
@@ -23,7 +23,7 @@ import sys
 from eta import ETA
 import pysam
 
-from ngsutils.bam import read_alignment_fragments_gen
+from ngsutils.bam import read_alignment_fragments_gen, RawBamReader, RawBamWriter
 from ngsutils.bed import BedFile
 
 
@@ -34,6 +34,7 @@ Usage: bamutils extract {opts} in.bam out.bam regions.bed
 
 Options:
   -ns    Ignore strandedness of reads and regions
+  -raw   Copy the reads to the output without decoding and re-encoding them
 """
     sys.exit(1)
 
@@ -86,12 +87,15 @@ if __name__ == '__main__':
     outfile = None
     bedfile = None
     nostrand = False
+    raw = False
 
     for arg in sys.argv[1:]:
         if arg == '-h':
             usage()
         elif arg == '-ns':
             nostrand = True
+        elif arg == '-raw':
+            raw = True
         elif not infile and os.path.exists(arg):
             infile = arg
         elif not outfile:
@@ -105,8 +109,12 @@ if __name__ == '__main__':
     if not infile or not outfile or not bedfile:
         usage()
     else:
-        inbam = pysam.Samfile(infile, "rb")
-        outbam = pysam.Samfile(outfile, "wb", template=inbam)
+        if raw:
+            inbam = RawBamReader(infile)
+            outbam = RawBamWriter(outfile, inbam.header_data)
+        else:
+            inbam = pysam.Samfile(infile, "rb")
+            outbam = pysam.Samfile(outfile, "wb", template=inbam)
 
         bam_extract(inbam, outbam, bedfile, nostrand)
 
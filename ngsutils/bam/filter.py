@@ -39,7 +39,9 @@ Currently, the available filters are:
                                Variations that are found in the dbSNP list are
                                not counted as mismatches. The dbSNP list is a
                                Tabix-indexed dump of dbSNP (from UCSC Genome
-                               Browser). Indels in dbSNP are also counted.
+                               Browser), or a binary index of one (see:
+                               ngsutils dbsnpindex). Indels in dbSNP are also
+                               counted.
                                Adds a 'ZS:i' tag with the number of found SNPs
                                in the read.
                                (requires NM and MD tags)
@@ -74,17 +76,21 @@ Currently, the available filters are:
                                from the given BED file. If 'nostrand' is given,
                                strand information from the BED file is ignored.
 
-                               Note: If this is a large dataset, use
-                               "bamutils extract" instead.
-
     -includeref refname        Exclude reads NOT mapped to a reference
+
+                               Note: If the BAM file is indexed, only the
+                               included regions/references are read (unless
+                               -failed is used).
     -excluderef refname        Exclude reads mapped to a particular reference
                                (e.g. chrM, or _dup chromosomes)
 
-    -whitelist fname           Remove reads that aren't on this list (by name)
-    -blacklist fname           Remove reads that are on this list (by name)
+    -whitelist fname {exact}   Remove reads that aren't on this list (by name)
+    -blacklist fname {exact}   Remove reads that are on this list (by name)
                                  These lists can be whitespace-delimited with
                                  the read name as the first column.
+                                 Large lists (>1M names) are stored as
+                                 64-bit hashes of the names. If 'exact' is
+                                 given, the names are also checked.
     -maximum_mismatch_ratio val
                                Filter by maximum mismatch ratio (fraction of length)
 
@@ -110,21 +116,56 @@ Common tags to filter by:
 
 import os
 import sys
+import time
+import heapq
+import hashlib
+import bisect
+import tempfile
+import multiprocessing
 import pysam
-from ngsutils.bam import bam_iter
+from ngsutils.bam import bam_iter, bam_open, bam_open_writer, bam_exists, bam_file_size, RawBamReader, RawBamWriter, BamIndex
 from ngsutils.support.dbsnp import DBSNP
+from ngsutils.support.refcache import CachedFastaFile
 from ngsutils.bam import read_calc_mismatches, read_calc_mismatches_ref, read_calc_mismatches_gen, read_calc_variations
 from ngsutils.bed import BedFile
+from ngsutils.support.nameset import NameSet, read_names
 
 
 def usage():
     print __doc__
     print """
 Usage: bamutils filter in.bam out.bam {-failed out.txt} criteria...
+       bamutils filter -explain in.bam criteria...
+
+Use '-' to read from stdin (SAM or BAM) or write to stdout (uncompressed BAM,
+unless -level is given). The read counts are then written to stderr.
 
 Options:
   -failed fname    A text file containing the read names of all reads
                    that were removed with filtering
+  -threads N       Use N threads to compress the output BAM file
+                   [default: 1]
+  -level N         Compression level for the output BAM file (0-9). Use 0
+                   for uncompressed output that will be piped to another
+                   program. [default: 6]
+  -p N             Filter each reference in a separate process, using N
+                   processes at once (requires an indexed BAM file)
+  -v               Verbose output (shows the time used by each criterion)
+  -explain         Don't filter anything. Instead, check each criterion on a
+                   sample of reads from across the file (spread out using
+                   the BAM index, or the first 10000 reads without one) and
+                   show how many reads would pass, the estimated output
+                   size and run time, and the fastest order for the
+                   criteria. The output file isn't needed.
+  -raw             Copy the reads that pass to the output without decoding
+                   and re-encoding them. Long runs of reads that pass (for
+                   example, -mapped on a sorted file) are copied as
+                   compressed blocks, without compressing them again. (If
+                   most of the reads that pass are next to reads that
+                   don't, this is a little slower than decoding the reads.)
+                   This is only used if all of the criteria can be checked on
+                   raw reads (all but -uniq and the -mismatch_ref/dbsnp
+                   criteria). Otherwise this option is ignored.
 
 Example:
 bamutils filter filename.bam output.bam -mapped -gte AS:i 1000
@@ -136,6 +177,14 @@ value less than 1000.
 
 
 class Unique(object):
+    '''
+    Removes reads with the same sequence as an earlier read at the same
+    position. Only the MD5 digest of each sequence is kept (16 bytes, so
+    unlike hash(), different sequences won't match by chance).
+    '''
+    # depends on the reads that were seen before
+    stateful = True
+
     def __init__(self, length=None):
         if length:
             self.length = int(length)
@@ -161,10 +210,11 @@ class Unique(object):
         if self.length:
             seq = seq[:self.length]
 
-        if seq in self.pos_reads:
+        seq_hash = hashlib.md5(seq).digest()
+        if seq_hash in self.pos_reads:
             return False
 
-        self.pos_reads.add(seq)
+        self.pos_reads.add(seq_hash)
         return True
 
     def close(self):
@@ -172,6 +222,9 @@ class Unique(object):
 
 
 class UniqueStart(object):
+    stateful = True
+    raw = True
+
     def __init__(self):
         self.last_tid = None
         self.last_fwd_pos = -1
@@ -184,6 +237,8 @@ class UniqueStart(object):
         if self.last_tid is None or self.last_tid != read.tid:
             self.last_tid = read.tid
             self.rev_pos = set()
+            self.rev_pos_bins = {}  # the same positions, binned (pos >> 14) to find the old ones
+            self.rev_pos_minbin = 0
             self.last_fwd_pos = -1
             self.last_rev_pos = -1
 
@@ -199,16 +254,17 @@ class UniqueStart(object):
             # and memory
             if read.pos > (self.last_rev_pos + 100000):
                 self.last_rev_pos = start_pos
-                del_list = []
-                for k in self.rev_pos:
-                    if k < read.pos:
-                        del_list.append(k)
-
-                for k in del_list:
-                    self.rev_pos.remove(k)
+                self._prune(read.pos)
 
             if not start_pos in self.rev_pos:
                 self.rev_pos.add(start_pos)
+                # (anything below the first bin is kept in the first bin,
+                # which is checked position by position)
+                posbin = max(start_pos >> 14, self.rev_pos_minbin)
+                if posbin in self.rev_pos_bins:
+                    self.rev_pos_bins[posbin].append(start_pos)
+                else:
+                    self.rev_pos_bins[posbin] = [start_pos]
                 return True
             return False
         else:
@@ -222,17 +278,34 @@ class UniqueStart(object):
         #     return True
         # return False
 
+    def _prune(self, pos):
+        'Removes the reverse read positions < pos'
+        minbin = pos >> 14
+        if minbin > self.rev_pos_minbin:
+            for posbin in xrange(self.rev_pos_minbin, minbin):
+                if posbin in self.rev_pos_bins:
+                    self.rev_pos.difference_update(self.rev_pos_bins.pop(posbin))
+            self.rev_pos_minbin = minbin
+
+        if minbin in self.rev_pos_bins:
+            keep = []
+            for k in self.rev_pos_bins[minbin]:
+                if k < pos:
+                    self.rev_pos.remove(k)
+                else:
+                    keep.append(k)
+            self.rev_pos_bins[minbin] = keep
+
     def close(self):
         pass
 
 
 class Blacklist(object):
-    def __init__(self, fname):
+    raw = True
+
+    def __init__(self, fname, exact=None):
         self.fname = fname
-        self.notallowed = set()
-        with open(fname) as f:
-            for line in f:
-                self.notallowed.add(line.strip().split()[0])
+        self.notallowed = NameSet(read_names(fname), exact=exact == 'exact')
 
     def filter(self, bam, read):
         return read.qname not in self.notallowed
@@ -245,12 +318,11 @@ class Blacklist(object):
 
 
 class Whitelist(object):
-    def __init__(self, fname):
+    raw = True
+
+    def __init__(self, fname, exact=None):
         self.fname = fname
-        self.allowed = set()
-        with open(fname) as f:
-            for line in f:
-                self.allowed.add(line.strip().split()[0])
+        self.allowed = NameSet(read_names(fname), exact=exact == 'exact')
 
     def filter(self, bam, read):
         return read.qname in self.allowed
@@ -265,13 +337,14 @@ class Whitelist(object):
 class IncludeRegion(object):
     _excludes = []
     _last = None
+    raw = True
 
     def __init__(self, region):
         IncludeRegion._excludes.append(ExcludeRegion(region))
         # self.excl = ExcludeRegion(region)
 
     def filter(self, bam, read):
-        if read == IncludeRegion._last:
+        if read is IncludeRegion._last:
             return True
 
         IncludeRegion._last = read
@@ -283,27 +356,41 @@ class IncludeRegion(object):
 
         # return not self.excl.filter(bam,read)
     def __repr__(self):
-        return 'Including: %s' % (self.excl.region)
+        return 'Including: %s' % (', '.join([excl.region for excl in IncludeRegion._excludes]))
+
+    def regions(self):
+        'The intervals (chrom, start, end) that can contain reads that pass'
+        return [(excl.chrom, max(0, excl.start - 1), excl.end + 1) for excl in IncludeRegion._excludes]
 
     def close(self):
         pass
 
 
 class IncludeBED(object):
+    raw = True
+
     def __init__(self, fname, nostrand=None):
         self.excl = ExcludeBED(fname, nostrand)
 
     def filter(self, bam, read):
+        if read.is_unmapped:
+            return False
         return not self.excl.filter(bam, read)
 
     def __repr__(self):
         return 'Including from BED: %s%s' % (self.excl.fname, ' nostrand' if self.excl.nostrand else '')
 
+    def regions(self):
+        'The intervals (chrom, start, end) that can contain reads that pass'
+        return [(region.chrom, max(0, region.start - 1), region.end + 1) for region in self.excl.bed]
+
     def close(self):
         pass
 
 
 class ExcludeRegion(object):
+    raw = True
+
     def __init__(self, region):
         self.region = region
         spl = region.split(':')
@@ -329,6 +416,8 @@ class ExcludeRegion(object):
 
 
 class ExcludeRef(object):
+    raw = True
+
     def __init__(self, ref):
         self.ref = ref
 
@@ -345,6 +434,8 @@ class ExcludeRef(object):
         pass
 
 class IncludeRef(object):
+    raw = True
+
     def __init__(self, ref):
         self.ref = ref
 
@@ -357,13 +448,26 @@ class IncludeRef(object):
     def __repr__(self):
         return 'Including: %s' % (self.ref)
 
+    def regions(self):
+        'The intervals (chrom, start, end) that can contain reads that pass'
+        return [(self.ref, 0, None)]
+
     def close(self):
         pass
 
 
 class ExcludeBED(object):
+    '''
+    Removes reads that overlap any of the regions in a BED file.
+
+    If the reads are sorted by position, the BED regions are swept along with
+    the reads: the regions are kept sorted by start for each chrom, and the
+    regions that could still overlap a read are kept in a heap (by end). If the
+    reads turn out not to be sorted, the BedFile bins are used instead.
+    '''
+    raw = True
+
     def __init__(self, fname, nostrand=None):
-        self.regions = {}  # store BED regions as keyed bins (chrom, bin)
         self.fname = fname
         if nostrand == 'nostrand':
             self.nostrand = True
@@ -371,29 +475,61 @@ class ExcludeBED(object):
             self.nostrand = False
 
         self.bed = BedFile(fname)
-        # with open(fname) as f:
-        #     for line in f:
-        #         if not line:
-        #             continue
-        #         if line[0] == '#':
-        #             continue
-        #         cols = line.strip().split('\t')
-
-        #         chrom = cols[0]
-        #         start = int(cols[1])
-        #         end = int(cols[2])
-        #         if self.nostrand:
-        #             strand = '?'
-        #         else:
-        #             strand = cols[5]
-
-        #         startbin = start / 100000
-        #         endbin = end / 100000
-
-        #         for bin in xrange(startbin, endbin + 1):
-        #             if not (chrom, bin) in self.regions:
-        #                 self.regions[(chrom, bin)] = []
-        #         self.regions[(chrom, bin)].append((start, end, strand))
+
+        self._regions = {}  # chrom => [(start, end, strand), ...] sorted
+        for region in self.bed:
+            if not region.chrom in self._regions:
+                self._regions[region.chrom] = []
+            self._regions[region.chrom].append((region.start, region.end, region.strand))
+
+        for chrom in self._regions:
+            self._regions[chrom].sort()
+
+        self._sorted = True
+        self._seen_tids = set()
+        self._last_tid = None
+        self._last_pos = -1
+        self._chrom_regions = []
+        self._next = 0
+        self._active = []
+
+    def _sweep(self, bam, read, strand):
+        '''
+        Returns True if the read overlaps a region, False if not, or None if
+        the reads aren't sorted.
+        '''
+        if read.tid != self._last_tid:
+            if read.tid in self._seen_tids:
+                return None
+
+            self._seen_tids.add(read.tid)
+            self._last_tid = read.tid
+            self._chrom_regions = self._regions.get(bam.getrname(read.tid), [])
+            self._next = 0
+            self._active = []
+
+        elif read.pos < self._last_pos:
+            return None
+
+        self._last_pos = read.pos
+        aend = read.aend
+
+        # add the regions that start before the end of this read
+        regions = self._chrom_regions
+        while self._next < len(regions) and regions[self._next][0] <= aend:
+            start, end, region_strand = regions[self._next]
+            heapq.heappush(self._active, (end, start, region_strand))
+            self._next += 1
+
+        # and drop the ones that end before it (the next reads start later)
+        while self._active and self._active[0][0] < read.pos:
+            heapq.heappop(self._active)
+
+        for end, start, region_strand in self._active:
+            if start <= aend and (not strand or strand == region_strand):
+                return True
+
+        return False
 
     def filter(self, bam, read):
         if not read.is_unmapped:
@@ -404,29 +540,17 @@ class ExcludeBED(object):
             else:
                 strand = '+'
 
+            if self._sorted:
+                found = self._sweep(bam, read, strand)
+                if found is not None:
+                    return not found
+                self._sorted = False
+
             for region in self.bed.fetch(bam.getrname(read.tid), read.pos, read.aend, strand):
                 # region found, exclude read
                 return False
             return True
 
-        #     bin = read.pos / 100000
-        #     ref = bam.getrname(read.tid)
-
-        #     if not (ref, bin) in self.regions:
-        #         return True
-
-        #     for start, end, strand in self.regions[(ref, bin)]:
-        #         if not self.nostrand:
-        #             if strand == '+' and read.is_reverse:
-        #                 continue
-        #             if strand == '-' and not read.is_reverse:
-        #                 continue
-        #         if start <= read.pos <= end:
-        #             return False
-        #         if start <= read.aend <= end:
-        #             return False
-        # return True
-
     def __repr__(self):
         return 'Excluding from BED: %s%s' % (self.fname, ' nostrand' if self.nostrand else '')
 
@@ -435,6 +559,8 @@ class ExcludeBED(object):
 
 
 class Mismatch(object):
+    raw = True
+
     def __init__(self, num):
         self.num = int(num)
 
@@ -462,7 +588,7 @@ class MismatchRef(object):
         if not os.path.exists('%s.fai' % refname):
             pysam.faidx(refname)
 
-        self.ref = pysam.Fastafile(refname)
+        self.ref = CachedFastaFile(refname)
 
     def filter(self, bam, read):
         if read.is_unmapped:
@@ -536,7 +662,7 @@ class MismatchRefDbSNP(object):
         if not os.path.exists('%s.fai' % refname):
             pysam.faidx(refname)
 
-        self.ref = pysam.Fastafile(refname)
+        self.ref = CachedFastaFile(refname)
 
     def filter(self, bam, read):
         if read.is_unmapped:
@@ -570,6 +696,8 @@ class MismatchRefDbSNP(object):
 
 
 class Mapped(object):
+    raw = True
+
     def __init__(self):
         pass
 
@@ -588,6 +716,8 @@ class Mapped(object):
 
 
 class Unmapped(object):
+    raw = True
+
     def __init__(self):
         pass
 
@@ -606,6 +736,8 @@ class Unmapped(object):
 
 
 class ProperPair(object):
+    raw = True
+
     def __init__(self):
         pass
 
@@ -629,6 +761,8 @@ class ProperPair(object):
 
 
 class NoProperPair(object):
+    raw = True
+
     def __init__(self):
         self.proper = ProperPair()
         pass
@@ -644,6 +778,8 @@ class NoProperPair(object):
 
 
 class MaskFlag(object):
+    raw = True
+
     def __init__(self, value):
         if type(value) == type(1):
             self.flag = value
@@ -664,6 +800,8 @@ class MaskFlag(object):
 
 
 class SecondaryFlag(object):
+    raw = True
+
     def __repr__(self):
         return "no 0x100 (secondary) flag"
 
@@ -675,6 +813,8 @@ class SecondaryFlag(object):
 
 
 class ReadMinLength(object):
+    raw = True
+
     def __init__(self, minval):
         self.minval = int(minval)
 
@@ -682,13 +822,15 @@ class ReadMinLength(object):
         return "read length min: %s" % self.minval
 
     def filter(self, bam, read):
-        return len(read.seq) >= self.minval
+        return read.rlen >= self.minval
 
     def close(self):
         pass
 
 
 class ReadMaxLength(object):
+    raw = True
+
     def __init__(self, val):
         self.val = int(val)
 
@@ -696,27 +838,31 @@ class ReadMaxLength(object):
         return "read length max: %s" % self.val
 
     def filter(self, bam, read):
-        return len(read.seq) <= self.val
+        return read.rlen <= self.val
 
     def close(self):
         pass
 
 
 class MaximumMismatchRatio(object):
+    raw = True
+
     def __init__(self, ratio):
         self.ratio = float(ratio)
 
     def __repr__(self):
-        return "maximum mismatch ratio: %s" % self.val
+        return "maximum mismatch ratio: %s" % self.ratio
 
     def filter(self, bam, read):
-        return read_calc_mismatches(read) <= self.ratio*len(read.seq)
+        return read_calc_mismatches(read) <= self.ratio*read.rlen
 
     def close(self):
         pass
 
 
 class QCFailFlag(object):
+    raw = True
+
     def __repr__(self):
         return "no 0x200 (qcfail) flag"
 
@@ -728,6 +874,8 @@ class QCFailFlag(object):
 
 
 class PCRDupFlag(object):
+    raw = True
+
     def __repr__(self):
         return "no 0x400 (pcrdup) flag"
 
@@ -739,6 +887,8 @@ class PCRDupFlag(object):
 
 
 class _TagCompare(object):
+    raw = True
+
     def __init__(self, tag, value):
         self.args = '%s %s' % (tag, value)
 
@@ -769,11 +919,10 @@ class _TagCompare(object):
         if self.tag == 'MAPQ':
             return read.mapq
 
-        for name, value in read.tags:
-            if name == self.tag:
-                return value
-
-        return None
+        try:
+            return read.opt(self.tag)
+        except KeyError:
+            return None
 
     def __repr__(self):
         return "%s %s %s" % (self.tag, self.__class__.op, self.value)
@@ -860,57 +1009,741 @@ _criteria = {
 }
 
 
-def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
+class FilterPlan(object):
+    '''
+    Checks each read against a list of criteria, stopping at the first one
+    that fails.
+
+    For the first 'warmup' reads, the criteria are checked in the given order
+    and the time and rejection rate for each criterion is measured. After
+    that, the criteria are reordered to check the cheapest / most selective
+    ones first (ordered by: time per call / fraction of reads rejected).
+
+    Criteria that depend on which reads they see (stateful, such as Unique)
+    are never moved, and other criteria aren't moved across them.
+    '''
+    def __init__(self, criteria, adaptive=True, warmup=10000, timing=False):
+        self.criteria = list(criteria)
+        self.adaptive = adaptive
+        self.warmup = warmup
+        self.timing = timing
+
+        self.calls = [0] * len(criteria)
+        self.rejected = [0] * len(criteria)
+        self.elapsed = [0.0] * len(criteria)
+
+        self._count = 0
+        self._timed = True
+        self._order = range(len(criteria))
+
+    def filter(self, bam, read):
+        '''
+        Returns the criterion that rejected the read (or None if it passed)
+        '''
+        if self._timed:
+            self._count += 1
+            for i in self._order:
+                criterion = self.criteria[i]
+                start = time.time()
+                passed = criterion.filter(bam, read)
+                self.elapsed[i] += time.time() - start
+                self.calls[i] += 1
+                if not passed:
+                    self.rejected[i] += 1
+                    break
+            else:
+                criterion = None
+
+            if self._count == self.warmup:
+                if self.adaptive:
+                    self.reorder()
+                if not self.timing:
+                    self._timed = False
+                    self._ordered = [self.criteria[i] for i in self._order]
+
+            return criterion
+
+        for criterion in self._ordered:
+            if not criterion.filter(bam, read):
+                return criterion
+        return None
+
+    def _rank(self, i):
+        if not self.calls[i] or not self.rejected[i]:
+            return (1, self.elapsed[i] / max(self.calls[i], 1))
+        return (0, self.elapsed[i] / self.rejected[i])
+
+    def reorder(self):
+        order = []
+        run = []
+        for i in range(len(self.criteria)):
+            if getattr(self.criteria[i], 'stateful', False):
+                order.extend(sorted(run, key=self._rank))
+                order.append(i)
+                run = []
+            else:
+                run.append(i)
+
+        order.extend(sorted(run, key=self._rank))
+        self._order = order
+
+    def summary(self):
+        'Returns a list of (criterion, calls, rejected, secs) in the order used'
+        return [(self.criteria[i], self.calls[i], self.rejected[i], self.elapsed[i]) for i in self._order]
+
+
+def build_criteria(specs):
+    '''
+    Builds criteria objects from a list of (name, args) specs, where name is
+    the command-line name of the criterion (without the '-').
+
+    >>> build_criteria([('mapped', []), ('mask', ['0x10'])])
+    [is mapped, Doesn't match flag: 16]
+    '''
+    return [_criteria[name](*args) for name, args in specs]
+
+
+def _fetch_intervals(bamfile, criteria):
+    '''
+    If the criteria only allow reads from certain references or regions
+    (-include, -includeref, -includebed), returns the merged intervals
+    (tid, start, end) that need to be read, in file order. This is taken from
+    the criterion with the smallest total size. Otherwise returns None.
+    '''
+    best = None
+    best_size = 0
+
+    for criterion in criteria:
+        if not hasattr(criterion, 'regions'):
+            continue
+
+        intervals = []
+        for chrom, start, end in criterion.regions():
+            tid = bamfile.gettid(chrom)
+            if tid < 0:
+                continue
+            if end is None or end > bamfile.lengths[tid]:
+                end = bamfile.lengths[tid]
+            if start < end:
+                intervals.append((tid, start, end))
+
+        intervals.sort()
+        merged = []
+        for tid, start, end in intervals:
+            if merged and merged[-1][0] == tid and start <= merged[-1][2]:
+                if end > merged[-1][2]:
+                    merged[-1] = (tid, merged[-1][1], end)
+            else:
+                merged.append((tid, start, end))
+
+        size = sum([end - start for tid, start, end in merged])
+        if best is None or size < best_size:
+            best = merged
+            best_size = size
+
+    return best
+
+
+def _fetch_reads(bamfile, intervals):
+    '''
+    Yields the reads in the given (merged) intervals, in file order. Reads that
+    span more than one interval are only returned once.
+    '''
+    last_tid = None
+    last_end = 0
+    for tid, start, end in intervals:
+        for read in bamfile.fetch(bamfile.getrname(tid), start, end):
+            # this read also overlaps the previous interval
+            if tid == last_tid and read.pos < last_end:
+                continue
+            yield read
+
+        last_tid = tid
+        last_end = end
+
+
+def _filter_reads(bamfile, reads, outfile, plan, failed_out=None):
+    'Writes the reads that pass to outfile. Returns (passed, failed)'
+    passed = 0
+    failed = 0
+
+    for read in reads:
+        criterion = plan.filter(bamfile, read)
+        if criterion is not None:
+            failed += 1
+            if failed_out:
+                failed_out.write('%s\t%s\n' % (read.qname, criterion))
+            #outfile.write(read_to_unmapped(read))
+        else:
+            passed += 1
+            outfile.write(read)
+
+    return passed, failed
+
+
+# Runs of passing reads at least this long (uncompressed) are copied as
+# compressed blocks (a run has to cover a whole block to save anything)
+_RUN_COPY_SIZE = 3 * 65536
+
+
+def _filter_raw_reads(bamfile, reads, outfile, plan, failed_out=None, end=None):
+    '''
+    The same as _filter_reads, but for the reads from a RawBamReader in file
+    order (not from fetch), up to the virtual offset 'end' (None for the end
+    of the file). Runs of reads that all pass are copied from the input as
+    compressed blocks (RawBamWriter.copy_range), so they don't need to be
+    compressed again. Returns (passed, failed)
+    '''
+    passed = 0
+    failed = 0
+
+    run = []  # the reads in the current run (None once it is long enough to copy)
+    run_start = None
+    run_size = 0
+
+    for read in reads:
+        criterion = plan.filter(bamfile, read)
+        if criterion is None:
+            passed += 1
+            if not run_size:
+                run_start = bamfile.tell_read()
+            run_size += len(read.data)
+            if run is not None:
+                run.append(read)
+                if run_size >= _RUN_COPY_SIZE:
+                    run = None
+            continue
+
+        failed += 1
+        if failed_out:
+            failed_out.write('%s\t%s\n' % (read.qname, criterion))
+
+        if run_size:
+            _write_run(bamfile, outfile, run, run_start, bamfile.tell_read())
+            run = []
+            run_size = 0
+
+    if run_size:
+        _write_run(bamfile, outfile, run, run_start, end)
+
+    return passed, failed
+
+
+def _write_run(bamfile, outfile, run, start, end):
+    if run is None:
+        outfile.copy_range(bamfile.filename, start, end)
+    else:
+        for read in run:
+            outfile.write(read)
+
+
+def _open_filter_files(infile, outfile, criteria, threads, level, raw):
+    if raw and infile != '-' and all([getattr(criterion, 'raw', False) for criterion in criteria]):
+        # None of the criteria need a decoded read (only flags, positions,
+        # names, etc), so the records can be copied to the output as-is.
+        # (stdin could be SAM, so it is always decoded)
+        bamfile = RawBamReader(infile, threads)
+        outfile = RawBamWriter(outfile, bamfile.header_data, threads, level)
+    else:
+        bamfile = bam_open(infile)
+        outfile = bam_open_writer(outfile, threads, level, template=bamfile)
+
+    return bamfile, outfile
+
+
+# The criteria for each worker process (see: _init_filter_worker)
+_worker_criteria = None
+
+
+def _init_filter_worker(specs):
+    '''
+    Builds the criteria once for each worker process, so that the whitelists,
+    BED files, dbSNP, etc. aren't loaded again for every shard.
+    '''
+    global _worker_criteria
+    _worker_criteria = build_criteria(specs)
+
+
+def _shard_reads(bamfile, tids, start):
+    '''
+    Yields the reads starting at the virtual offset 'start' while they are
+    from one of the given references (tids are consecutive, so this stops at
+    the next shard). For the unmapped reads (tid -1), reads to the end.
+    '''
+    tids = set(tids)
+    bamfile.seek(start)
+    for read in bamfile:
+        if read.tid not in tids:
+            break
+        yield read
+
+
+def _filter_shard(args):
+    '''
+    Filters the reads for a group of consecutive references (tids), or the
+    unmapped reads at the end of the file (tid -1), into a temporary BAM file.
+    The reads for the shard are between the virtual offsets 'start' and 'end'.
+    '''
+    infile, tids, start, end, keep_failed, use_index, timing, level, raw, tmpdir = args
+
+    criteria = _worker_criteria
+    fd, tmpname = tempfile.mkstemp(prefix='.tmp', suffix='.bam', dir=tmpdir)
+    os.close(fd)
+    bamfile, outfile = _open_filter_files(infile, tmpname, criteria, 1, level, raw)
+
+    if keep_failed:
+        fd, failedname = tempfile.mkstemp(prefix='.tmp', suffix='.txt', dir=tmpdir)
+        failed_out = os.fdopen(fd, 'w')
+    else:
+        failedname = None
+        failed_out = None
+
+    intervals = None
+    if use_index:
+        intervals = _fetch_intervals(bamfile, criteria)
+
+    if intervals is not None:
+        # only read the allowed regions for these references (none of the
+        # unmapped reads can pass)
+        reads = _fetch_reads(bamfile, [x for x in intervals if x[0] in tids])
+    else:
+        reads = _shard_reads(bamfile, tids, start)
+
+    # Only reorder if there isn't a failed list (see bam_filter)
+    plan = FilterPlan(criteria, adaptive=not keep_failed, timing=timing)
+    if intervals is None and level != 0 and isinstance(bamfile, RawBamReader):
+        passed, failed = _filter_raw_reads(bamfile, reads, outfile, plan, failed_out, end)
+    else:
+        passed, failed = _filter_reads(bamfile, reads, outfile, plan, failed_out)
+
+    bamfile.close()
+    outfile.close()
+    if failed_out:
+        failed_out.close()
+
+    summary = [(criteria.index(criterion), calls, rejected, secs) for criterion, calls, rejected, secs in plan.summary()]
+
+    return tmpname, failedname, passed, failed, summary
+
+
+def _filter_shards(index, procs, unmapped_offset):
+    '''
+    Splits the references into shards of about the same number of reads (a
+    few per process, so the work evens out). Small references are grouped
+    together, so that there isn't a task (and temporary file) for every
+    contig. Returns a list of (tids, start offset, end offset), in file order,
+    with the unmapped reads at the end as ([-1], unmapped_offset, None).
+
+    >>> class MockIndex(object):
+    ...     meta = [(0, 10, 100, 0), None, (10, 20, 5, 1), (20, 30, 4, 0), (30, 40, 200, 0), (40, 50, 1, 0)]
+    >>> _filter_shards(MockIndex(), 2, 50)
+    [([0], 0, 10), ([2, 3, 4], 10, 40), ([5], 40, 50), ([-1], 50, None)]
+    '''
+    refs = [(tid, meta) for tid, meta in enumerate(index.meta) if meta]
+    target = max(sum([meta[2] + meta[3] for tid, meta in refs]) / (procs * 4), 1)
+
+    shards = []
+    tids = []
+    count = 0
+    for tid, meta in refs:
+        if not tids:
+            start = meta[0]
+        tids.append(tid)
+        count += meta[2] + meta[3]
+
+        if count >= target:
+            shards.append((tids, start, meta[1]))
+            tids = []
+            count = 0
+
+    if tids:
+        shards.append((tids, start, meta[1]))
+
+    shards.append(([-1], unmapped_offset, None))
+    return shards
+
+
+def _bam_filter_parallel(infile, outfile, specs, failedfile, verbose, threads, level, raw, procs, tmpdir, summary_out):
+    bamfile = RawBamReader(infile)
+    index = BamIndex('%s.bai' % infile)
+
+    unmapped_offset = max([meta[1] for meta in index.meta if meta] or [bamfile.tell()])
+    shards = _filter_shards(index, procs, unmapped_offset)
+
+    if not tmpdir:
+        tmpdir = os.path.dirname(os.path.abspath(outfile))
+
+    # see bam_filter
+    total = None
+    if not failedfile:
+        total = index.read_count()
+
+    tasks = [(infile, tids, start, end, failedfile is not None, total is not None, verbose, level, raw, tmpdir) for tids, start, end in shards]
+
+    pool = multiprocessing.Pool(procs, _init_filter_worker, (specs,))
+    results = pool.map(_filter_shard, tasks, 1)
+    pool.close()
+    pool.join()
+
+    # The shards are in header order (the same order as the input file), so
+    # they can be concatenated without sorting.
+    out = RawBamWriter(outfile, bamfile.header_data, threads, level)
+    failed_out = open(failedfile, 'w') if failedfile else None
+
+    passed = 0
+    failed = 0
+    totals = [[0, 0, 0.0] for spec in specs]
+
+    for tmpname, failedname, shard_passed, shard_failed, summary in results:
+        shard = RawBamReader(tmpname)
+        start = shard.tell()
+        shard.close()
+        out.copy_range(tmpname, start)
+        os.unlink(tmpname)
+
+        if failedname:
+            with open(failedname) as f:
+                for line in f:
+                    failed_out.write(line)
+            os.unlink(failedname)
+
+        passed += shard_passed
+        failed += shard_failed
+
+        for i, calls, rejected, secs in summary:
+            totals[i][0] += calls
+            totals[i][1] += rejected
+            totals[i][2] += secs
+
+    out.close()
+    bamfile.close()
+    if failed_out:
+        failed_out.close()
+
+    if total is not None:
+        failed = total - passed
+
+    summary_out.write("%s kept\n%s failed\n" % (passed, failed))
+
+    if verbose:
+        sys.stderr.write('\nCriteria (totals for all references):\n')
+        for (name, args), (calls, rejected, secs) in zip(specs, totals):
+            sys.stderr.write('    -%s %s: %s checked, %s failed, %.2f us/read\n' % (name, ' '.join(args), calls, rejected, secs * 1000000 / calls if calls else 0))
+
+
+def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False, threads=1, level=None, raw=False, procs=1, tmpdir=None):
+    '''
+    Filters a BAM file.
+
+    criteria is a list of criteria objects, or of (name, args) specs (see:
+    build_criteria).
+
+    If procs > 1, each reference (and then the unmapped reads) is filtered in
+    a separate process and the results are concatenated in the original order.
+    This requires an indexed BAM file and criteria given as specs, so that
+    each process can build its own criteria.
+
+    infile and outfile can be '-' for stdin/stdout. The output is then
+    uncompressed (unless a level is given), and the read counts are written to
+    stderr instead of stdout.
+    '''
+    summary_out = sys.stdout
+    if outfile == '-':
+        summary_out = sys.stderr
+        if level is None:
+            level = 0
+
+    specs = None
+    if criteria and isinstance(criteria[0], tuple):
+        specs = criteria
+
     if verbose:
         sys.stderr.write('Input file  : %s\n' % infile)
         sys.stderr.write('Output file : %s\n' % outfile)
         if failedfile:
             sys.stderr.write('Failed reads: %s\n' % failedfile)
         sys.stderr.write('Criteria:\n')
-        for criterion in criteria:
-            sys.stderr.write('    %s\n' % criterion)
+        if specs:
+            for name, args in specs:
+                sys.stderr.write('    -%s %s\n' % (name, ' '.join(args)))
+        else:
+            for criterion in criteria:
+                sys.stderr.write('    %s\n' % criterion)
 
         sys.stderr.write('\n')
 
-    bamfile = pysam.Samfile(infile, "rb")
-    outfile = pysam.Samfile(outfile, "wb", template=bamfile)
+    if procs > 1:
+        if not specs:
+            sys.stderr.write('Criteria must be given as (name, args) to filter in parallel, using one process\n')
+        elif not os.path.exists('%s.bai' % infile):
+            sys.stderr.write('Missing BAM index (%s.bai), using one process\n' % infile)
+        elif BamIndex('%s.bai' % infile).read_count() is None:
+            # the shards are found from the reference ranges in the index
+            sys.stderr.write('BAM index (%s.bai) is missing the reference ranges, using one process\n' % infile)
+        else:
+            _bam_filter_parallel(infile, outfile, specs, failedfile, verbose, threads, level, raw, procs, tmpdir, summary_out)
+            return
+
+    if specs:
+        criteria = build_criteria(specs)
+
+    bamfile, outfile = _open_filter_files(infile, outfile, criteria, threads, level, raw)
 
     if failedfile:
         failed_out = open(failedfile, 'w')
     else:
         failed_out = None
 
-    passed = 0
-    failed = 0
-
-    def _callback(read):
-        return "%s | %s kept,%s failed" % ('%s:%s' % (bamfile.getrname(read.tid), read.pos) if read.tid > -1 else 'unk', passed, failed)
-
-    for read in bam_iter(bamfile):
-        p = True
+    # If only some regions can pass, use the index to read just those. The
+    # other reads are still counted as failed (using the read counts in the
+    # index), but the -failed file needs every read, so it is only used
+    # without one.
+    intervals = None
+    total = None
+    if not failed_out and os.path.exists('%s.bai' % infile):
+        intervals = _fetch_intervals(bamfile, criteria)
+        if intervals is not None:
+            total = BamIndex('%s.bai' % infile).read_count()
+            if total is None:
+                intervals = None
+
+    if intervals is not None:
+        if verbose:
+            sys.stderr.write('Reading %s region(s) using the BAM index\n' % len(intervals))
+        reads = _fetch_reads(bamfile, intervals)
+    else:
+        reads = bam_iter(bamfile)
 
-        for criterion in criteria:
-            if not criterion.filter(bamfile, read):
-                p = False
-                failed += 1
-                if failed_out:
-                    failed_out.write('%s\t%s\n' % (read.qname, criterion))
-                #outfile.write(read_to_unmapped(read))
-                break
-        if p:
-            passed += 1
-            outfile.write(read)
+    # The -failed file lists the first criterion (in the given order) that
+    # a read failed, so the criteria can only be reordered without it.
+    plan = FilterPlan(criteria, adaptive=not failed_out, timing=verbose)
+    if intervals is None and level != 0 and isinstance(bamfile, RawBamReader):
+        passed, failed = _filter_raw_reads(bamfile, reads, outfile, plan, failed_out)
+    else:
+        passed, failed = _filter_reads(bamfile, reads, outfile, plan, failed_out)
+    if total is not None:
+        failed = total - passed
 
     bamfile.close()
     outfile.close()
     if failed_out:
         failed_out.close()
-    sys.stdout.write("%s kept\n%s failed\n" % (passed, failed))
+    summary_out.write("%s kept\n%s failed\n" % (passed, failed))
+
+    if verbose:
+        sys.stderr.write('\nCriteria (in the order used):\n')
+        for criterion, calls, rejected, secs in plan.summary():
+            sys.stderr.write('    %s: %s checked, %s failed, %.2f us/read\n' % (criterion, calls, rejected, secs * 1000000 / calls if calls else 0))
+
+        for criterion in criteria:
+            if isinstance(getattr(criterion, 'ref', None), CachedFastaFile):
+                sys.stderr.write('    %s reference cache: %s\n' % (os.path.basename(criterion.refname), criterion.ref.stats()))
 
     for criterion in criteria:
         criterion.close()
 
 
+def _sample_reads(bamfile, index, sample_size=10000, points=100):
+    '''
+    Returns (reads, secs, nbytes): a sample of reads from across a BAM file,
+    the time spent reading them (not counting seeks) and the number of
+    compressed bytes they came from.
+
+    If there is an index, the reads are taken in equal-sized runs from evenly
+    spaced points in the (compressed) file, using the offsets in the linear
+    index. This way the references are sampled in proportion to the number
+    of reads they have. Otherwise, the first sample_size reads are used.
+    '''
+    first = bamfile.tell()
+    starts = [first]
+    per_point = sample_size
+
+    if index:
+        unmapped_offset = max([meta[1] for meta in index.meta if meta] or [first])
+        for linear in index.linear:
+            starts.extend([x for x in linear if x])
+        starts.append(unmapped_offset)
+        starts = sorted(set(starts))
+
+        fsize = os.path.getsize(bamfile.filename)
+        offsets = []
+        for i in xrange(points):
+            target = (fsize * (2 * i + 1) // (2 * points)) << 16
+            offsets.append(starts[min(bisect.bisect_left(starts, target), len(starts) - 1)])
+
+        starts = offsets
+        per_point = max(sample_size // points, 1)
+
+    reads = []
+    secs = 0.0
+    nbytes = 0
+    end = first
+
+    for offset in starts:
+        if offset < end:
+            # the last run already got to this point
+            offset = end
+        bamfile.seek(offset)
+
+        count = 0
+        start = None
+        for read in bamfile:
+            if start is None:
+                start = time.time()
+            reads.append(read)
+            count += 1
+            if count >= per_point or len(reads) >= sample_size:
+                break
+
+        if start is not None:
+            secs += time.time() - start
+        end = bamfile.tell()
+        nbytes += (end >> 16) - (offset >> 16)
+
+        if len(reads) >= sample_size:
+            break
+
+    return reads, secs, nbytes
+
+
+def _format_secs(secs):
+    if secs < 60:
+        return '%.1f sec' % secs
+    secs = int(secs)
+    return '%d:%02d:%02d' % (secs // 3600, secs % 3600 // 60, secs % 60)
+
+
+def bam_filter_explain(infile, criteria, sample_size=10000, out=sys.stdout):
+    '''
+    Estimates what filtering a BAM file would do, without writing anything.
+
+    Each criterion is checked separately on a sample of reads from across the
+    file (see _sample_reads). This shows how many reads pass each criterion
+    and all of them, the time each takes per read, the estimated output
+    size and run time, and the order FilterPlan would use (cheapest / most
+    selective first).
+
+    The input has to be a named file (not stdin), because the sample is read
+    from offsets across the file and the output size is estimated from the
+    file size.
+    '''
+    if infile == '-':
+        raise ValueError("-explain needs a named input BAM file (it can't read from stdin)")
+
+    if criteria and isinstance(criteria[0], tuple):
+        labels = [('-%s %s' % (name, ' '.join(args))).strip() for name, args in criteria]
+        criteria = build_criteria(criteria)
+    else:
+        labels = [str(criterion) for criterion in criteria]
+
+    bamfile = bam_open(infile)
+    index = None
+    if os.path.exists('%s.bai' % infile):
+        index = BamIndex('%s.bai' % infile)
+        if index.read_count() is None:
+            # no reference ranges (or counts), so sample the start of the file
+            index = None
+
+    reads, read_secs, nbytes = _sample_reads(bamfile, index, sample_size)
+    n = len(reads)
+    if not n:
+        out.write('No reads in %s\n' % infile)
+        bamfile.close()
+        return
+
+    elapsed = [0.0] * len(criteria)
+    rows = []
+    for read in reads:
+        row = []
+        for i, criterion in enumerate(criteria):
+            start = time.time()
+            row.append(bool(criterion.filter(bamfile, read)))
+            elapsed[i] += time.time() - start
+        rows.append(row)
+
+    # time to write the reads that pass (encoding + compression)
+    devnull = pysam.Samfile(os.devnull, 'wb', template=bamfile)
+    start = time.time()
+    written = 0
+    for read, row in zip(reads, rows):
+        if all(row):
+            devnull.write(read)
+            written += 1
+    write_secs = time.time() - start
+    devnull.close()
+
+    fsize = os.path.getsize(infile)
+    total = None
+    if index:
+        total = index.read_count()
+    elif n < sample_size:
+        # this is the whole file
+        total = n
+    exact = total is not None
+    if not exact:
+        total = n * fsize // max(nbytes, 1)
+
+    passes = [sum([row[i] for row in rows]) for i in xrange(len(criteria))]
+    joint = sum([all(row) for row in rows])
+
+    plan = FilterPlan(criteria)
+    plan.calls = [n] * len(criteria)
+    plan.rejected = [n - x for x in passes]
+    plan.elapsed = elapsed
+    plan.reorder()
+
+    # With an index, only the included regions are read (see bam_filter)
+    fetched = 1.0
+    fetch_rows = rows
+    if index and exact:
+        regional = [i for i, criterion in enumerate(criteria) if hasattr(criterion, 'regions')]
+        if regional:
+            best = max(regional, key=lambda i: plan.rejected[i])
+            fetched = float(passes[best]) / n
+            fetch_rows = [row for row in rows if row[best]]
+
+    def order_cost(order):
+        secs = 0.0
+        for row in fetch_rows:
+            for i in order:
+                secs += elapsed[i] / n
+                if not row[i]:
+                    break
+        return secs / max(len(fetch_rows), 1)
+
+    filter_cost = order_cost(plan._order)
+    read_cost = read_secs / n
+    write_cost = write_secs / written if written else 0.0
+    est_out = total * joint // n
+    est_secs = total * fetched * (read_cost + filter_cost) + est_out * write_cost
+
+    if index:
+        out.write('Sampled %s reads from across the file (using the BAM index)\n' % n)
+    elif n < sample_size:
+        out.write('Sampled all %s reads\n' % n)
+    else:
+        out.write('Sampled the first %s reads (the file isn\'t indexed)\n' % n)
+    out.write('Reads in file: %s%s\n\n' % ('' if exact else '~', total))
+
+    out.write('Criteria (each checked on every sampled read):\n')
+    out.write('    pass %   us/read  criterion\n')
+    for i, label in enumerate(labels):
+        out.write('    %6.2f%%  %7.2f  %s%s\n' % (passes[i] * 100.0 / n, elapsed[i] * 1000000 / n, label, ' (depends on the neighboring reads, so this is approximate)' if getattr(criteria[i], 'stateful', False) else ''))
+
+    out.write('\nAll criteria: %.2f%% pass\n' % (joint * 100.0 / n))
+    out.write('Estimated output: %s reads (%.1f MB)\n' % (est_out, float(fsize) * est_out / total / 1048576 if total else 0))
+    out.write('Estimated time: %s (%.2f us/read to read, %.2f us/read to filter, %.2f us/read to write)\n' % (_format_secs(est_secs), read_cost * 1000000, filter_cost * 1000000, write_cost * 1000000))
+    if fetched < 1.0:
+        out.write('  (only the included regions, ~%.2f%% of the reads, are read)\n' % (fetched * 100))
+
+    out.write('\nSuggested order (cheapest / most selective first, %.2f us/read vs %.2f us/read as given):\n' % (filter_cost * 1000000, order_cost(range(len(criteria))) * 1000000))
+    out.write('    %s\n' % ' '.join([labels[i] for i in plan._order]))
+
+    bamfile.close()
+    for criterion in criteria:
+        criterion.close()
+
+
 def read_to_unmapped(read):
     '''
     Example unmapped read
@@ -940,27 +1773,45 @@ if __name__ == '__main__':
     last = None
     verbose = False
     fail = False
+    threads = 1
+    level = None
+    raw = False
+    procs = 1
+    explain = False
 
     for arg in sys.argv[1:]:
         if last == '-failed':
             failed = arg
             last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
+        elif last == '-p':
+            procs = int(arg)
+            last = None
         elif arg == '-h':
             usage()
-        elif arg == '-failed':
+        elif arg in ['-failed', '-threads', '-level', '-p']:
             last = arg
         elif arg == '-v':
             verbose = True
-        elif not infile and os.path.exists(arg):
+        elif arg == '-raw':
+            raw = True
+        elif arg == '-explain':
+            explain = True
+        elif not infile and bam_exists(arg):
             infile = arg
-        elif not outfile:
+        elif not outfile and not crit_args and not (arg[0] == '-' and arg[1:] in _criteria):
             outfile = arg
         elif arg[0] == '-':
             if not arg[1:] in _criteria:
                 print "Unknown criterion: %s" % arg
                 fail = True
             if crit_args:
-                criteria.append(_criteria[crit_args[0][1:]](*crit_args[1:]))
+                criteria.append((crit_args[0][1:], crit_args[1:]))
             crit_args = [arg, ]
         elif crit_args:
             crit_args.append(arg)
@@ -969,18 +1820,24 @@ if __name__ == '__main__':
             fail = True
 
     if not fail and crit_args:
-        criteria.append(_criteria[crit_args[0][1:]](*crit_args[1:]))
+        criteria.append((crit_args[0][1:], crit_args[1:]))
+
+    if explain and infile == '-':
+        print "-explain needs a named input BAM file (it can't read from stdin)"
+        fail = True
 
-    if fail or not infile or not outfile or not criteria:
+    if fail or not infile or not (outfile or explain) or not criteria:
         if not infile and not outfile and not criteria:
             usage()
 
         if not infile:
             print "Missing: input bamfile"
-        if not outfile:
+        if not outfile and not explain:
             print "Missing: output bamfile"
         if not criteria:
             print "Missing: filtering criteria"
         usage()
+    elif explain:
+        bam_filter_explain(infile, criteria)
     else:
-        bam_filter(infile, outfile, criteria, failed, verbose)
+        bam_filter(infile, outfile, criteria, failed, verbose, threads=threads, level=level, raw=raw, procs=procs)
@@ -36,9 +36,8 @@ or if they overlap:
 '''
 import sys
 import os
-from ngsutils.bam import bam_iter
+from ngsutils.bam import bam_iter, bam_open, bam_exists
 from ngsutils.support.stats import counts_mean_stdev
-import pysam
 
 
 def bam_innerdist(bam1, bam2, summaryout=None):
@@ -110,6 +109,8 @@ def usage():  # pragma: no cover
     print """\
 Usage: bamutils innerdist filename1.bam filename2.bam
 
+Use '-' to read one of the files from stdin.
+
 Options:
   -summary filename       Write all distances out to a file
 
@@ -129,9 +130,9 @@ if __name__ == "__main__":  # pragma: no cover
         if last == '-summary' and not os.path.exists(arg):
             summary = arg
             last = None
-        elif not fname1 and os.path.exists(arg):
+        elif not fname1 and bam_exists(arg):
             fname1 = arg
-        elif not fname2 and os.path.exists(arg):
+        elif not fname2 and bam_exists(arg):
             fname2 = arg
         elif arg in ['-summary']:
             last = arg
@@ -141,8 +142,8 @@ if __name__ == "__main__":  # pragma: no cover
     if not fname1 or not fname2:
         usage()
 
-    bam1 = pysam.Samfile(fname1, "rb")
-    bam2 = pysam.Samfile(fname2, "rb")
+    bam1 = bam_open(fname1)
+    bam2 = bam_open(fname2)
 
     if summary:
         fobj = open(summary, 'w')
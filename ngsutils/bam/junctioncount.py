@@ -8,8 +8,7 @@ You can specify a particular genome range to scan (like a gene region).
 '''
 
 import sys
-import os
-from ngsutils.bam import bam_iter, bam_open
+from ngsutils.bam import bam_iter, bam_open, bam_exists
 
 def bam_junction_count(bam, ref=None, start=None, end=None, out=sys.stdout, quiet=False):
     last_tid = None
@@ -65,6 +64,8 @@ Usage: bamutils junctioncount {opts} bamfile {region}
 
 Region should be: chr:start-end (start 1-based)
 
+Use '-' to read from stdin (without a region).
+
 """
     sys.exit(1)
 
@@ -78,7 +79,7 @@ if __name__ == "__main__":
         if arg == '-h':
             usage()
         elif not fname:
-            if os.path.exists(arg):
+            if bam_exists(arg):
                 fname = arg
             else:
                 usage("%s doesn't exist!")
@@ -23,35 +23,66 @@ def get_read_tag_value(read, tag):
     return -1
 
 
-def _output_best(lastreads, outfile):
-    if not lastreads:
-        return
-
-    lastreads.sort()
-
-    best = lastreads[-1][0]
-    for score, read in lastreads[::-1]:
-        if score == best:
+def keepbest_reads(reads, tag='AS'):
+    '''
+    Returns the mappings for a read with the highest value for tag (all of
+    them, if there is a tie).
+
+    >>> from ngsutils.bam.t import MockRead
+    >>> reads = [MockRead(name, tags=[('AS', score)]) for name, score in [('x', 5), ('y', 5), ('z', 3), ('w', 5)]]
+    >>> [read.qname for read in keepbest_reads(reads)]
+    ['x', 'y', 'w']
+    '''
+    scores = [get_read_tag_value(read, tag) for read in reads]
+    if not scores:
+        return []
+
+    # ties are kept in input order
+    best = max(scores)
+    return [read for score, read in zip(scores, reads) if score == best]
+
+
+def _keepbest_batches(batches, outfile, tag):
+    for reads in batches:
+        for read in keepbest_reads(reads, tag):
             outfile.write(read)
-        else:
-            break
 
 
-def bam_keepbest(fname, outname, tag="AS"):
+def _keepbest_worker(args):
+    fname, start, end, tmpdir, tag, level = args
+
     bamfile = ngsutils.bam.bam_open(fname)
-    outfile = ngsutils.bam.bam_open(outname, "w", template=bamfile)
+    tmpname = ngsutils.bam.bam_tmpname(tmpdir)
+    outfile = ngsutils.bam.bam_open_writer(tmpname, level=level, template=bamfile)
 
-    lastreads = []
-    for read in ngsutils.bam.bam_iter(bamfile):
-        if lastreads and read.qname == lastreads[0][1].qname:
-            lastreads.append((get_read_tag_value(read, tag), read))
-        else:
-            if lastreads:
-                _output_best(lastreads, outfile)
+    _keepbest_batches(ngsutils.bam.bam_batch_range(bamfile, start, end), outfile, tag)
+
+    bamfile.close()
+    outfile.close()
+    return [tmpname], None
+
+
+def bam_keepbest(fname, outname, tag="AS", procs=1, tmpdir=None, batch_size=20000):
+    '''
+    If procs > 1, ranges of read names are processed in a pool of processes
+    (fname must be a BAM file, not stdin). Each range has about batch_size
+    reads.
+    '''
+    if procs > 1 and fname != '-':
+        if tmpdir is None and outname != '-':
+            tmpdir = os.path.dirname(os.path.abspath(outname))
+
+        # the workers compress the output at the final level
+        level = 0 if outname == '-' else None
+        # (the ranges are found while the workers run)
+        tasks = ((fname, start, end, tmpdir, tag, level) for start, end in ngsutils.bam.bam_batch_offsets(fname, batch_size, procs))
+        ngsutils.bam.bam_pool_map(_keepbest_worker, tasks, [outname], procs, [level])
+        return
 
-            lastreads = [(get_read_tag_value(read, tag), read), ]
+    bamfile = ngsutils.bam.bam_open(fname)
+    outfile = ngsutils.bam.bam_open(outname, "w", template=bamfile)
 
-    _output_best(lastreads, outfile)
+    _keepbest_batches(ngsutils.bam.bam_batch_reads(bamfile), outfile, tag)
 
     bamfile.close()
     outfile.close()
@@ -61,10 +92,18 @@ def usage():
     print __doc__
     print """Usage: bamutils keepbest {-tag tag} infile.bam outfile.bam
 
+Use '-' to read from stdin or write to stdout.
+
 Options:
    -tag tag    Use {tag} to determine which mappings to keep. This can be any
                tag present in the BAM file or "MAPQ" (default: AS).
 
+   -p N        Use N processes (infile.bam must be a file, not stdin)
+               [default: 1]
+
+   -T dir      Use this directory for temporary files (-p only)
+               [default: same directory as outfile.bam]
+
 """
     sys.exit(-1)
 
@@ -72,17 +111,25 @@ if __name__ == "__main__":
     fname = None
     outname = None
     tag = "AS"
+    procs = 1
+    tmpdir = None
     last = None
 
     for arg in sys.argv[1:]:
         if last == '-tag':
             tag = arg
             last = None
-        elif arg in ['-tag']:
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif last == '-T':
+            tmpdir = arg
+            last = None
+        elif arg in ['-tag', '-p', '-T']:
             last = arg
         elif arg == "-h":
             usage()
-        elif not fname and os.path.exists(arg):
+        elif not fname and ngsutils.bam.bam_exists(arg):
             fname = arg
         elif not outname:
             if os.path.exists(arg):
@@ -97,4 +144,4 @@ if __name__ == "__main__":
     if not fname:
         usage()
 
-    bam_keepbest(fname, outname, tag)
+    bam_keepbest(fname, outname, tag, procs, tmpdir)
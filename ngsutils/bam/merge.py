@@ -7,7 +7,8 @@ Combine multiple BAM files together (taking best-matches)
 Given a number of BAM files, this script will merge them together, taking
 only the best matches.  There can be any number of files, but the BAM header
 will be taken from the first one.  The input files should be sorted by read
-name, or at least have reads in the same order.
+name, or at least have reads in the same order. (To merge coordinate sorted
+files, see: bamutils catmerge)
 
 The first input file should have a record for every read in the other files.
 However, the secondary files *may* have missing lines, so long as they are in
@@ -27,7 +28,9 @@ will be kept.
 
 import os
 import sys
-import pysam
+import collections
+import threading
+import Queue
 import ngsutils.bam
 
 
@@ -36,6 +39,8 @@ def usage():
     print """
 Usage: bamutils merge {opts} out.bam in1.bam in2.bam ...
 
+Use '-' to write to stdout, or to read one of the input files from stdin.
+
 Options
   -tag VAL    Tag to use to determine from which file reads will be taken.
               (must be type :i or :f) You may have more than one of these,
@@ -47,89 +52,171 @@ Options
 
   -keepall    Keep all mappings for each read, not just the best one.
               (Note: only one mapping to each ref/pos will be kept)
+
+  -readahead  Read each input file in its own thread. pysam holds the GIL
+              while it decodes reads, so this is only faster if the input
+              files are slow to read (network storage, etc), not for CPU
+              time. [default: off]
+
+  -threads N  Use N threads to compress the output BAM file [default: 1]
+
+  -level N    Compression level for the output BAM file (0-9). Use 0 for
+              uncompressed output that will be piped to another program.
+              [default: 6]
 """
     sys.exit(1)
 
 
-def bam_merge(fname, infiles, tags=['AS+', 'NM-'], discard=False, keepall=False, quiet=False):
+class _ReadAhead(object):
+    '''
+    Reads the batches of reads (by name) from a BAM file in a separate thread,
+    so that the files are read (and inflated) while the reads are compared.
+    Batches are passed back in chunks of 'size'.
+    '''
+    def __init__(self, bam, quiet=False, size=256):
+        self._queue = Queue.Queue(4)
+        self._buf = collections.deque()
+        self._done = False
+        self._thread = threading.Thread(target=self._run, args=(bam, quiet, size))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, bam, quiet, size):
+        try:
+            chunk = []
+            for batch in ngsutils.bam.bam_batch_reads(bam, quiet=quiet):
+                chunk.append(batch)
+                if len(chunk) >= size:
+                    self._queue.put(chunk)
+                    chunk = []
+            if chunk:
+                self._queue.put(chunk)
+            self._queue.put(None)
+        except Exception, e:
+            self._queue.put(e)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self._buf:
+            if self._done:
+                raise StopIteration
+
+            chunk = self._queue.get()
+            if chunk is None:
+                self._done = True
+                self._thread.join()
+            elif isinstance(chunk, Exception):
+                self._done = True
+                raise chunk
+            else:
+                self._buf.extend(chunk)
+
+        return self._buf.popleft()
+
+
+def _tag_vals(read, tag_specs):
+    '''
+    Returns the values for the tags used to pick the best read. Values are
+    negated for descending (-) tags, so that larger is always better.
+    '''
+    vals = []
+    for tag, desc in tag_specs:
+        val = float(read.opt(tag))
+        if desc:
+            val = -val
+        vals.append(val)
+    return vals
+
+
+def bam_merge(fname, infiles, tags=['AS+', 'NM-'], discard=False, keepall=False, quiet=False, threads=1, level=None, readahead=False):
+    '''
+    Merges the best mappings for each read from infiles.
+
+    The reads in the first file set the order. The next batch of reads (by name)
+    from each of the other files is kept by read name until the first file gets
+    to that read, so each read is only looked at once, no matter how many files
+    there are. If readahead is True, each file is read in a separate thread.
+    '''
     bams = []
-    last_reads = []
     bamgens = []
     counts = []
     unmapped = 0
 
-    for infile in infiles:
-        bam = pysam.Samfile(infile, "rb")
-        last_reads.append(None)
+    tag_specs = [(tag[:2], tag[-1] == '-') for tag in tags]
+
+    for i, infile in enumerate(infiles):
+        bam = ngsutils.bam.bam_open(infile)
         bams.append(bam)
         counts.append(0)
-        bamgens.append(ngsutils.bam.bam_batch_reads(bam))
-
-    outfile = pysam.Samfile('%s.tmp' % fname, "wb", template=bams[0])
-
-    while True:
-        found = False
-        for i, bamgen in enumerate(bamgens):
-            if last_reads[i] == None:
-                try:
-                    last_reads[i] = bamgen.next()
-                    if last_reads[i]:
-                        found = True
-                except:
-                    pass
-            else:
-                found = True
-        if not found:
-            break
+        if readahead:
+            bamgens.append(_ReadAhead(bam, quiet=quiet or i > 0))
+        else:
+            bamgens.append(ngsutils.bam.bam_batch_reads(bam, quiet=quiet or i > 0))
+
+    tmpname = fname if fname == '-' else '%s.tmp' % fname
+    outfile = ngsutils.bam.bam_open_writer(tmpname, threads, level, template=bams[0])
+
+    # read name => [(file, batch), ...] for the next batch in each of the
+    # other files
+    waiting = {}
+
+    def _advance(i):
+        try:
+            batch = bamgens[i].next()
+        except StopIteration:
+            return
+        waiting.setdefault(batch[0].qname, []).append((i, batch))
+
+    for i in xrange(1, len(bamgens)):
+        _advance(i)
+
+    for first_group in bamgens[0]:
+        groups = [(0, first_group)]
+
+        matches = waiting.pop(first_group[0].qname, None)
+        if matches:
+            matches.sort(key=lambda x: x[0])
+            groups.extend(matches)
+            for i, batch in matches:
+                _advance(i)
 
         best_val = None
         best_reads = []
         best_source = 0
 
         mappings = {}
-        unmapped = None
-
-        first_group = last_reads[0]
-        for i in xrange(len(last_reads)):
-            if not last_reads[i]:
-                continue
-
-            match = False
-            for read in last_reads[i]:                        
-                if read.qname == first_group[0].qname:
-                    match = True
-
-                    if not read.is_unmapped:
-                        tag_val = []
-                        for tag in tags:
-                            val = float(read.opt(tag[:2]))
-                            if tag[-1] == '-':
-                                val = -val
-                            tag_val.append(val)
-
-                        if keepall:
-                            if not (read.tid, read.pos) in mappings:
-                                mappings[(read.tid, read.pos)] = (tag_val, i, read)
-                            elif tag_val > mappings[(read.tid, read.pos)][0]:
-                                mappings[(read.tid, read.pos)] = (tag_val, i, read)
-                        else:        
-                            if not best_val or tag_val > best_val:
-                                best_val = tag_val
-                                best_reads = [read]
-                                best_source = i
-                            elif tag_val == best_val:
-                                best_reads.append(read)
-                    elif not discard:
-                        unmapped = read
-            if match:
-                last_reads[i] = None
+        unmapped_read = None
+
+        for i, group in groups:
+            for read in group:
+                if not read.is_unmapped:
+                    tag_val = _tag_vals(read, tag_specs)
+
+                    if keepall:
+                        if not (read.tid, read.pos) in mappings:
+                            mappings[(read.tid, read.pos)] = (tag_val, i, read)
+                        elif tag_val > mappings[(read.tid, read.pos)][0]:
+                            mappings[(read.tid, read.pos)] = (tag_val, i, read)
+                    else:
+                        if not best_val or tag_val > best_val:
+                            best_val = tag_val
+                            best_reads = [read]
+                            best_source = i
+                        elif tag_val == best_val:
+                            best_reads.append(read)
+                elif not discard:
+                    unmapped_read = read
 
         if keepall and mappings:
             outs = []
             for k in mappings:
                 outs.append(mappings[k])
 
-            for tagval, i, read in sorted(outs):
+            # (ties are written by position, not compared as pysam objects)
+            outs.sort(key=lambda x: (x[0], x[1], x[2].tid, x[2].pos))
+            for tagval, i, read in outs:
                 counts[i] += 1
                 outfile.write(read)
 
@@ -137,22 +224,31 @@ def bam_merge(fname, infiles, tags=['AS+', 'NM-'], discard=False, keepall=False,
             counts[best_source] += 1
             for read in best_reads:
                 outfile.write(read)
-        elif unmapped:
+        elif unmapped_read:
             unmapped += 1
 
             if not discard:
-                outfile.write(unmapped)
-
-    if not quiet:
-        for fn, cnt in zip(infiles, counts):
-            print "%s\t%s" % (fn, cnt)
-        print "unmapped\t%s" % unmapped
+                outfile.write(unmapped_read)
 
     outfile.close()
     for bam in bams:
         bam.close()
 
-    os.rename('%s.tmp' % fname, fname)
+    if waiting:
+        if tmpname != fname:
+            os.unlink(tmpname)
+        i, batch = waiting.values()[0][0]
+        raise ValueError("%s has reads that aren't in %s (or are in a different order): %s" % (infiles[i], infiles[0], batch[0].qname))
+
+    if not quiet:
+        # (the reads may be going to stdout)
+        out = sys.stderr if fname == '-' else sys.stdout
+        for fn, cnt in zip(infiles, counts):
+            out.write("%s\t%s\n" % (fn, cnt))
+        out.write("unmapped\t%s\n" % unmapped)
+
+    if tmpname != fname:
+        os.rename(tmpname, fname)
 
 if __name__ == '__main__':
     infiles = []
@@ -160,6 +256,9 @@ if __name__ == '__main__':
     last = None
     discard = False
     keepall = False
+    threads = 1
+    level = None
+    readahead = False
     tags = []
 
     for arg in sys.argv[1:]:
@@ -168,15 +267,23 @@ if __name__ == '__main__':
         elif last == '-tag':
             tags.append(arg)
             last = None
-        elif arg in ['-tag']:
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
+        elif arg in ['-tag', '-threads', '-level']:
             last = arg
         elif arg == '-keepall':
             keepall = True
         elif arg == '-discard':
             discard = True
+        elif arg == '-readahead':
+            readahead = True
         elif not outfile:
             outfile = arg
-        elif os.path.exists(arg):
+        elif ngsutils.bam.bam_exists(arg):
             infiles.append(arg)
 
     if not tags:
@@ -185,4 +292,4 @@ if __name__ == '__main__':
     if not infiles or not outfile:
         usage()
     else:
-        bam_merge(outfile, infiles, tags, discard, keepall)
+        bam_merge(outfile, infiles, tags, discard, keepall, threads=threads, level=level, readahead=readahead)
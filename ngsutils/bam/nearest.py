@@ -73,6 +73,8 @@ def usage(msg=None):
     sys.stdout.write('''\
 Usage: bamutils nearest {-max val} filename.bam regions.bed
 
+Use '-' to read the BAM file from stdin.
+
 Options:
   -max    The maximal distance to look for a nearest region
           (default: 100K)
@@ -94,7 +96,7 @@ if __name__ == '__main__':
             last = None
         elif arg in ['-max']:
             last = arg
-        elif not bam_fname and os.path.exists(arg):
+        elif not bam_fname and ngsutils.bam.bam_exists(arg):
             bam_fname = arg
         elif not bed_fname and os.path.exists(arg):
             bed_fname = arg
@@ -7,7 +7,7 @@ the most likely pairing partners based upon strand, insert distance, and
 maximizing alignment scores.
 
 It is very important that the files are either in the same order with each
-read present in both files or sorted in name order.
+read present in both files or sorted in name order (see: bamutils sort -n).
 
 The value of the attribute/tag given will be used to determine which reads
 should be kept and which should be discarded. The tag should be a numeric
@@ -17,9 +17,9 @@ The BEST pair will be kept that maximizes the tag values and otherwise
 satisfies strand and distance values.
 """
 
+import bisect
 import os
 import sys
-import pysam
 import ngsutils.bam
 
 
@@ -30,6 +30,8 @@ def usage(msg=None):
     print """
 Usage: bamutils pair {opts} out.bam read1.bam read2.bam 
 
+Use '-' to write to stdout, or to read one of the input files from stdin.
+
 Options
   -tag VAL            Tag to use to determine from which file reads will be
                       taken. (must be type :i or :f) You may have more than
@@ -52,6 +54,19 @@ Options
 
   -reason tag         Write the reason for failure to this tag (only for
                       failed reads/mappings) Must be a valid two char name.
+
+  -threads N          Use N threads to compress each output BAM file
+                      [default: 1]
+
+  -level N            Compression level for the output BAM files (0-9). Use
+                      0 for uncompressed output that will be piped to another
+                      program. [default: 6]
+
+  -p N                Use N processes (read1.bam and read2.bam must be files,
+                      not stdin) [default: 1]
+
+  -T dir              Use this directory for temporary files (-p only)
+                      [default: same directory as out.bam]
 """
     sys.exit(1)
 
@@ -79,6 +94,119 @@ def is_valid_pair(read1, read2):
     return True, ''
 
 
+class MateIndex(object):
+    '''
+    The mappings for one read of a pair, indexed by reference and strand and
+    sorted by position, so that the possible mates for a mapping of the other
+    read can be found with bisect (instead of checking every mapping).
+    '''
+    def __init__(self, reads):
+        self.has_unmapped = False
+        self.mapped = 0
+        self.tid_counts = {}
+        self.groups = {}
+        self.positions = {}
+
+        for i, read in enumerate(reads):
+            if read.is_unmapped:
+                self.has_unmapped = True
+                continue
+
+            self.mapped += 1
+            self.tid_counts[read.tid] = self.tid_counts.get(read.tid, 0) + 1
+
+            if not (read.tid, read.is_reverse) in self.groups:
+                self.groups[(read.tid, read.is_reverse)] = []
+            self.groups[(read.tid, read.is_reverse)].append((read.pos, i, read))
+
+        for key in self.groups:
+            self.groups[key].sort(key=lambda x: (x[0], x[1]))
+            self.positions[key] = [x[0] for x in self.groups[key]]
+
+    def mates(self, read, min_size, max_size):
+        '''
+        Finds the valid mates for read. Returns (reasons, mates), where reasons
+        is the set of reasons that pairs with the other mappings aren't valid
+        (see: is_valid_pair), and mates is a list of (i, mate, insert size)
+        for the valid pairs (in the same order as the indexed reads).
+        '''
+        reasons = set()
+
+        if read.is_unmapped:
+            reasons.add('unmapped')
+            return reasons, []
+
+        if self.has_unmapped:
+            reasons.add('unmapped')
+
+        if self.mapped > self.tid_counts.get(read.tid, 0):
+            reasons.add('chromosome')
+
+        if (read.tid, read.is_reverse) in self.groups:
+            reasons.add('orientation')
+
+        key = (read.tid, not read.is_reverse)
+        if not key in self.groups:
+            return reasons, []
+
+        group = self.groups[key]
+        positions = self.positions[key]
+
+        # Mates have to be sequenced towards the read, and the insert size
+        # is at least the distance between the starts, so only the mates in
+        # this window need to be checked.
+        if read.is_reverse:
+            lo = bisect.bisect_left(positions, read.pos - max_size)
+            hi = bisect.bisect_right(positions, read.pos)
+            if lo > 0:
+                reasons.add('size')
+            if hi < len(positions):
+                reasons.add('direction')
+        else:
+            lo = bisect.bisect_left(positions, read.pos)
+            hi = bisect.bisect_right(positions, read.pos + max_size)
+            if lo > 0:
+                reasons.add('direction')
+            if hi < len(positions):
+                reasons.add('size')
+
+        mates = []
+        for pos, i, mate in group[lo:hi]:
+            # there can be some strange edge cases for insert size, so we'll just look
+            # for the biggest
+            ins_size = max(mate.aend - read.pos, read.aend - mate.pos)
+
+            # This doesn't work for RNA reads - you can still have hidden introns
+            # between the two reads. I'm leaving this here so that when I'm tempted
+            # to add this check again, I'll remember why it's a bad idea.
+
+            # junctionstarts = set()
+
+            # pos = r1.pos
+            # for op, size in r1.cigar:
+            #     if op == 0 or op == 2:
+            #         pos += size
+            #     elif op == 3:
+            #         junctionstarts.add(pos)
+            #         ins_size -= size
+
+            # pos = r2.pos
+            # for op, size in r2.cigar:
+            #     if op == 0 or op == 2:
+            #         pos += size
+            #     elif op == 3:
+            #         if not pos in junctionstarts:
+            #             ins_size -= size
+
+            if ins_size < min_size or ins_size > max_size:
+                reasons.add('size')
+            else:
+                mates.append((i, mate, ins_size))
+
+        mates.sort(key=lambda x: x[0])
+        return reasons, mates
+
+
 def find_pairs(reads1, reads2, min_size, max_size, tags):
     '''
     returns pairs, fail1, fail2
@@ -91,100 +219,57 @@ def find_pairs(reads1, reads2, min_size, max_size, tags):
     valid = set()
     reasons = {}
 
+    index2 = MateIndex(reads2)
+
     for r1 in reads1:
-        for r2 in reads2:
-            is_valid, reason = is_valid_pair(r1, r2)
-            if is_valid:
-                # there can be some strange edge cases for insert size, so we'll just look
-                # for the biggest
-                ins_size = max(r2.aend - r1.pos, r1.aend - r2.pos)
-
-
-                # This doesn't work for RNA reads - you can still have hidden introns
-                # between the two reads. I'm leaving this here so that when I'm tempted
-                # to add this check again, I'll remember why it's a bad idea.
-
-                # junctionstarts = set()
-
-                # pos = r1.pos
-                # for op, size in r1.cigar:
-                #     if op == 0 or op == 2:
-                #         pos += size
-                #     elif op == 3:
-                #         junctionstarts.add(pos)
-                #         ins_size -= size
-
-                # pos = r2.pos
-                # for op, size in r2.cigar:
-                #     if op == 0 or op == 2:
-                #         pos += size
-                #     elif op == 3:
-                #         if not pos in junctionstarts:
-                #             ins_size -= size
-
-                if ins_size < min_size or ins_size > max_size:
-                    if not (1, r1.tid, r1.pos) in reasons:
-                        reasons[(1, r1.tid, r1.pos)] = set()
-                    if not (2, r2.tid, r2.pos) in reasons:
-                        reasons[(2, r2.tid, r2.pos)] = set()
-
-                    reasons[(1, r1.tid, r1.pos)].add('size')
-                    reasons[(2, r2.tid, r2.pos)].add('size')
-                    continue
-
-                tag_val = []
-                for tag in tags:
-                    val = float(r1.opt(tag[:2]))
-
-                    val += float(r2.opt(tag[:2]))
-                    if tag[-1] == '+':
-                        # we will sort ascending to minimize size, so + tags (AS) need to be reversed
-                        val = -val
-                    tag_val.append(val)
-
-                possible.append((tag_val, ins_size, r1, r2))
-                valid.add((1, r1.tid, r1.pos))
-                valid.add((2, r2.tid, r2.pos))
-            else:
-                if not (1, r1.tid, r1.pos) in reasons:
-                    reasons[(1, r1.tid, r1.pos)] = set()
-                if not (2, r2.tid, r2.pos) in reasons:
-                    reasons[(2, r2.tid, r2.pos)] = set()
+        r1_reasons, mates = index2.mates(r1, min_size, max_size)
 
-                reasons[(1, r1.tid, r1.pos)].add(reason)
-                reasons[(2, r2.tid, r2.pos)].add(reason)
+        if not (1, r1.tid, r1.pos) in reasons:
+            reasons[(1, r1.tid, r1.pos)] = set()
+        reasons[(1, r1.tid, r1.pos)] |= r1_reasons
+
+        for i, r2, ins_size in mates:
+            tag_val = []
+            for tag in tags:
+                val = float(r1.opt(tag[:2]))
+
+                val += float(r2.opt(tag[:2]))
+                if tag[-1] == '+':
+                    # we will sort ascending to minimize size, so + tags (AS) need to be reversed
+                    val = -val
+                tag_val.append(val)
+
+            possible.append((tag_val, ins_size, r1, r2))
+            valid.add((1, r1.tid, r1.pos))
+            valid.add((2, r2.tid, r2.pos))
 
     for r1 in reads1:
         if not (1, r1.tid, r1.pos) in valid:
             fail1.append((r1, reasons[(1, r1.tid, r1.pos)]))
 
+    # the reasons are only needed for read2 mappings without a valid pair
+    index1 = None
     for r2 in reads2:
         if not (2, r2.tid, r2.pos) in valid:
-            fail2.append((r2, reasons[(2, r2.tid, r2.pos)]))
-
-    return possible, fail1, fail2
-
+            if index1 is None:
+                index1 = MateIndex(reads1)
 
-def bam_pair(out_fname, read1_fname, read2_fname, tags=['AS+', 'NM-'], min_size=50, max_size=1000, fail1_fname=None, fail2_fname=None, reason_tag=None, quiet=False):
-    bam1 = pysam.Samfile(read1_fname, "rb")
-    bam2 = pysam.Samfile(read2_fname, "rb")
-    out = pysam.Samfile('%s.tmp' % out_fname, "wb", template=bam1)
+            if not (2, r2.tid, r2.pos) in reasons:
+                reasons[(2, r2.tid, r2.pos)] = set()
+            reasons[(2, r2.tid, r2.pos)] |= index1.mates(r2, min_size, max_size)[0]
 
-    fail1 = None
-    fail2 = None
-
-    if fail1_fname:
-        fail1 = pysam.Samfile('%s.tmp' % fail1_fname, "wb", template=bam1)
+    for r2 in reads2:
+        if not (2, r2.tid, r2.pos) in valid:
+            fail2.append((r2, reasons[(2, r2.tid, r2.pos)]))
 
-    if fail2_fname:
-        if fail2_fname == fail1_fname:
-            fail2 = fail1
-        else:
-            fail2 = pysam.Samfile('%s.tmp' % fail2_fname, "wb", template=bam1)
+    return possible, fail1, fail2
 
-    gen1 = ngsutils.bam.bam_batch_reads(bam1, quiet=quiet)
-    gen2 = ngsutils.bam.bam_batch_reads(bam2, quiet=True)
 
+def _pair_groups(gen1, gen2):
+    '''
+    Joins two generators of read batches (from name-ordered files). Yields
+    (reads1, reads2) for each read name that is in both.
+    '''
     reads1 = None
     reads2 = None
 
@@ -205,112 +290,258 @@ def bam_pair(out_fname, read1_fname, read2_fname, tags=['AS+', 'NM-'], min_size=
                 reads2 = None
             continue
 
-        pairs, failed_reads1, failed_reads2 = find_pairs(reads1, reads2, min_size, max_size, tags)
-        written = set()
-        if pairs:
-            pairs.sort()  # default: max AS, min NM, min size
+        yield reads1, reads2
+
+        reads1 = None
+        reads2 = None
 
-            tag_val, size, r1, r2 = pairs[0]
-            best_val = (tag_val, size)
-            best_pairs = []
 
-            for tag_val, size, r1, r2 in pairs:
-                if (tag_val, size) == best_val:
-                    best_pairs.append((size, r1, r2))
+def _pair_write(reads1, reads2, out, fail1, fail2, tags, min_size, max_size, reason_tag):
+    pairs, failed_reads1, failed_reads2 = find_pairs(reads1, reads2, min_size, max_size, tags)
+    written = set()
+    if pairs:
+        # default: max AS, min NM, min size (ties are kept in the order they
+        # were found, instead of comparing the reads)
+        pairs.sort(key=lambda x: (x[0], x[1]))
 
-            for size, r1, r2 in best_pairs:
-                # good match! set the flags and write them out
-                r1.is_paired = True
-                r2.is_paired = True
+        tag_val, size, r1, r2 = pairs[0]
+        best_val = (tag_val, size)
+        best_pairs = []
 
-                r1.is_proper_pair = True
-                r2.is_proper_pair = True
+        for tag_val, size, r1, r2 in pairs:
+            if (tag_val, size) == best_val:
+                best_pairs.append((size, r1, r2))
 
-                r1.is_read1 = True
-                r2.is_read2 = True
+        for size, r1, r2 in best_pairs:
+            # good match! set the flags and write them out
+            r1.is_paired = True
+            r2.is_paired = True
+
+            r1.is_proper_pair = True
+            r2.is_proper_pair = True
 
-                if r1.pos < r2.pos:
-                    r1.tlen = size
-                    r2.tlen = -size
-                else:
-                    r1.tlen = -size
-                    r2.tlen = size
-
-                r1.mate_is_reverse = r2.is_reverse
-                r2.mate_is_reverse = r1.is_reverse
-
-                r1.mate_is_unmapped = False
-                r2.mate_is_unmapped = False
-
-                r1.rnext = r2.tid
-                r2.rnext = r1.tid
-
-                r1.pnext = r2.pos
-                r2.pnext = r1.pos
-
-                r1.tags = r1.tags + [('NH', len(best_pairs))]
-                r2.tags = r2.tags + [('NH', len(best_pairs))]
-
-                out.write(r1)
-                out.write(r2)
-                written.add((1, r1.tid, r1.pos))
-                written.add((2, r2.tid, r2.pos))
-
-        for tag_val, size, r1, r2 in pairs[1:]:
-            if fail1:
-                if (1,r1.tid, r1.pos) not in written:
-                    written.add((1,r1.tid, r1.pos))
-                    r1.is_paired = True
-                    r1.is_proper_pair = False
-                    r1.is_read1 = True
-                    if reason_tag:
-                        r1.tags = r1.tags + [(reason_tag, 'suboptimal')]
-                    fail1.write(r1)
-            if fail2:
-                if (2,r2.tid, r2.pos) not in written:
-                    written.add((2,r2.tid, r2.pos))
-                    r2.is_paired = True
-                    r2.is_proper_pair = False
-                    r2.is_read2 = True
-                    if reason_tag:
-                        r2.tags = r2.tags + [(reason_tag, 'suboptimal')]
-                    fail2.write(r2)
-
-        if failed_reads1 and fail1:
-            for r1, reasons in failed_reads1:
+            r1.is_read1 = True
+            r2.is_read2 = True
+
+            if r1.pos < r2.pos:
+                r1.tlen = size
+                r2.tlen = -size
+            else:
+                r1.tlen = -size
+                r2.tlen = size
+
+            r1.mate_is_reverse = r2.is_reverse
+            r2.mate_is_reverse = r1.is_reverse
+
+            r1.mate_is_unmapped = False
+            r2.mate_is_unmapped = False
+
+            r1.rnext = r2.tid
+            r2.rnext = r1.tid
+
+            r1.pnext = r2.pos
+            r2.pnext = r1.pos
+
+            r1.tags = r1.tags + [('NH', len(best_pairs))]
+            r2.tags = r2.tags + [('NH', len(best_pairs))]
+
+            out.write(r1)
+            out.write(r2)
+            written.add((1, r1.tid, r1.pos))
+            written.add((2, r2.tid, r2.pos))
+
+    for tag_val, size, r1, r2 in pairs[1:]:
+        if fail1:
+            if (1,r1.tid, r1.pos) not in written:
+                written.add((1,r1.tid, r1.pos))
                 r1.is_paired = True
                 r1.is_proper_pair = False
                 r1.is_read1 = True
                 if reason_tag:
-                    r1.tags = r1.tags + [(reason_tag, ','.join(reasons))]
+                    r1.tags = r1.tags + [(reason_tag, 'suboptimal')]
                 fail1.write(r1)
-        if failed_reads2 and fail2:
-            for r2, reasons in failed_reads2:
+        if fail2:
+            if (2,r2.tid, r2.pos) not in written:
+                written.add((2,r2.tid, r2.pos))
                 r2.is_paired = True
                 r2.is_proper_pair = False
-                r2.is_read1 = True
+                r2.is_read2 = True
                 if reason_tag:
-                    r2.tags = r2.tags + [(reason_tag, ','.join(reasons))]
+                    r2.tags = r2.tags + [(reason_tag, 'suboptimal')]
                 fail2.write(r2)
 
-        reads1 = None
-        reads2 = None
+    if failed_reads1 and fail1:
+        for r1, reasons in failed_reads1:
+            r1.is_paired = True
+            r1.is_proper_pair = False
+            r1.is_read1 = True
+            if reason_tag:
+                r1.tags = r1.tags + [(reason_tag, ','.join(reasons))]
+            fail1.write(r1)
+    if failed_reads2 and fail2:
+        for r2, reasons in failed_reads2:
+            r2.is_paired = True
+            r2.is_proper_pair = False
+            r2.is_read1 = True
+            if reason_tag:
+                r2.tags = r2.tags + [(reason_tag, ','.join(reasons))]
+            fail2.write(r2)
+
+
+def _pair_offsets(read1_fname, read2_fname, names=10000, threads=1):
+    '''
+    Splits two files into ranges of 'names' paired read names, using the same
+    join as _pair_groups (each range starts at a read name that is in both
+    files). Yields (start1, end1, start2, end2) virtual offsets (the ends are
+    None for the last range), as they are found (see: bam_batch_offsets).
+    '''
+    bam1 = ngsutils.bam.RawBamReader(read1_fname, threads=threads)
+    bam2 = ngsutils.bam.RawBamReader(read2_fname, threads=threads)
+    start1 = bam1.tell()
+    start2 = bam2.tell()
+
+    gen1 = bam1.name_offsets()
+    gen2 = bam2.name_offsets()
+    name1 = None
+    name2 = None
+    count = 0
+
+    while True:
+        try:
+            if name1 is None:
+                name1, pos1 = gen1.next()
+
+            if name2 is None:
+                name2, pos2 = gen2.next()
+        except StopIteration:
+            break
+
+        if name1 != name2:
+            if name1 < name2:
+                name1 = None
+            else:
+                name2 = None
+            continue
 
+        if count == names:
+            yield (start1, pos1, start2, pos2)
+            start1 = pos1
+            start2 = pos2
+            count = 0
+        count += 1
+
+        name1 = None
+        name2 = None
 
     bam1.close()
     bam2.close()
+    yield (start1, None, start2, None)
 
-    out.close()
-    os.rename('%s.tmp' % out_fname, out_fname)
 
+def _pair_worker(args):
+    read1_fname, read2_fname, start1, end1, start2, end2, tmpdir, has_fail1, has_fail2, same_fail, tags, min_size, max_size, reason_tag, out_level, fail_level = args
+
+    bam1 = ngsutils.bam.bam_open(read1_fname)
+    bam2 = ngsutils.bam.bam_open(read2_fname)
+    tmpnames = [ngsutils.bam.bam_tmpname(tmpdir)]
+    out = ngsutils.bam.bam_open_writer(tmpnames[0], level=out_level, template=bam1)
+
+    fail1 = None
+    fail2 = None
+
+    if has_fail1:
+        tmpnames.append(ngsutils.bam.bam_tmpname(tmpdir))
+        fail1 = ngsutils.bam.bam_open_writer(tmpnames[-1], level=fail_level, template=bam1)
+
+    if has_fail2:
+        if same_fail:
+            fail2 = fail1
+        else:
+            tmpnames.append(ngsutils.bam.bam_tmpname(tmpdir))
+            fail2 = ngsutils.bam.bam_open_writer(tmpnames[-1], level=fail_level, template=bam1)
+
+    for reads1, reads2 in _pair_groups(ngsutils.bam.bam_batch_range(bam1, start1, end1), ngsutils.bam.bam_batch_range(bam2, start2, end2)):
+        _pair_write(reads1, reads2, out, fail1, fail2, tags, min_size, max_size, reason_tag)
+
+    bam1.close()
+    bam2.close()
+    out.close()
     if fail1:
         fail1.close()
-        os.rename('%s.tmp' % fail1_fname, fail1_fname)
+    if fail2 and not same_fail:
+        fail2.close()
 
-    if fail2:
-        if fail2_fname != fail1_fname:
+    return tmpnames, None
+
+
+def bam_pair(out_fname, read1_fname, read2_fname, tags=['AS+', 'NM-'], min_size=50, max_size=1000, fail1_fname=None, fail2_fname=None, reason_tag=None, quiet=False, threads=1, level=None, procs=1, tmpdir=None, batch_size=10000):
+    '''
+    If procs > 1, ranges of read names are processed in a pool of processes
+    (the input files must be BAM files, not stdin). Each range has
+    batch_size paired read names.
+    '''
+    out_tmpname = out_fname if out_fname == '-' else '%s.tmp' % out_fname
+
+    if procs > 1 and read1_fname != '-' and read2_fname != '-':
+        if tmpdir is None and out_fname != '-':
+            tmpdir = os.path.dirname(os.path.abspath(out_fname))
+
+        outnames = [out_tmpname]
+        if fail1_fname:
+            outnames.append('%s.tmp' % fail1_fname)
+        if fail2_fname and fail2_fname != fail1_fname:
+            outnames.append('%s.tmp' % fail2_fname)
+
+        # the workers compress the output at the final level (stdout is
+        # uncompressed)
+        out_level = level
+        if out_fname == '-' and level is None:
+            out_level = 0
+
+        # (the ranges are found while the workers run)
+        tasks = ((read1_fname, read2_fname, start1, end1, start2, end2, tmpdir, fail1_fname is not None, fail2_fname is not None, fail2_fname == fail1_fname, tags, min_size, max_size, reason_tag, out_level, level) for start1, end1, start2, end2 in _pair_offsets(read1_fname, read2_fname, batch_size, procs))
+        ngsutils.bam.bam_pool_map(_pair_worker, tasks, outnames, procs, [out_level] + [level] * (len(outnames) - 1))
+
+    else:
+        bam1 = ngsutils.bam.bam_open(read1_fname)
+        bam2 = ngsutils.bam.bam_open(read2_fname)
+        out = ngsutils.bam.bam_open_writer(out_tmpname, threads, level, template=bam1)
+
+        fail1 = None
+        fail2 = None
+
+        if fail1_fname:
+            fail1 = ngsutils.bam.bam_open_writer('%s.tmp' % fail1_fname, threads, level, template=bam1)
+
+        if fail2_fname:
+            if fail2_fname == fail1_fname:
+                fail2 = fail1
+            else:
+                fail2 = ngsutils.bam.bam_open_writer('%s.tmp' % fail2_fname, threads, level, template=bam1)
+
+        gen1 = ngsutils.bam.bam_batch_reads(bam1, quiet=quiet)
+        gen2 = ngsutils.bam.bam_batch_reads(bam2, quiet=True)
+
+        for reads1, reads2 in _pair_groups(gen1, gen2):
+            _pair_write(reads1, reads2, out, fail1, fail2, tags, min_size, max_size, reason_tag)
+
+        bam1.close()
+        bam2.close()
+
+        out.close()
+        if fail1:
+            fail1.close()
+        if fail2 and fail2_fname != fail1_fname:
             fail2.close()
-            os.rename('%s.tmp' % fail2_fname, fail2_fname)
+
+    if out_tmpname != out_fname:
+        os.rename(out_tmpname, out_fname)
+
+    if fail1_fname:
+        os.rename('%s.tmp' % fail1_fname, fail1_fname)
+
+    if fail2_fname and fail2_fname != fail1_fname:
+        os.rename('%s.tmp' % fail2_fname, fail2_fname)
 
 if __name__ == '__main__':
     out_fname = None
@@ -321,6 +552,10 @@ if __name__ == '__main__':
     min_size = 50
     max_size = 10000
     reason_tag = None
+    threads = 1
+    level = None
+    procs = 1
+    tmpdir = None
     tags = []
 
     last = None
@@ -343,13 +578,25 @@ if __name__ == '__main__':
         elif last == '-reason':
             reason_tag = arg
             last = None
-        elif arg in ['-tag', '-fail1', '-fail2', '-size', '-reason']:
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif last == '-T':
+            tmpdir = arg
+            last = None
+        elif arg in ['-tag', '-fail1', '-fail2', '-size', '-reason', '-threads', '-level', '-p', '-T']:
             last = arg
         elif not out_fname:
             out_fname = arg
-        elif not read1_fname and os.path.exists(arg):
+        elif not read1_fname and ngsutils.bam.bam_exists(arg):
             read1_fname = arg
-        elif not read2_fname and os.path.exists(arg):
+        elif not read2_fname and ngsutils.bam.bam_exists(arg):
             read2_fname = arg
         else:
             usage('Unknown option: %s' % arg)
@@ -360,4 +607,4 @@ if __name__ == '__main__':
     if not read1_fname or not read2_fname or not out_fname:
         usage()
     else:
-        bam_pair(out_fname, read1_fname, read2_fname, tags, min_size, max_size, fail1_fname, fail2_fname, reason_tag)
+        bam_pair(out_fname, read1_fname, read2_fname, tags, min_size, max_size, fail1_fname, fail2_fname, reason_tag, threads=threads, level=level, procs=procs, tmpdir=tmpdir)
@@ -17,8 +17,7 @@ Note: The BAM file must be sorted in order to find duplicates. For paired-end
 
 import sys
 import os
-import pysam
-from ngsutils.bam import bam_iter
+from ngsutils.bam import bam_iter, bam_open, bam_open_writer, bam_exists
 
 
 def usage(msg=None):
@@ -28,6 +27,8 @@ def usage(msg=None):
     sys.stdout.write('''\
 Usage: bamutils pcrdup {options} infile.bam
 
+Use '-' to read from stdin (or for -bam, to write to stdout).
+
 Options:
     -frag                The reads are single-end fragments, so mark PCR
                          duplicated based only on the location of the read 
@@ -42,6 +43,13 @@ Options:
                          mapped to it, but they are not pcr duplicates, then
                          there each will be reported separately.
 
+    -threads N           Use N threads to compress the output BAM file
+                         [default: 1]
+
+    -level N             Compression level for the output BAM file (0-9).
+                         Use 0 for uncompressed output that will be piped to
+                         another program. [default: 6]
+
     You must set either -bam or -counts (or both).
 
 ''')
@@ -139,6 +147,8 @@ if __name__ == '__main__':
     outfile = None
     countfname = None
     fragment = False
+    threads = 1
+    level = None
 
     last = None
 
@@ -151,12 +161,18 @@ if __name__ == '__main__':
         elif last == '-bam':
             outfile = arg
             last = None
-        elif arg in ['-counts', '-bam']:
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
+        elif arg in ['-counts', '-bam', '-threads', '-level']:
             last = arg
         elif arg == '-frag':
             fragment = True
         elif not infile:
-            if os.path.exists(arg):
+            if bam_exists(arg):
                 infile = arg
             else:
                 usage("%s doesn't exist!" % arg)
@@ -169,10 +185,10 @@ if __name__ == '__main__':
     if not infile or not (outfile or countfname):
         usage()
 
-    bamfile = pysam.Samfile(infile, "rb")
+    bamfile = bam_open(infile)
     bamout = None
     if outfile:
-        bamout = pysam.Samfile(outfile, "wb", template=bamfile)
+        bamout = bam_open_writer(outfile, threads, level, template=bamfile)
 
     if countfname:
         countfile = open(countfname, 'w')
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+## category General
+## desc Runs filters, tags and other read changes in one pass
+'''
+Runs filters, tags and other read changes in one pass
+
+Instead of running 'bamutils cleancigar', 'removeclipping', 'renamepair',
+'filter' and 'tag' one after another (each reading and writing a whole BAM
+file), this runs them as stages of a single pass over the file. Each read is
+only decoded and encoded once.
+
+The stages are run in the order given. Reads that are removed by a filter
+aren't seen by the later stages.
+
+Stages:
+  -cleancigar           Remove zero-length CIGAR operations
+                        (see: bamutils cleancigar)
+  -removeclipping       Remove clipping from reads and alignments
+                        (see: bamutils removeclipping)
+  -renamepair {delim}   Remove the trailing /N from read names
+                        (see: bamutils renamepair, default delim: '/')
+
+  -suffix suff          Tags (see: bamutils tag)
+  -tag tag
+  -xs
+  -junction tag
+  -orig-ref tag
+  -orig-pos tag
+  -orig-cigar tag
+
+  Any of the criteria from 'bamutils filter' can also be used (ex: -mapped,
+  -lt MAPQ 10). Criteria that are next to each other are checked together, so
+  they can be reordered to check the cheapest / most selective ones first
+  (see: bamutils filter).
+'''
+
+import os
+import sys
+import time
+
+from ngsutils.bam import bam_open, bam_open_writer, bam_exists, read_cleancigar
+from ngsutils.bam.filter import FilterPlan, build_criteria, _criteria
+from ngsutils.bam.removeclipping import read_removeclipping
+from ngsutils.bam.renamepair import read_renamepair
+import ngsutils.bam.tag
+
+
+def _removeclipping(read):
+    return read_removeclipping(read) == 2
+
+
+def _renamepair(read, delim='/'):
+    name = read.qname
+    read_renamepair(read, delim)
+    return read.qname != name
+
+
+_read_funcs = {
+    'cleancigar': read_cleancigar,
+    'removeclipping': _removeclipping,
+    'renamepair': _renamepair,
+}
+
+_tags = {
+    'suffix': ngsutils.bam.tag.Suffix,
+    'tag': ngsutils.bam.tag.Tag,
+    'xs': ngsutils.bam.tag.CufflinksXS,
+    'junction': ngsutils.bam.tag.PredictJunction,
+    'orig-ref': ngsutils.bam.tag.OrigRef,
+    'orig-pos': ngsutils.bam.tag.OrigPos,
+    'orig-cigar': ngsutils.bam.tag.OrigCIGAR,
+}
+
+
+def _spec_name(specs):
+    return ' '.join([('-%s %s' % (name, ' '.join(args))).strip() for name, args in specs])
+
+
+class FilterStage(object):
+    'Removes the reads that fail any of the given filter criteria'
+    def __init__(self, parent, specs):
+        self.parent = parent
+        self.name = _spec_name(specs)
+        self.criteria = build_criteria(specs)
+        self.plan = FilterPlan(self.criteria)
+        self.reads_in = 0
+        self.reads_out = 0
+        self.altered = None
+        self.elapsed = 0.0
+
+    def filter(self, bam):
+        for read in self.parent.filter(bam):
+            self.reads_in += 1
+            start = time.time()
+            criterion = self.plan.filter(bam, read)
+            self.elapsed += time.time() - start
+            if criterion is None:
+                self.reads_out += 1
+                yield read
+
+    def close(self):
+        for criterion in self.criteria:
+            criterion.close()
+
+
+class ReadStage(object):
+    '''
+    Changes each read in-place with func(read, *args), which returns True if
+    the read was altered.
+    '''
+    def __init__(self, parent, name, func, *args):
+        self.parent = parent
+        self.name = _spec_name([(name, args)])
+        self.func = func
+        self.args = args
+        self.reads_in = 0
+        self.reads_out = 0
+        self.altered = 0
+        self.elapsed = 0.0
+
+    def filter(self, bam):
+        for read in self.parent.filter(bam):
+            self.reads_in += 1
+            start = time.time()
+            if self.func(read, *self.args):
+                self.altered += 1
+            self.elapsed += time.time() - start
+            self.reads_out += 1
+            yield read
+
+    def close(self):
+        pass
+
+
+class TagStage(object):
+    'Runs one of the chain classes from bamutils tag (Suffix, Tag, etc)'
+    def __init__(self, parent, name, clazz, *args):
+        self.name = _spec_name([(name, args)])
+        self.chain = clazz(parent, *args)
+        self.reads_in = 0
+        self.reads_out = 0
+        self.altered = None
+        self.elapsed = None
+
+    def filter(self, bam):
+        # tags don't remove reads
+        for read in self.chain.filter(bam):
+            self.reads_in += 1
+            self.reads_out += 1
+            yield read
+
+    def close(self):
+        pass
+
+
+def build_pipeline(specs):
+    '''
+    Builds the chain of stages from a list of (name, args) specs (name is the
+    command-line name, without the '-'). Returns (chain, stages).
+    '''
+    chain = ngsutils.bam.tag.BamReader()
+    stages = []
+
+    i = 0
+    while i < len(specs):
+        name, args = specs[i]
+        if name in _criteria:
+            j = i
+            while j < len(specs) and specs[j][0] in _criteria:
+                j += 1
+            chain = FilterStage(chain, specs[i:j])
+            i = j
+        else:
+            if name in _read_funcs:
+                chain = ReadStage(chain, name, _read_funcs[name], *args)
+            elif name in _tags:
+                chain = TagStage(chain, name, _tags[name], *args)
+            else:
+                raise ValueError('Unknown stage: -%s' % name)
+            i += 1
+
+        stages.append(chain)
+
+    return chain, stages
+
+
+def bam_pipeline(infile, outfile, specs, threads=1, level=None, out=sys.stderr):
+    '''
+    Runs the stages given by specs (see: build_pipeline) over a BAM file.
+    Returns the stages (with their counts).
+    '''
+    chain, stages = build_pipeline(specs)
+
+    bam = bam_open(infile)
+    outbam = bam_open_writer(outfile, threads, level, template=bam)
+
+    for read in chain.filter(bam):
+        outbam.write(read)
+
+    bam.close()
+    outbam.close()
+
+    for stage in stages:
+        stage.close()
+
+    if out:
+        out.write('Stage\treads in\treads out\taltered\tsecs\n')
+        for stage in stages:
+            out.write('%s\t%s\t%s\t%s\t%s\n' % (stage.name, stage.reads_in, stage.reads_out, '' if stage.altered is None else stage.altered, '' if stage.elapsed is None else '%.2f' % stage.elapsed))
+
+    return stages
+
+
+def usage(msg=None):
+    if msg:
+        print msg
+        print
+    print __doc__
+    print """\
+Usage: bamutils pipeline {opts} in.bam out.bam stages...
+
+Use '-' to read from stdin (SAM or BAM) or write to stdout (uncompressed BAM,
+unless -level is given).
+
+Options:
+  -f               Force overwriting the output BAM file if it exists
+
+  -threads N       Use N threads to compress the output BAM file
+                   [default: 1]
+
+  -level N         Compression level for the output BAM file (0-9). Use 0
+                   for uncompressed output that will be piped to another
+                   program. [default: 6]
+
+The number of reads going into and out of each stage (and the number of
+reads changed) is written to stderr.
+
+Example:
+bamutils pipeline in.bam out.bam -renamepair -mapped -lt MAPQ 10 -xs
+"""
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    infile = None
+    outfile = None
+    force = False
+    threads = 1
+    level = None
+    last = None
+
+    specs = []
+    stage_args = []
+
+    for arg in sys.argv[1:]:
+        if last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
+        elif arg == '-h':
+            usage()
+        elif arg in ['-threads', '-level']:
+            last = arg
+        elif arg == '-f':
+            force = True
+        elif not infile and bam_exists(arg):
+            infile = arg
+        elif not outfile and not stage_args:
+            outfile = arg
+        elif arg[0] == '-' and len(arg) > 1:
+            if not (arg[1:] in _criteria or arg[1:] in _read_funcs or arg[1:] in _tags):
+                usage('Unknown stage: %s' % arg)
+            if stage_args:
+                specs.append((stage_args[0][1:], stage_args[1:]))
+            stage_args = [arg, ]
+        elif stage_args:
+            stage_args.append(arg)
+        else:
+            usage('Unknown argument: %s' % arg)
+
+    if stage_args:
+        specs.append((stage_args[0][1:], stage_args[1:]))
+
+    if not infile or not outfile or not specs:
+        usage()
+
+    if not force and os.path.exists(outfile):
+        sys.stderr.write('ERROR: %s already exists! Not overwriting without force (-f)\n\n' % outfile)
+        sys.exit(1)
+
+    bam_pipeline(infile, outfile, specs, threads, level)
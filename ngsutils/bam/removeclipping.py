@@ -12,13 +12,12 @@ clipped bases is given in the 'ZC:f' tag.
 '''
 import sys
 import os
-import pysam
-from ngsutils.bam import bam_iter
+from ngsutils.bam import bam_iter, bam_open, bam_open_writer, bam_exists
 
 
-def bam_removeclipping(infile, outfile):
-    bam = pysam.Samfile(infile, "rb")
-    out = pysam.Samfile(outfile, "wb", template=bam)
+def bam_removeclipping(infile, outfile, threads=1, level=None):
+    bam = bam_open(infile)
+    out = bam_open_writer(outfile, threads, level, template=bam)
     total = 0
     count = 0
     unmapped = 0
@@ -96,8 +95,14 @@ def usage():
     print __doc__
     print """Usage: bamutils removeclipping {-f} inbamfile outbamfile
 
+Use '-' to read from stdin or write to stdout.
+
 Options:
-  -f     Force overwriting an existing outfile
+  -f           Force overwriting an existing outfile
+  -threads N   Use N threads to compress the output BAM file [default: 1]
+  -level N     Compression level for the output BAM file (0-9). Use 0 for
+               uncompressed output that will be piped to another program.
+               [default: 6]
 """
     sys.exit(-1)
 
@@ -105,14 +110,25 @@ if __name__ == "__main__":
     infile = None
     outfile = None
     force = False
+    threads = 1
+    level = None
+    last = None
 
     for arg in sys.argv[1:]:
-        if arg == "-h":
+        if last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
+        elif arg == "-h":
             usage()
+        elif arg in ['-threads', '-level']:
+            last = arg
         elif arg == "-f":
             force = True
         elif not infile:
-            if os.path.exists(os.path.expanduser(arg)):
+            if bam_exists(os.path.expanduser(arg)):
                 infile = os.path.expanduser(arg)
             else:
                 sys.stderr.write("File: %s not found!" % arg)
@@ -131,4 +147,4 @@ if __name__ == "__main__":
     if not infile or not outfile:
         usage()
 
-    bam_removeclipping(infile, outfile)
+    bam_removeclipping(infile, outfile, threads, level)
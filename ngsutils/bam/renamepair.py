@@ -11,13 +11,12 @@ exact same name.
 '''
 import sys
 import os
-import pysam
-from ngsutils.bam import bam_iter
+from ngsutils.bam import bam_iter, bam_open, bam_open_writer, bam_exists
 
 
-def bam_renamepair(infile, outfile, delim='/'):
-    bam = pysam.Samfile(infile, "rb")
-    out = pysam.Samfile(outfile, "wb", template=bam)
+def bam_renamepair(infile, outfile, delim='/', threads=1, level=None):
+    bam = bam_open(infile)
+    out = bam_open_writer(outfile, threads, level, template=bam)
     for read in bam_iter(bam):
         read_renamepair(read, delim)
         out.write(read)
@@ -36,9 +35,15 @@ def usage():
     print __doc__
     print """Usage: bamutils renamepair {opts} inbamfile outbamfile
 
+Use '-' to read from stdin or write to stdout.
+
 Options:
   -f           Force overwriting an existing outfile
   -delim val   The trailing delimiter to use (default '/')
+  -threads N   Use N threads to compress the output BAM file [default: 1]
+  -level N     Compression level for the output BAM file (0-9). Use 0 for
+               uncompressed output that will be piped to another program.
+               [default: 6]
 """
     sys.exit(-1)
 
@@ -48,19 +53,27 @@ if __name__ == "__main__":
     delim = '/'
     last = None
     force = False
+    threads = 1
+    level = None
 
     for arg in sys.argv[1:]:
         if last == '-delim':
             delim = arg
             last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
         elif arg == "-h":
             usage()
-        elif arg == "-delim":
+        elif arg in ["-delim", "-threads", "-level"]:
             last = arg
         elif arg == "-f":
             force = True
         elif not infile:
-            if os.path.exists(os.path.expanduser(arg)):
+            if bam_exists(os.path.expanduser(arg)):
                 infile = os.path.expanduser(arg)
             else:
                 sys.stderr.write("File: %s not found!" % arg)
@@ -79,4 +92,4 @@ if __name__ == "__main__":
     if not infile or not outfile:
         usage()
 
-    bam_renamepair(infile, outfile, delim)
+    bam_renamepair(infile, outfile, delim, threads, level)
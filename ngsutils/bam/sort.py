@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+## category General
+## desc Sorts a BAM file by coordinate or read name
+'''
+Sorts a BAM file by coordinate or read name
+
+Reads are loaded in chunks (up to the memory limit), sorted, and written to
+temporary files that are then merged together. The chunks can be sorted in
+parallel. The records are sorted without being decoded, so this is also
+usually faster than reading/writing the file with pysam.
+
+Coordinate sorted files are indexed (unless written to stdout). Reads without
+a reference are placed at the end of the file.
+
+Name sorted files are sorted by plain string comparison (the order that
+'bamutils merge' and 'bamutils pair' expect). Use -natural to sort names in
+natural order (read2 before read10), like 'samtools sort -n'. Reads with the
+same name (or position) are kept in the same order as the input file.
+'''
+
+import collections
+import multiprocessing
+import os
+import re
+import struct
+import sys
+
+import pysam
+
+from ngsutils.bam import RawBamReader, RawBamWriter, RawRead, bam_exists, bam_iter, bam_merge_sorted_runs, bam_merge_run_groups, bam_tmpname, read_coord_key
+
+# extra memory used by each read (RawRead, string and key overhead) while
+# a chunk is being sorted
+_READ_OVERHEAD = 200
+
+# temporary runs only need to be written/read once, so use fast compression
+_RUN_LEVEL = 1
+
+_digits = re.compile('([0-9]+)')
+
+
+def read_name_key(read):
+    return read.qname
+
+
+def read_natural_name_key(read):
+    '''
+    Sort key for natural name ordering (numbers are compared by value)
+
+    >>> class Read(object):
+    ...     def __init__(self, qname):
+    ...         self.qname = qname
+    >>> [x.qname for x in sorted([Read('r10'), Read('r2'), Read('r1:5'), Read('r1:10')], key=read_natural_name_key)]
+    ['r1:5', 'r1:10', 'r2', 'r10']
+    '''
+    parts = _digits.split(read.qname)
+    parts[1::2] = [int(x) for x in parts[1::2]]
+    return parts
+
+
+_keys = {
+    'coordinate': read_coord_key,
+    'name': read_name_key,
+    'natural': read_natural_name_key,
+}
+
+
+def parse_size(val):
+    '''
+    Parses a memory size (K/M/G suffixes are allowed)
+
+    >>> parse_size('100'), parse_size('2K'), parse_size('768M'), parse_size('1g')
+    (100, 2048, 805306368, 1073741824)
+    '''
+    mult = 1
+    if val[-1].upper() in 'KMG':
+        mult = 1024 ** ('KMG'.index(val[-1].upper()) + 1)
+        val = val[:-1]
+    return int(val) * mult
+
+
+def _sorted_header(header_data, sort_order):
+    'Returns the raw BAM header with the @HD SO tag set to sort_order'
+    l_text, = struct.unpack_from('<i', header_data, 4)
+    text = header_data[8:8 + l_text].rstrip('\0')
+
+    lines = [line for line in text.split('\n') if line]
+    if lines and lines[0].startswith('@HD'):
+        cols = [col for col in lines[0].split('\t') if not col.startswith('SO:')]
+        cols.append('SO:%s' % sort_order)
+        lines[0] = '\t'.join(cols)
+    else:
+        lines.insert(0, '@HD\tVN:1.0\tSO:%s' % sort_order)
+
+    text = ''.join(['%s\n' % line for line in lines])
+    return header_data[:4] + struct.pack('<i', len(text)) + text + header_data[8 + l_text:]
+
+
+def _write_reads(fname, header_data, reads, threads=1, level=None):
+    out = RawBamWriter(fname, header_data, threads, level)
+    for read in reads:
+        out.write(read)
+    out.close()
+
+
+def _sort_run(args):
+    'Sorts a chunk of raw records and writes it to a temporary file'
+    datas, order, header_data, tmpdir = args
+
+    reads = [RawRead(data) for data in datas]
+    del datas
+    reads.sort(key=_keys[order])
+
+    tmpname = bam_tmpname(tmpdir)
+    _write_reads(tmpname, header_data, reads, level=_RUN_LEVEL)
+    return tmpname
+
+
+def bam_sort(infile, outfile, order='coordinate', mem=768 * 1024 * 1024, procs=1, tmpdir=None, threads=1, level=None, index=True, max_files=64, quiet=False):
+    '''
+    Sorts a BAM file by 'coordinate', 'name', or 'natural' (name) order.
+
+    mem     - the (approximate) memory to use for sorting chunks. If procs > 1,
+              this is split between the processes.
+    tmpdir  - where to write the temporary sorted runs [default: the same
+              directory as outfile]
+
+    infile and outfile can be '-' for stdin/stdout (stdout is uncompressed,
+    unless a level is given).
+    '''
+    if order not in _keys:
+        raise ValueError('Unknown sort order: %s' % order)
+
+    bam = RawBamReader(infile)
+    header_data = _sorted_header(bam.header_data, 'coordinate' if order == 'coordinate' else 'queryname')
+
+    if tmpdir is None and outfile != '-':
+        tmpdir = os.path.dirname(os.path.abspath(outfile))
+
+    if outfile == '-' and level is None:
+        level = 0
+
+    tmpname = outfile if outfile == '-' else '%s.tmp' % outfile
+    chunk_size = max(mem / procs, 1)
+
+    pool = None
+    if procs > 1:
+        pool = multiprocessing.Pool(procs)
+
+    runs = []
+    pending = collections.deque()
+
+    try:
+        chunk = []
+        size = 0
+
+        for read in bam_iter(bam, quiet=quiet):
+            chunk.append(read.data)
+            size += len(read.data) + _READ_OVERHEAD
+
+            if size >= chunk_size:
+                task = (chunk, order, header_data, tmpdir)
+                if pool:
+                    # only one chunk per process is kept in memory
+                    if len(pending) >= procs:
+                        runs.append(pending.popleft().get())
+                    pending.append(pool.apply_async(_sort_run, (task,)))
+                else:
+                    runs.append(_sort_run(task))
+                chunk = []
+                size = 0
+
+        bam.close()
+
+        while pending:
+            runs.append(pending.popleft().get())
+
+        if pool:
+            pool.close()
+            pool.join()
+            pool = None
+
+        if not runs:
+            # everything fit in memory
+            reads = [RawRead(data) for data in chunk]
+            del chunk
+            reads.sort(key=_keys[order])
+            _write_reads(tmpname, header_data, reads, threads, level)
+
+        else:
+            if chunk:
+                runs.append(_sort_run((chunk, order, header_data, tmpdir)))
+                del chunk
+
+            bam_merge_run_groups(runs, _keys[order], tmpdir, max_files, _RUN_LEVEL)
+            _write_reads(tmpname, header_data, bam_merge_sorted_runs(runs, _keys[order], raw=True), threads, level)
+
+    finally:
+        if pool:
+            pool.terminate()
+
+        for run in runs:
+            if os.path.exists(run):
+                os.unlink(run)
+
+    if tmpname != outfile:
+        os.rename(tmpname, outfile)
+
+        if index and order == 'coordinate':
+            pysam.index(outfile)
+
+
+def usage(msg=None):
+    if msg:
+        print msg
+        print
+    print __doc__
+    print """\
+Usage: bamutils sort {opts} in.bam out.bam
+
+Use '-' to read a BAM file from stdin or write to stdout (uncompressed,
+unless -level is given).
+
+Options:
+  -n             Sort by read name
+  -natural       Sort by read name, in natural order
+
+  -m size        Memory to use for sorting (K/M/G suffixes allowed). This is
+                 approximate and is split between the processes.
+                 [default: 768M]
+
+  -p N           Sort chunks in N processes [default: 1]
+
+  -T dir         Use this directory for temporary files
+                 [default: same directory as out.bam]
+
+  -noindex       Don't index the coordinate sorted output file
+
+  -f             Force overwriting an existing out.bam file
+
+  -threads N     Use N threads to compress the output BAM file [default: 1]
+
+  -level N       Compression level for the output BAM file (0-9). Use 0 for
+                 uncompressed output that will be piped to another program.
+                 [default: 6]
+"""
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    infile = None
+    outfile = None
+    order = 'coordinate'
+    mem = 768 * 1024 * 1024
+    procs = 1
+    tmpdir = None
+    index = True
+    force = False
+    threads = 1
+    level = None
+    last = None
+
+    for arg in sys.argv[1:]:
+        if last == '-m':
+            mem = parse_size(arg)
+            last = None
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif last == '-T':
+            tmpdir = arg
+            last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
+        elif arg == '-h':
+            usage()
+        elif arg in ['-m', '-p', '-T', '-threads', '-level']:
+            last = arg
+        elif arg == '-n':
+            order = 'name'
+        elif arg == '-natural':
+            order = 'natural'
+        elif arg == '-noindex':
+            index = False
+        elif arg == '-f':
+            force = True
+        elif not infile and bam_exists(arg):
+            infile = arg
+        elif not outfile:
+            outfile = arg
+        else:
+            usage('Unknown argument: %s' % arg)
+
+    if not infile or not outfile:
+        usage()
+
+    if outfile != '-' and not force and os.path.exists(outfile):
+        sys.stderr.write('ERROR: %s already exists! Not overwriting without force (-f)\n\n' % outfile)
+        sys.exit(1)
+
+    bam_sort(infile, outfile, order, mem, procs, tmpdir, threads, level, index)
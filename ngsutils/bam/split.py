@@ -8,19 +8,24 @@ Given a BAM file, this script will split it into smaller BAM files with a
 limit on the number of reads included.
 
 Or it will also split a BAM file into a separate BAM file for each reference
-that is included.
+that is included, or for each value of a tag (such as the read group, RG).
+
+Reads are copied into the new files without being decoded or re-encoded.
 """
 
 import os
 import sys
-from ngsutils.bam import bam_iter
-import pysam
+import re
+import collections
+from multiprocessing.pool import ThreadPool
+from ngsutils.bam import bam_iter, RawBamReader, RawBamWriter, BamIndex
+from ngsutils.support.bgzip import BGZF_EOF
 
 
 def usage():
     print __doc__
     print """
-Usage: bamutils split {-n num | -ref} in.bam out_template_name
+Usage: bamutils split {-n num | -ref | -tag tag} in.bam out_template_name
 
 out_template_name will be the template for the smaller BAM files.  They will
 be named "out_template_name.N.bam" where out_template_name is the given
@@ -30,50 +35,179 @@ Options:
     -n      The number of reads to include in sub-files
             (default: 1000000)
 
-    -ref    Split by references
+    -ref    Split by references (uses the BAM index, if there is one)
+
+    -tag    Split by the value of a tag (ex: RG). Files are named
+            "out_template_name.value.bam". Reads without the tag are written
+            to "out_template_name.untagged.bam". Characters other than
+            letters, numbers and "_.+-" are replaced with "_". If two values
+            would then have the same name, the later one has a number added
+            (ex: "out_template_name.a_b.2.bam").
+
+Options for -tag:
+    -max N        Write at most N values to separate files. Reads with
+                  other values are written to "out_template_name.other.bam"
+
+    -open N       Keep at most N (>= 1) files open at once (default: 64)
+
+    -threads N    Use N threads to compress the output files (default: 1)
+
+    -level N      Compression level for the output files (0-9)
+
+With -tag, in.bam can be '-' to read a BAM file from stdin (-n and -ref need
+to read the file twice).
 """
     sys.exit(1)
 
 
 def bam_split(infile, out_template, read_count=1000000, reference=False, quiet=False):
-    bamfile = pysam.Samfile(infile, "rb")
-    outfile = None
+    '''
+    Splits a BAM file by read count or reference.
 
-    file_count = 0
-
-    count = 0
-    fname = ""
-    lastref = -1
-    for read in bam_iter(bamfile):
-        if not outfile or (not reference and count >= read_count) or (reference and lastref != read.tid):
-            if outfile:
-                outfile.close()
-            file_count += 1
-            count = 0
-            if reference:
-                if read.tid >= 0:
-                    fname = '%s.%s.bam' % (out_template, bamfile.getrname(read.tid))
-                else:
-                    fname = None
-            else:
-                fname = '%s.%s.bam' % (out_template, file_count)
-
-            if fname:
-                outfile = pysam.Samfile(fname, "wb", template=bamfile)
-            else:
-                outfile = None
-
-        if outfile:
-            outfile.write(read)
-            count += 1
-
-        lastref = read.tid
+    The boundaries between the files are found as virtual offsets (from the
+    BAM index for -ref, if there is one, otherwise by scanning the record
+    sizes). Records are then copied into the new files as raw BGZF data,
+    without being decoded.
+    '''
+    bamfile = RawBamReader(infile)
+    ranges = []
 
-    bamfile.close()
-    if outfile:
+    if reference:
+        if os.path.exists('%s.bai' % infile):
+            index = BamIndex('%s.bai' % infile)
+            for tid, meta in enumerate(index.meta):
+                if meta:
+                    ranges.append(('%s.%s.bam' % (out_template, bamfile.getrname(tid)), meta[0], meta[1]))
+        else:
+            lasttid = None
+            start = bamfile.tell()
+            while True:
+                pos = bamfile.tell()
+                try:
+                    read = bamfile.next()
+                except StopIteration:
+                    read = None
+
+                if read is None or read.tid != lasttid:
+                    if lasttid is not None and lasttid >= 0:
+                        ranges.append(('%s.%s.bam' % (out_template, bamfile.getrname(lasttid)), start, pos))
+                    if read is None:
+                        break
+                    lasttid = read.tid
+                    start = pos
+    else:
+        while True:
+            start = bamfile.tell()
+            if not bamfile.skip(read_count):
+                break
+            ranges.append(('%s.%s.bam' % (out_template, len(ranges) + 1), start, bamfile.tell()))
+
+    for fname, start, end in ranges:
+        outfile = RawBamWriter(fname, bamfile.header_data)
+        outfile.copy_range(infile, start, end)
         outfile.close()
+
+    bamfile.close()
+    if not quiet:
+        sys.stderr.write("Split into %s files" % (len(ranges)))
+
+
+def _tag_fname(out_template, value, used):
+    '''
+    Returns the file name for a tag value. Characters that can't be used in a
+    filename are replaced with '_'. If that gives a name that is already in
+    'used' (from another value, or the untagged/other files), a number is
+    added. Names are compared ignoring case (for case-insensitive file
+    systems).
+
+    >>> used = set(['untagged'])
+    >>> [_tag_fname('out', val, used) for val in ['a/b', 'a:b', 'A_B', 'a_b.2', 'untagged']]
+    ['out.a_b.bam', 'out.a_b.2.bam', 'out.A_B.3.bam', 'out.a_b.2.2.bam', 'out.untagged.2.bam']
+    '''
+    base = re.sub(r'[^A-Za-z0-9_.+-]', '_', value)
+    name = base
+    num = 1
+    while name.lower() in used:
+        num += 1
+        name = '%s.%s' % (base, num)
+
+    used.add(name.lower())
+    return '%s.%s.bam' % (out_template, name)
+
+
+def bam_split_tag(infile, out_template, tag, max_files=None, max_open=64, threads=1, level=None, quiet=False):
+    '''
+    Splits a BAM file by the value of a tag (such as RG) in one pass.
+
+    Each value is written to "out_template.value.bam". Reads without the tag
+    are written to "out_template.untagged.bam". If max_files is set, values
+    found after the first max_files are written to "out_template.other.bam".
+    Values that would share a file name get a number added (see: _tag_fname).
+
+    At most max_open files are kept open at once. When a file has to be
+    closed to make room, it is closed without an EOF marker, and re-opened
+    in append mode if more reads for it are found. All of the files share
+    one pool of 'threads' compression threads.
+    '''
+    if max_open < 1:
+        raise ValueError('max_open must be at least 1 (got %s)' % max_open)
+
+    bamfile = RawBamReader(infile)
+
+    if threads > 1:
+        pool = ThreadPool(threads)
+    else:
+        pool = None
+
+    values = {}
+    used = set(['untagged', 'other'] if max_files else ['untagged'])
+    created = set()
+    writers = collections.OrderedDict()  # in LRU order
+
+    for read in bam_iter(bamfile, quiet=quiet):
+        try:
+            value = str(read.opt(tag))
+        except KeyError:
+            value = None
+
+        if value is None:
+            fname = '%s.untagged.bam' % out_template
+        elif value in values:
+            fname = values[value]
+        elif max_files and len(values) >= max_files:
+            fname = '%s.other.bam' % out_template
+        else:
+            fname = _tag_fname(out_template, value, used)
+            values[value] = fname
+
+        writer = writers.pop(fname, None)
+        if not writer:
+            if len(writers) >= max_open:
+                oldname, old = writers.popitem(last=False)
+                old.close(eof=False)
+
+            writer = RawBamWriter(fname, bamfile.header_data, threads, level, append=fname in created, pool=pool)
+            created.add(fname)
+
+        writers[fname] = writer
+        writer.write(read)
+
+    for writer in writers.values():
+        writer.close()
+
+    # files that were closed to make room still need an EOF marker
+    for fname in created:
+        if fname not in writers:
+            with open(fname, 'ab') as f:
+                f.write(BGZF_EOF)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    bamfile.close()
     if not quiet:
-        sys.stderr.write("Split into %s files" % (file_count))
+        sys.stderr.write("Split into %s files" % (len(created)))
 
 
 if __name__ == '__main__':
@@ -81,17 +215,37 @@ if __name__ == '__main__':
     outfile = None
     num = 1000000
     reference = False
+    tag = None
+    max_files = None
+    max_open = 64
+    threads = 1
+    level = None
     last = None
 
     for arg in sys.argv[1:]:
         if last == '-n':
             num = int(arg)
             last = None
+        elif last == '-tag':
+            tag = arg
+            last = None
+        elif last == '-max':
+            max_files = int(arg)
+            last = None
+        elif last == '-open':
+            max_open = int(arg)
+            last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
         elif arg == '-ref':
             reference = True
         elif arg == '-h':
                 usage()
-        elif arg in ['-n']:
+        elif arg in ['-n', '-tag', '-max', '-open', '-threads', '-level']:
             last = arg
         elif not infile:
             infile = arg
@@ -100,5 +254,13 @@ if __name__ == '__main__':
 
     if not infile or not outfile:
         usage()
+    elif infile == '-' and not tag:
+        sys.stderr.write('Only -tag can read from stdin\n')
+        usage()
+    elif max_open < 1:
+        sys.stderr.write('-open must be at least 1\n')
+        usage()
+    elif tag:
+        bam_split_tag(infile, outfile, tag, max_files, max_open, threads, level)
     else:
         bam_split(infile, outfile, num, reference=reference)
@@ -5,12 +5,12 @@
 Calculates simple stats for a BAM file
 """
 
-import os
 import sys
-from ngsutils.bam import read_calc_mismatches, bam_iter, bam_open
+from ngsutils.bam import read_calc_mismatches, bam_iter, bam_open, bam_exists
 from ngsutils.gtf import GTF
 from ngsutils.support.regions import RegionTagger
 from ngsutils.support.stats import counts_mean_stdev
+from ngsutils.support.nameset import NameSet
 
 
 class FeatureBin(object):
@@ -103,6 +103,8 @@ def usage():
     print """
 Usage: bamutils stats {options} file1.bam {file2.bam...}
 
+Use '-' to read from stdin.
+
 If a region is given, only reads that map to that region will be counted.
 Regions should be be in the format: 'ref:start-end' or 'ref:start' using
 1-based start coordinates.
@@ -214,7 +216,7 @@ class BamStats(object):
         
         tlen_counts = {}
 
-        names = set()
+        names = NameSet()
         refs = {}
 
         tagbins = {}
@@ -530,7 +532,7 @@ if __name__ == '__main__':
             fillin_stats = False
         elif arg in ['-gtf', '-delim', '-tags', '-region']:
             last = arg
-        elif os.path.exists(arg):
+        elif bam_exists(arg):
             infiles.append(arg)
         else:
             sys.stderr.write('Unknown option: %s\n' % arg)
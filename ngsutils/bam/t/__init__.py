@@ -4,6 +4,10 @@ import ngsutils.bam.basecall
 import ngsutils.bed
 import StringIO
 import collections
+import os
+import random
+import struct
+import pysam
 
 PileupRecords = collections.namedtuple('PileupRecord', 'tid pos n pileups')
 PileupRead = collections.namedtuple('PileupRecord', 'alignment indel is_del is_head is_tail level qpos')
@@ -46,6 +50,73 @@ def _matches(valid, queries):
     return True
 
 
+def write_mappings(fname, names, seed=1):
+    '''
+    Writes a name-grouped BAM file (with the references from test.bam) that
+    has 1-4 mappings for each of 'names' read names, at random positions and
+    strands, with random AS and NM tags. About one in ten reads is unmapped.
+    The names are the same for every seed, so two files can be paired.
+    '''
+    rand = random.Random(seed)
+    bam = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+    reads = list(bam)
+    mapped = [read for read in reads if not read.is_unmapped]
+    unmapped = [read for read in reads if read.is_unmapped]
+
+    out = pysam.Samfile(fname, 'wb', template=bam)
+    for i in xrange(names):
+        for j in xrange(rand.randint(1, 4)):
+            if rand.random() < 0.1:
+                read = unmapped[0]
+            else:
+                read = rand.choice(mapped)
+                read.tid = rand.randint(0, 1)
+                read.pos = rand.randint(0, 1200)
+                read.is_reverse = rand.random() < 0.5
+                read.tags = [('AS', rand.randint(0, 3)), ('NM', rand.randint(0, 2))]
+
+            read.qname = 'read%05d' % i
+            out.write(read)
+
+    out.close()
+    bam.close()
+
+
+
+def strip_index_meta(fname):
+    '''
+    Rewrites a BAM index (.bai) without the pseudo-bins (reference ranges
+    and read counts) and the count of reads without coordinates, like an
+    index from an older samtools.
+    '''
+    with open(fname, 'rb') as f:
+        data = f.read()
+
+    n_ref, = struct.unpack_from('<i', data, 4)
+    out = [data[:8]]
+    pos = 8
+
+    for i in xrange(n_ref):
+        n_bin, = struct.unpack_from('<i', data, pos)
+        pos += 4
+        bins = []
+        for j in xrange(n_bin):
+            bin_num, n_chunk = struct.unpack_from('<Ii', data, pos)
+            size = 8 + 16 * n_chunk
+            if bin_num != 37450:
+                bins.append(data[pos:pos + size])
+            pos += size
+
+        n_intv, = struct.unpack_from('<i', data, pos)
+        size = 4 + 8 * n_intv
+        out.append(struct.pack('<i', len(bins)))
+        out.extend(bins)
+        out.append(data[pos:pos + size])
+        pos += size
+
+    with open(fname, 'wb') as f:
+        f.write(''.join(out))
+
 class MockBam(object):
     def __init__(self, refs, lengths=None, insert_order=False):
         self._refs = refs[:]
@@ -246,6 +317,10 @@ class MockRead(object):
                 return val
         return None
 
+    @property
+    def rlen(self):
+        return len(self.seq)
+
     @property
     def flag(self):
         return self._flag
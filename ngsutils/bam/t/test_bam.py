@@ -3,10 +3,14 @@
 Tests for bamutils / docutils
 '''
 
+import os
+import subprocess
+import sys
 import unittest
 import doctest
 
 import ngsutils.bam
+from ngsutils.bam.t import MockBam
 import ngsutils.bam.convertregion
 import ngsutils.bam.count.count
 
@@ -17,5 +21,258 @@ def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(ngsutils.bam.count.count))
     return tests
 
+
+class RawBamTest(unittest.TestCase):
+    fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+
+    def _fields(self, read):
+        return (read.qname, read.tid, read.pos, read.flag, read.mapq, read.cigar, read.is_reverse)
+
+    def testRead(self):
+        raw = ngsutils.bam.RawBamReader(self.fname)
+        bam = ngsutils.bam.bam_open(self.fname)
+
+        self.assertEqual(raw.references, bam.references)
+        self.assertEqual(raw.lengths, bam.lengths)
+        self.assertEqual([self._fields(x) for x in raw], [self._fields(x) for x in bam])
+        raw.close()
+        bam.close()
+
+    def testFetch(self):
+        raw = ngsutils.bam.RawBamReader(self.fname)
+        bam = ngsutils.bam.bam_open(self.fname)
+        for ref in bam.references:
+            for start, end in [(0, 1000), (0, 10), (20, 60), (90, 100)]:
+                self.assertEqual([x.qname for x in raw.fetch(ref, start, end)], [x.qname for x in bam.fetch(ref, start, end)])
+        raw.close()
+        bam.close()
+
+    def testIndexReadCount(self):
+        index = ngsutils.bam.BamIndex('%s.bai' % self.fname)
+        self.assertEqual(index.read_count(), 7)
+
+    def testWrite(self):
+        outname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+        raw = ngsutils.bam.RawBamReader(self.fname)
+        out = ngsutils.bam.RawBamWriter(outname, raw.header_data, threads=2)
+        for read in raw:
+            out.write(read)
+        out.close()
+        raw.close()
+
+        bam = ngsutils.bam.bam_open(self.fname)
+        bam2 = ngsutils.bam.bam_open(outname)
+        self.assertEqual([x.compare(y) for x, y in zip(bam, bam2)], [0] * 7)
+        bam.close()
+        bam2.close()
+        os.unlink(outname)
+
+
+
+class WriterTest(unittest.TestCase):
+    fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+    outname = os.path.join(os.path.dirname(__file__), 'tmp-writer.bam')
+
+    def _roundtrip(self, threads, level):
+        bam = ngsutils.bam.bam_open(self.fname)
+        out = ngsutils.bam.bam_open_writer(self.outname, threads, level, template=bam)
+        for read in bam:
+            out.write(read)
+        out.close()
+        bam.close()
+
+        bam = ngsutils.bam.bam_open(self.fname)
+        bam2 = ngsutils.bam.bam_open(self.outname)
+        self.assertEqual([x.compare(y) for x, y in zip(bam, bam2)], [0] * 7)
+        self.assertEqual(list(bam2), [])
+        bam.close()
+        bam2.close()
+
+        with open(self.outname, 'rb') as f:
+            return f.read(19)
+
+    def testThreaded(self):
+        self.assertNotEqual(self._roundtrip(4, 1)[18], '\x01')
+        # level 0: stored (uncompressed) blocks
+        self.assertEqual(self._roundtrip(4, 0)[18], '\x01')
+        self.assertEqual(self._roundtrip(1, 0)[18], '\x01')
+
+    def testNoDevFd(self):
+        isdir = os.path.isdir
+        stderr = sys.stderr
+        os.path.isdir = lambda x: False if x == '/dev/fd' else isdir(x)
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            self.assertNotEqual(self._roundtrip(4, 1)[18], '\x01')
+            self.assertEqual(self._roundtrip(4, 0)[18], '\x01')
+        finally:
+            sys.stderr.close()
+            os.path.isdir = isdir
+            sys.stderr = stderr
+
+    def testHelperError(self):
+        bam = ngsutils.bam.bam_open(self.fname)
+        missing = os.path.join(os.path.dirname(__file__), 'missing', 'tmp-writer.bam')
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        stderr = os.dup(2)
+        os.dup2(devnull, 2)
+        try:
+            def write():
+                out = ngsutils.bam.bam_open_writer(missing, 2, 1, template=bam)
+                for read in bam:
+                    out.write(read)
+                out.close()
+            self.assertRaises(IOError, write)
+        finally:
+            os.dup2(stderr, 2)
+            os.close(stderr)
+            os.close(devnull)
+            bam.close()
+
+    def tearDown(self):
+        if os.path.exists(self.outname):
+            os.unlink(self.outname)
+
+
+def _names_worker(args):
+    'Writes the reads in a range to n temporary files and returns the names'
+    fname, start, end, tmpdir, n = args
+    bam = ngsutils.bam.bam_open(fname)
+    tmpnames = [ngsutils.bam.bam_tmpname(tmpdir) for i in xrange(n)]
+    outs = [ngsutils.bam.bam_open_writer(tmpname, template=bam) for tmpname in tmpnames]
+
+    names = []
+    for reads in ngsutils.bam.bam_batch_range(bam, start, end):
+        names.append(reads[0].qname)
+        for read in reads:
+            for out in outs:
+                out.write(read)
+
+    bam.close()
+    for out in outs:
+        out.close()
+    return tmpnames, ''.join(names)
+
+
+class BatchPoolTest(unittest.TestCase):
+    path = os.path.dirname(__file__)
+    fname = os.path.join(path, 'tmp-batch.bam')
+    outname = os.path.join(path, 'tmp-batch-out.bam')
+
+    def setUp(self):
+        # test.bam, with more than one read for some names
+        bam = ngsutils.bam.bam_open(os.path.join(self.path, 'test.bam'))
+        out = ngsutils.bam.bam_open_writer(self.fname, template=bam)
+        for read, name in zip(bam, 'AABBBCD'):
+            read.qname = name
+            out.write(read)
+        out.close()
+        bam.close()
+
+    def tearDown(self):
+        for fname in [self.fname, self.outname]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def testNameOffsets(self):
+        raw = ngsutils.bam.RawBamReader(self.fname)
+        offsets = list(raw.name_offsets())
+        raw.close()
+        self.assertEqual([x[0] for x in offsets], ['A', 'B', 'C', 'D'])
+
+        raw = ngsutils.bam.RawBamReader(self.fname)
+        for name, pos in offsets:
+            raw.seek(pos)
+            self.assertEqual(raw.next().qname, name)
+        raw.close()
+
+    def testBatchOffsets(self):
+        bam = ngsutils.bam.bam_open(self.fname)
+        for reads, expected in [(1, ['A', 'B', 'C', 'D']), (2, ['A', 'B', 'CD']), (3, ['AB', 'CD']), (10, ['ABCD'])]:
+            offsets = list(ngsutils.bam.bam_batch_offsets(self.fname, reads))
+            self.assertEqual(offsets[-1][1], None)
+            self.assertEqual([''.join([x[0].qname for x in ngsutils.bam.bam_batch_range(bam, start, end)]) for start, end in offsets], expected)
+        bam.close()
+
+    def testPoolMap(self):
+        tasks = ((self.fname, start, end, self.path, 1) for start, end in ngsutils.bam.bam_batch_offsets(self.fname, 1))
+        results = ngsutils.bam.bam_pool_map(_names_worker, tasks, [self.outname], 2)
+        self.assertEqual(results, ['A', 'B', 'C', 'D'])
+
+        bam = ngsutils.bam.bam_open(self.fname)
+        out = ngsutils.bam.bam_open(self.outname)
+        self.assertEqual([x.compare(y) for x, y in zip(bam, out)], [0] * 7)
+        self.assertEqual(len(list(out)), 0)
+        bam.close()
+        out.close()
+
+    def testPoolMapLevels(self):
+        ''' Each output's header is written at its own level '''
+        failname = os.path.join(self.path, 'tmp-batch-fail.bam')
+        tasks = [(self.fname, start, end, self.path, 2) for start, end in ngsutils.bam.bam_batch_offsets(self.fname, 1)]
+        ngsutils.bam.bam_pool_map(_names_worker, tasks, [self.outname, failname], 2, [0, None])
+
+        with open(self.outname) as f:
+            out = f.read(19)
+        with open(failname) as f:
+            fail = f.read(19)
+        os.unlink(failname)
+
+        # the first block is stored (uncompressed) only for the level 0 output
+        self.assertEqual(out[18], '\x01')
+        self.assertNotEqual(fail[18], '\x01')
+
+
+class StdioTest(unittest.TestCase):
+    ''' '-' reads SAM/BAM from stdin and writes uncompressed BAM to stdout '''
+    script = '''
+import ngsutils.bam
+bam = ngsutils.bam.bam_open('-')
+out = ngsutils.bam.bam_open_writer('-', template=bam)
+for read in ngsutils.bam.bam_iter(bam):
+    out.write(read)
+out.close()
+'''
+
+    def _run(self, fname):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.join(os.path.dirname(__file__), '..', '..', '..')
+
+        with open(fname) as f:
+            proc = subprocess.Popen([sys.executable, '-c', self.script], stdin=f, stdout=subprocess.PIPE, env=env)
+            data = proc.communicate()[0]
+        self.assertEqual(proc.returncode, 0)
+
+        outname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+        with open(outname, 'wb') as f:
+            f.write(data)
+
+        bam = ngsutils.bam.bam_open(outname)
+        names = [x.qname for x in bam]
+        bam.close()
+        os.unlink(outname)
+
+        # uncompressed (level 0) BGZF block: a final, stored deflate block
+        self.assertEqual(data[:4], '\x1f\x8b\x08\x04')
+        self.assertEqual(data[18], '\x01')
+        return names
+
+    def testStdio(self):
+        names = ['A', 'B', 'E', 'C', 'D', 'F', 'Z']
+        self.assertEqual(self._run(os.path.join(os.path.dirname(__file__), 'test.bam')), names)
+        self.assertEqual(self._run(os.path.join(os.path.dirname(__file__), 'test.sam')), names)
+
+    def testFileSize(self):
+        fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        bam = ngsutils.bam.bam_open(fname)
+        self.assertEqual(ngsutils.bam.bam_file_size(bam), os.path.getsize(fname))
+        bam.close()
+
+        self.assertEqual(ngsutils.bam.bam_file_size(MockBam(['chr1'])), None)
+        self.assertTrue(ngsutils.bam.bam_exists('-'))
+        self.assertTrue(ngsutils.bam.bam_exists(fname))
+        self.assertFalse(ngsutils.bam.bam_exists('%s.missing' % fname))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils best
+'''
+
+import os
+import unittest
+
+import ngsutils.bam
+import ngsutils.bam.best
+from ngsutils.bam.t import MockRead, write_mappings
+
+path = os.path.dirname(__file__)
+inname = os.path.join(path, 'tmp-best-in.bam')
+
+
+def _reads(fname):
+    bam = ngsutils.bam.bam_open(fname)
+    reads = [str(read) for read in bam]
+    bam.close()
+    return reads
+
+
+class BestTest(unittest.TestCase):
+    def setUp(self):
+        self.fnames = [inname]
+        write_mappings(inname, 200)
+
+    def tearDown(self):
+        for fname in self.fnames:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def _best(self, **kwargs):
+        outname = os.path.join(path, 'tmp-best%s.bam' % len(self.fnames))
+        failname = os.path.join(path, 'tmp-best%s-fail.bam' % len(self.fnames))
+        self.fnames.extend([outname, failname])
+
+        ngsutils.bam.best.bam_best(inname, outname, failname, quiet=True, **kwargs)
+        return _reads(outname), _reads(failname)
+
+    def testBestReads(self):
+        reads = [MockRead(name, tid=0, pos=pos, tags=[('AS', AS), ('NM', NM)]) for name, pos, AS, NM in [('x', 1, 5, 1), ('y', 2, 5, 0), ('z', 3, 6, 2), ('w', 4, 6, 2)]]
+        best, failed = ngsutils.bam.best.best_reads(reads + [MockRead('u')])
+        self.assertEqual([x.qname for x in best], ['z', 'w'])
+        self.assertEqual([x.qname for x in failed], ['x', 'y'])
+
+        best, failed = ngsutils.bam.best.best_reads(reads, ['NM-', 'AS+'])
+        self.assertEqual([x.qname for x in best], ['y'])
+
+    def testPool(self):
+        ''' The output (and failed reads) from a pool of processes is the same as running serially '''
+        out, fail = self._best()
+        self.assertTrue(out and fail)
+        self.assertEqual(self._best(procs=2, batch_size=20), (out, fail))
+        self.assertEqual(self._best(procs=3, batch_size=1), (out, fail))
+
+
+if __name__ == '__main__':
+    unittest.main()
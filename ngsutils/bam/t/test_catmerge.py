@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils catmerge
+'''
+
+import os
+import unittest
+
+import pysam
+
+import ngsutils.bam
+import ngsutils.bam.catmerge
+
+path = os.path.dirname(__file__)
+outname = os.path.join(path, 'tmp-catmerge.bam')
+
+
+class CatMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.fnames = []
+
+    def tearDown(self):
+        for fname in self.fnames + [outname]:
+            for f in [fname, '%s.bai' % fname]:
+                if os.path.exists(f):
+                    os.unlink(f)
+
+    def _shards(self, names, chr2=None, index=True):
+        'Splits test.bam into shards, in the given order (optionally moving reads to chr2)'
+        bam = ngsutils.bam.bam_open(os.path.join(path, 'test.bam'))
+        reads = dict([(read.qname, read) for read in bam])
+        fnames = []
+
+        for shard in names:
+            fname = os.path.join(path, 'tmp-shard%s.bam' % len(self.fnames))
+            self.fnames.append(fname)
+            fnames.append(fname)
+
+            out = pysam.Samfile(fname, 'wb', template=bam)
+            for name in shard:
+                read = reads[name]
+                if chr2 and name in chr2:
+                    read.tid = 1
+                out.write(read)
+            out.close()
+
+            if index:
+                pysam.index(fname)
+
+        bam.close()
+        return fnames
+
+    def _merge(self, fnames):
+        result = ngsutils.bam.catmerge.bam_catmerge(fnames, outname)
+        bam = ngsutils.bam.bam_open(outname)
+        reads = [(x.qname, bam.getrname(x.tid) if x.tid > -1 else None, x.pos) for x in bam]
+        bam.close()
+        return result, reads
+
+    def testMerge(self):
+        ''' Shards over the same reference are merged (B and E have the same position) '''
+        result, reads = self._merge(self._shards(['ACFZ', 'BED']))
+        self.assertEqual(result, (0, 1))
+        self.assertEqual([x[0] for x in reads], ['A', 'B', 'E', 'C', 'D', 'F', 'Z'])
+
+        # unindexed files are merged in one pass (ties are in file order)
+        result, reads = self._merge(self._shards(['EF', 'ABZ', 'CD'], index=False))
+        self.assertEqual(result, (0, 1))
+        self.assertEqual([x[0] for x in reads], ['A', 'E', 'B', 'C', 'D', 'F', 'Z'])
+
+    def testCopy(self):
+        ''' Shards over different references are copied '''
+        fnames = self._shards(['EDF', 'ABCZ'], chr2='EDF')
+        result, reads = self._merge(fnames)
+        self.assertEqual(result, (2, 0))
+        self.assertEqual(reads, [('A', 'chr1', 99), ('B', 'chr1', 174), ('C', 'chr1', 424), ('E', 'chr2', 174), ('D', 'chr2', 474), ('F', 'chr2', 724), ('Z', None, -1)])
+        self.assertTrue(os.path.exists('%s.bai' % outname))
+
+        os.unlink('%s.bai' % fnames[0])
+        self.assertEqual(self._merge(fnames), ((0, 1), reads))
+
+    def testUnsorted(self):
+        fnames = self._shards(['AZ', 'FB'], index=False)
+        self.assertRaises(ValueError, ngsutils.bam.catmerge.bam_catmerge, fnames, outname)
+        self.assertFalse(os.path.exists('%s.tmp' % outname))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@ Tests for bamutils check
 '''
 
 import os
+import shutil
+import tempfile
 import unittest
 
 import ngsutils.bam
@@ -19,5 +21,33 @@ class CheckTest(unittest.TestCase):
         ret = ngsutils.bam.check.bam_check(os.path.join(os.path.dirname(__file__), 'test1.bam'), quiet=True)
         self.assertEqual(ret, False)
 
+    def testCheckFast(self):
+        fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        self.assertEqual(ngsutils.bam.check.bam_check(fname, quiet=True, fast=True, threads=2, sample=2), True)
+
+        fname = os.path.join(os.path.dirname(__file__), 'test1.bam')
+        self.assertEqual(ngsutils.bam.check.bam_check(fname, quiet=True, fast=True), False)
+
+    def testCheckFastCorrupt(self):
+        tmpdir = tempfile.mkdtemp()
+        fname = os.path.join(tmpdir, 'test.bam')
+        try:
+            shutil.copy(os.path.join(os.path.dirname(__file__), 'test.bam'), fname)
+            shutil.copy(os.path.join(os.path.dirname(__file__), 'test.bam.bai'), '%s.bai' % fname)
+            self.assertEqual(ngsutils.bam.check.bam_check_blocks(fname), None)
+
+            with open(fname, 'r+b') as f:
+                # CRC32 of the last data block
+                f.seek(int(os.stat(fname).st_size) - 28 - 8)
+                f.write('\0\0\0\0')
+            self.assertNotEqual(ngsutils.bam.check.bam_check_blocks(fname), None)
+
+            with open(fname, 'r+b') as f:
+                # missing EOF block
+                f.truncate(int(os.stat(fname).st_size) - 28)
+            self.assertNotEqual(ngsutils.bam.check.bam_check_blocks(fname), None)
+        finally:
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     unittest.main()
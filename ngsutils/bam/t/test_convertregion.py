@@ -67,6 +67,47 @@ class ConvertRegionTest(unittest.TestCase):
         self.assertFalse(foundC)
         self.assertFalse(foundZ)
 
+    def testConvertRegionSorted(self):
+        '''
+        Convert region/junction coordinates using multiple processes, sorted output (runs merged in groups)
+        '''
+        serialfname = os.path.join(os.path.dirname(__file__), 'tmp-convert-serial.bam')
+        ngsutils.bam.convertregion.bam_convertregion(infname, serialfname, chromsizes, overlap=0, quiet=True, sort=False)
+        ngsutils.bam.convertregion.bam_convertregion(infname, outfname, chromsizes, overlap=0, quiet=True, procs=2, chunksize=1, max_files=2)
+
+        bam = ngsutils.bam.bam_open(serialfname)
+        expected = sorted([str(x) for x in bam], key=lambda x: x.split('\t')[0])
+        bam.close()
+        os.unlink(serialfname)
+
+        bam = ngsutils.bam.bam_open(outfname)
+        reads = list(bam)
+        self.assertEqual(bam.header['HD']['SO'], 'coordinate')
+        self.assertEqual([ngsutils.bam.read_coord_key(x) for x in reads], sorted([ngsutils.bam.read_coord_key(x) for x in reads]))
+        self.assertEqual(sorted([str(x) for x in reads], key=lambda x: x.split('\t')[0]), expected)
+        bam.close()
+
+    def testConvertRegionPool(self):
+        '''
+        Convert region/junction coordinates using multiple processes, unsorted output (same as serial)
+        '''
+        serialfname = os.path.join(os.path.dirname(__file__), 'tmp-convert-serial.bam')
+        ngsutils.bam.convertregion.bam_convertregion(infname, serialfname, chromsizes, overlap=0, quiet=True, sort=False)
+
+        bam = ngsutils.bam.bam_open(serialfname)
+        expected = [str(x) for x in bam]
+        bam.close()
+        os.unlink(serialfname)
+
+        for batch_size in [1, 2, 100]:
+            ngsutils.bam.convertregion.bam_convertregion(infname, outfname, chromsizes, overlap=0, quiet=True, procs=2, sort=False, batch_size=batch_size)
+
+            bam = ngsutils.bam.bam_open(outfname)
+            self.assertEqual([str(x) for x in bam], expected)
+            bam.close()
+
+        self.assertTrue(expected)
+
     def tearDown(self):
         outfname = os.path.join(os.path.dirname(__file__), 'tmp-convert.bam')
         os.unlink(outfname)
@@ -4,14 +4,266 @@ Tests for bamutils filter
 '''
 
 import os
+import shutil
+import StringIO
+import sys
+import time
 import unittest
+import doctest
+
+import pysam
 
 import ngsutils.bam
 import ngsutils.bam.filter
-from ngsutils.bam.t import MockBam, MockRead
+from ngsutils.bam.t import MockBam, MockRead, write_mappings, strip_index_meta
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.filter))
+    return tests
 
 
 class FilterTest(unittest.TestCase):
+    def testFilterPlan(self):
+        ''' Criteria are reordered to check cheap/selective ones first '''
+        class Slow(object):
+            def filter(self, bam, read):
+                time.sleep(0.0005)
+                return True
+
+        class Odd(object):
+            def filter(self, bam, read):
+                return read.pos % 2 == 0
+
+        class Stateful(object):
+            stateful = True
+
+            def filter(self, bam, read):
+                return True
+
+        criteria = [Slow(), Odd(), Stateful(), Slow(), Odd()]
+        plan = ngsutils.bam.filter.FilterPlan(criteria, warmup=10)
+        for i in xrange(20):
+            criterion = plan.filter(None, MockRead('foo', tid=0, pos=i))
+            if i % 2 == 0:
+                self.assertEqual(criterion, None)
+            else:
+                self.assertTrue(isinstance(criterion, Odd))
+
+        self.assertEqual([x[0] for x in plan.summary()], [criteria[1], criteria[0], criteria[2], criteria[4], criteria[3]])
+
+        plan = ngsutils.bam.filter.FilterPlan(criteria, adaptive=False, warmup=10)
+        for i in xrange(20):
+            plan.filter(None, MockRead('foo', tid=0, pos=i))
+        self.assertEqual([x[0] for x in plan.summary()], criteria)
+
+    def testFilterRaw(self):
+        ''' Filters that don't need decoded reads copy the records as-is '''
+        fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        outname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+
+        criteria = [ngsutils.bam.filter.Mapped(), ngsutils.bam.filter.MaskFlag(16), ngsutils.bam.filter.TagLessThan('MAPQ', 10)]
+        self.assertTrue(all([c.raw for c in criteria]))
+        ngsutils.bam.filter.bam_filter(fname, outname, criteria, raw=True)
+        bam = ngsutils.bam.bam_open(outname)
+        raw_passed = [x.qname for x in bam]
+        bam.close()
+
+        # same result with a criterion that needs the decoded read
+        criteria.append(ngsutils.bam.filter.ReadMinLength(1))
+        ngsutils.bam.filter.bam_filter(fname, outname, criteria, raw=True)
+        bam = ngsutils.bam.bam_open(outname)
+        passed = [x.qname for x in bam]
+        bam.close()
+        os.unlink(outname)
+
+        self.assertEqual(raw_passed, passed)
+        self.assertTrue(len(passed) > 0)
+
+    def testFilterParallel(self):
+        ''' Filtering each reference in a separate process gives the same output '''
+        fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        outname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+        failedname = os.path.join(os.path.dirname(__file__), 'tmp.failed.txt')
+
+        specs = [('mask', ['0x10']), ('lt', ['MAPQ', '10'])]
+
+        results = []
+        for procs, raw in [(1, False), (2, False), (2, True)]:
+            ngsutils.bam.filter.bam_filter(fname, outname, specs, failedname, procs=procs, raw=raw)
+            bam = ngsutils.bam.bam_open(outname)
+            passed = [(x.qname, x.tid, x.pos) for x in bam]
+            bam.close()
+            with open(failedname) as f:
+                failed = f.read()
+            results.append((passed, failed))
+
+        os.unlink(outname)
+        os.unlink(failedname)
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        self.assertTrue(len(results[0][0]) > 0)
+        self.assertTrue(len(results[0][1]) > 0)
+
+    def testFilterParallelShards(self):
+        ''' Grouping references into shards (with the criteria reused by each worker) gives the same output '''
+        path = os.path.dirname(__file__)
+        inname = os.path.join(path, 'tmp-filter-in.bam')
+        fname = os.path.join(path, 'tmp-filter-sorted.bam')
+        outname = os.path.join(path, 'tmp.bam')
+        failedname = os.path.join(path, 'tmp.failed.txt')
+
+        write_mappings(inname, 300)
+        pysam.sort('-o', fname, inname)
+        pysam.index(fname)
+
+        specs = [('uniq', []), ('lt', ['AS', '1'])]
+
+        results = []
+        for procs, failed in [(1, None), (3, None), (1, failedname), (3, failedname)]:
+            ngsutils.bam.filter.bam_filter(fname, outname, specs, failed, procs=procs)
+            bam = ngsutils.bam.bam_open(outname)
+            passed = [str(x) for x in bam]
+            bam.close()
+            if failed:
+                with open(failed) as f:
+                    passed.append(f.read())
+            results.append(passed)
+
+        for name in [inname, fname, '%s.bai' % fname, outname, failedname]:
+            os.unlink(name)
+
+        self.assertTrue(len(results[0]) > 0)
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[3], results[2])
+
+    def testFilterParallelNoMeta(self):
+        ''' Without reference ranges in the index, -p filters in one process (same output and counts) '''
+        path = os.path.dirname(__file__)
+        fname = os.path.join(path, 'tmp_nometa.bam')
+        outname = os.path.join(path, 'tmp.bam')
+        shutil.copy(os.path.join(path, 'test.bam'), fname)
+        shutil.copy(os.path.join(path, 'test.bam.bai'), '%s.bai' % fname)
+        strip_index_meta('%s.bai' % fname)
+
+        specs = [('mask', ['0x10'])]
+        results = []
+        for procs in [1, 2]:
+            summary = StringIO.StringIO()
+            sys.stdout = summary
+            try:
+                ngsutils.bam.filter.bam_filter(fname, outname, specs, procs=procs)
+            finally:
+                sys.stdout = sys.__stdout__
+
+            bam = ngsutils.bam.bam_open(outname)
+            results.append(([x.qname for x in bam], summary.getvalue()))
+            bam.close()
+
+        out = StringIO.StringIO()
+        ngsutils.bam.filter.bam_filter_explain(fname, specs, out=out)
+
+        for name in [fname, '%s.bai' % fname, outname]:
+            os.unlink(name)
+
+        self.assertEqual(results[1], results[0])
+        self.assertTrue(results[0][0])
+        self.assertTrue('Reads in file: 7' in out.getvalue().split('\n'))
+
+    def testFilterRawRuns(self):
+        ''' Runs of passing reads that are copied as compressed blocks give the same output '''
+        path = os.path.dirname(__file__)
+        inname = os.path.join(path, 'tmp-filter-in.bam')
+        fname = os.path.join(path, 'tmp-filter-sorted.bam')
+        outname = os.path.join(path, 'tmp.bam')
+
+        write_mappings(inname, 300)
+        pysam.sort('-o', fname, inname)
+        pysam.index(fname)
+
+        run_size = ngsutils.bam.filter._RUN_COPY_SIZE
+        for specs in [[('mapped', [])], [('mapped', []), ('lt', ['AS', '3'])], [('gte', ['NM', '1']), ('minlen', ['10'])]]:
+            results = []
+            for raw, procs, size in [(False, 1, run_size), (True, 1, 1), (True, 3, 1), (True, 1, run_size)]:
+                ngsutils.bam.filter._RUN_COPY_SIZE = size
+                ngsutils.bam.filter.bam_filter(fname, outname, specs, raw=raw, procs=procs)
+                bam = ngsutils.bam.bam_open(outname)
+                results.append([str(x) for x in bam])
+                bam.close()
+
+            self.assertTrue(len(results[0]) > 0)
+            self.assertEqual(results[1], results[0])
+            self.assertEqual(results[2], results[0])
+            self.assertEqual(results[3], results[0])
+
+        ngsutils.bam.filter._RUN_COPY_SIZE = run_size
+        for name in [inname, fname, '%s.bai' % fname, outname]:
+            os.unlink(name)
+
+    def testFilterIncludeFetch(self):
+        ''' -include, -includeref and -includebed only read those regions (with an index) '''
+        fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        noidx = os.path.join(os.path.dirname(__file__), 'tmp_noidx.bam')
+        outname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+        bedname = os.path.join(os.path.dirname(__file__), 'tmp.bed')
+
+        shutil.copy(fname, noidx)
+        with open(bedname, 'w') as f:
+            f.write('chr1\t100\t150\nchr1\t170\t180\nchr1\t700\t730\nchr2\t10\t20\n')
+
+        for names in [[('IncludeRef', 'chr1')],
+                      [('IncludeRef', 'chr2')],
+                      [('IncludeRegion', 'chr1:100-200'), ('IncludeRegion', 'chr1:470-480')],
+                      [('IncludeBED', bedname, 'nostrand'), ('MaskFlag', 16)],
+                      ]:
+            # IncludeRegion keeps all of the regions in the class
+            del ngsutils.bam.filter.IncludeRegion._excludes[:]
+            criteria = [getattr(ngsutils.bam.filter, name)(*args) for name, args in [(x[0], x[1:]) for x in names]]
+
+            results = []
+            for infile in [fname, noidx]:
+                ngsutils.bam.filter.bam_filter(infile, outname, criteria)
+                bam = ngsutils.bam.bam_open(outname)
+                results.append([x.qname for x in bam])
+                bam.close()
+
+            self.assertEqual(results[0], results[1])
+
+        self.assertEqual(results[0], ['A', 'B', 'E', 'D'])
+        del ngsutils.bam.filter.IncludeRegion._excludes[:]
+
+        os.unlink(noidx)
+        os.unlink(outname)
+        os.unlink(bedname)
+
+    def testFilterExplain(self):
+        ''' -explain checks each criterion on a sample, without filtering '''
+        fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        noidx = os.path.join(os.path.dirname(__file__), 'tmp_noidx.bam')
+        shutil.copy(fname, noidx)
+
+        for infile in [fname, noidx]:
+            out = StringIO.StringIO()
+            ngsutils.bam.filter.bam_filter_explain(infile, [('mapped', []), ('mask', ['0x10'])], out=out)
+            lines = out.getvalue().split('\n')
+
+            self.assertTrue('Reads in file: 7' in lines)
+            self.assertTrue(lines[5].strip().startswith('85.71%'))
+            self.assertTrue(lines[5].endswith('-mapped'))
+            self.assertTrue(lines[6].strip().startswith('85.71%'))
+            self.assertTrue('All criteria: 71.43% pass' in lines)
+            self.assertTrue([x for x in lines if x.startswith('Estimated output: 5 reads')])
+
+        os.unlink(noidx)
+
+        bamfile = pysam.Samfile(fname, 'rb')
+        reads, secs, nbytes = ngsutils.bam.filter._sample_reads(bamfile, ngsutils.bam.BamIndex('%s.bai' % fname), 4, 2)
+        self.assertEqual([x.qname for x in reads], ['A', 'B', 'Z'])
+        bamfile.close()
+
+        self.assertRaises(ValueError, ngsutils.bam.filter.bam_filter_explain, '-', [('mapped', [])], out=StringIO.StringIO())
+
     def testUnique(self):
         ''' Unique sequences '''
         read1 = MockRead('foo1', tid=0, pos=1, seq='AAAAAAAAAAT')
@@ -72,6 +324,25 @@ class FilterTest(unittest.TestCase):
         self.assertTrue(uniqpos.filter(None, read6))
         self.assertFalse(uniqpos.filter(None, read7))
 
+        # old positions are removed once the reads are 100kb past them
+        self.assertEqual(sorted(uniqpos.rev_pos), [150011])
+        self.assertEqual(sum(uniqpos.rev_pos_bins.values(), []), [150011])
+
+    def testUniqueStartRevPruned(self):
+        'Uniq starts Rev (over many positions, with pruning)'
+        uniqpos = ngsutils.bam.filter.UniqueStart()
+        seen = set()
+        maxlen = 0
+        for pos in xrange(0, 1000000, 97):
+            for length in [50, 75, 50, (pos % 7) * 10 + 10]:
+                read = MockRead('foo', tid=0, pos=pos, is_reverse=True, aend=pos + length)
+                self.assertEqual(uniqpos.filter(None, read), not read.aend in seen)
+                seen.add(read.aend)
+            maxlen = max(maxlen, len(uniqpos.rev_pos))
+
+        self.assertEqual(len(uniqpos.rev_pos), len(sum(uniqpos.rev_pos_bins.values(), [])))
+        self.assertTrue(maxlen < 10000)
+
     def testBlacklist(self):
         'Blacklist'
         tmp_fname = os.path.join(os.path.dirname(__file__), 'tmp_list')
@@ -202,6 +473,42 @@ class FilterTest(unittest.TestCase):
 
         os.unlink(tmp_fname)
 
+    def testExcludeBEDSweep(self):
+        'Exclude BED - sorted reads (sweep) match the unsorted lookup'
+
+        tmp_fname = os.path.join(os.path.dirname(__file__), 'tmp_list')
+        with open(tmp_fname, 'w') as f:
+            for start in xrange(0, 5000, 170):
+                f.write('chr1\t%s\t%s\tfoo\t1\t%s\n' % (start, start + (start % 500) + 10, '+' if start % 3 else '-'))
+            f.write('chr2\t0\t100000\tfoo\t1\t+\n')
+
+        bam = MockBam(['chr1', 'chr2', 'chr3'])
+        reads = []
+        for tid in xrange(3):
+            for pos in xrange(0, 6000, 37):
+                reads.append(MockRead('foo', tid=tid, pos=pos, aend=pos + (pos % 250) + 1, is_reverse=pos % 2 == 0))
+
+        for nostrand in [None, 'nostrand']:
+            expected = []
+            for read in reads:
+                exclude = ngsutils.bam.filter.ExcludeBED(tmp_fname, nostrand)
+                exclude._sorted = False
+                expected.append(exclude.filter(bam, read))
+
+            exclude = ngsutils.bam.filter.ExcludeBED(tmp_fname, nostrand)
+            self.assertEqual([exclude.filter(bam, read) for read in reads], expected)
+            self.assertTrue(exclude._sorted)
+
+            # out of order reads switch to the lookup
+            exclude = ngsutils.bam.filter.ExcludeBED(tmp_fname, nostrand)
+            self.assertEqual([exclude.filter(bam, read) for read in reads[::-1]], expected[::-1])
+            self.assertFalse(exclude._sorted)
+
+            self.assertTrue(True in expected)
+            self.assertTrue(False in expected)
+
+        os.unlink(tmp_fname)
+
     def testMismatchRef(self):
         mismatch = ngsutils.bam.filter.MismatchRef(1, os.path.join(os.path.dirname(__file__), 'test.fa'))
 
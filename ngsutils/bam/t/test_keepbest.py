@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils keepbest
+'''
+
+import os
+import unittest
+import doctest
+
+import ngsutils.bam
+import ngsutils.bam.keepbest
+from ngsutils.bam.t import MockRead, write_mappings
+
+path = os.path.dirname(__file__)
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.keepbest))
+    return tests
+
+
+class KeepBestTest(unittest.TestCase):
+    def testKeepBestReads(self):
+        reads = [MockRead(name, tags=[('AS', score)], mapq=mapq) for name, score, mapq in [('x', 5, 10), ('y', 5, 30), ('z', 3, 30), ('w', 5, 20)]]
+        self.assertEqual([x.qname for x in ngsutils.bam.keepbest.keepbest_reads(reads)], ['x', 'y', 'w'])
+        self.assertEqual([x.qname for x in ngsutils.bam.keepbest.keepbest_reads(reads, 'MAPQ')], ['y', 'z'])
+        self.assertEqual([x.qname for x in ngsutils.bam.keepbest.keepbest_reads(reads, 'NM')], ['x', 'y', 'z', 'w'])
+        self.assertEqual(ngsutils.bam.keepbest.keepbest_reads([]), [])
+
+    def testPool(self):
+        ''' The output from a pool of processes is the same as running serially '''
+        inname = os.path.join(path, 'tmp-keepbest-in.bam')
+        fnames = [inname]
+        write_mappings(inname, 200)
+
+        outputs = []
+        for kwargs in [{}, {'procs': 2, 'batch_size': 20}, {'procs': 3, 'batch_size': 1}]:
+            outname = os.path.join(path, 'tmp-keepbest%s.bam' % len(fnames))
+            fnames.append(outname)
+            ngsutils.bam.keepbest.bam_keepbest(inname, outname, **kwargs)
+
+            bam = ngsutils.bam.bam_open(outname)
+            outputs.append([str(read) for read in bam])
+            bam.close()
+
+        for fname in fnames:
+            os.unlink(fname)
+
+        self.assertTrue(outputs[0])
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertEqual(outputs[2], outputs[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,9 @@ Tests for bamutils merge
 '''
 
 import os
+import sys
 import unittest
+import StringIO
 
 import ngsutils.bam
 import ngsutils.bam.merge
@@ -38,6 +40,51 @@ class MergeTest(unittest.TestCase):
             elif read.qname == 'Z':  # still unmapped
                 self.assertTrue(read.is_unmapped)
 
+    def testMergeUnmapped(self):
+        '''
+        Reads that are unmapped in all files are written (and counted) once
+        '''
+        fname1 = os.path.join(os.path.dirname(__file__), 'test.bam')
+        fname2 = os.path.join(os.path.dirname(__file__), 'test2.bam')
+        outfname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+
+        for readahead in [False, True]:
+            out = StringIO.StringIO()
+            sys.stdout = out
+            try:
+                ngsutils.bam.merge.bam_merge(outfname, [fname1, fname2], tags=['AS+'], readahead=readahead)
+            finally:
+                sys.stdout = sys.__stdout__
+
+            bam = ngsutils.bam.bam_open(outfname)
+            reads = [(x.qname, x.tid) for x in bam]
+            bam.close()
+
+            self.assertEqual(reads, [('A', 1), ('B', 0), ('B', 1), ('E', 1), ('C', 0), ('C', 1), ('D', 0), ('D', 1), ('F', 0), ('Z', -1)])
+            self.assertEqual(out.getvalue().split('\n')[-2], 'unmapped\t1')
+
+    def testMergeMissing(self):
+        '''
+        Reads that aren't in the first file (in the same order) are an error
+        '''
+        fname1 = os.path.join(os.path.dirname(__file__), 'test.bam')
+        fname2 = os.path.join(os.path.dirname(__file__), 'tmp-reversed.bam')
+        outfname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+
+        bam = ngsutils.bam.bam_open(fname1)
+        out = ngsutils.bam.bam_open_writer(fname2, template=bam)
+        for read in list(bam)[::-1]:
+            out.write(read)
+        out.close()
+        bam.close()
+
+        self.assertRaises(ValueError, ngsutils.bam.merge.bam_merge, outfname, [fname1, fname2], tags=['AS+'], quiet=True)
+        self.assertFalse(os.path.exists('%s.tmp' % outfname))
+        os.unlink(fname2)
+
+        # (tearDown removes tmp.bam)
+        open(outfname, 'w').close()
+
     def tearDown(self):
         outfname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
         os.unlink(outfname)
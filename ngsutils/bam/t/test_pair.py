@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils pair
+'''
+
+import os
+import random
+import unittest
+
+import ngsutils.bam
+import ngsutils.bam.pair
+from ngsutils.bam.t import MockRead, write_mappings
+
+path = os.path.dirname(__file__)
+
+
+def _find_pairs_all(reads1, reads2, min_size, max_size, tags):
+    'Checks every pair of mappings (what find_pairs should match)'
+    possible = []
+    valid = set()
+    reasons = {}
+
+    for r1 in reads1:
+        for r2 in reads2:
+            is_valid, reason = ngsutils.bam.pair.is_valid_pair(r1, r2)
+            if is_valid:
+                ins_size = max(r2.aend - r1.pos, r1.aend - r2.pos)
+                if ins_size < min_size or ins_size > max_size:
+                    is_valid = False
+                    reason = 'size'
+
+            if is_valid:
+                tag_val = []
+                for tag in tags:
+                    val = float(r1.opt(tag[:2])) + float(r2.opt(tag[:2]))
+                    tag_val.append(-val if tag[-1] == '+' else val)
+                possible.append((tag_val, ins_size, r1, r2))
+                valid.add((1, r1.tid, r1.pos))
+                valid.add((2, r2.tid, r2.pos))
+            else:
+                for key in [(1, r1.tid, r1.pos), (2, r2.tid, r2.pos)]:
+                    if not key in reasons:
+                        reasons[key] = set()
+                    reasons[key].add(reason)
+
+    fail1 = [(r1, reasons[(1, r1.tid, r1.pos)]) for r1 in reads1 if not (1, r1.tid, r1.pos) in valid]
+    fail2 = [(r2, reasons[(2, r2.tid, r2.pos)]) for r2 in reads2 if not (2, r2.tid, r2.pos) in valid]
+    return possible, fail1, fail2
+
+
+def _read(name, tid, pos, is_reverse=False, AS=0, NM=0):
+    return MockRead(name, 'A' * 50, tid=tid, pos=pos, cigar='50M', is_reverse=is_reverse, tags=[('AS', AS), ('NM', NM)])
+
+
+class FindPairsTest(unittest.TestCase):
+    def testFindPairs(self):
+        reads1 = [_read('foo', 0, 100, AS=10), _read('foo', 0, 1000, is_reverse=True), _read('foo', -1, -1), _read('foo', 1, 100)]
+        reads2 = [_read('foo', 0, 300, is_reverse=True, AS=5), _read('foo', 0, 120, is_reverse=True), _read('foo', 0, 50000, is_reverse=True), _read('foo', 0, 200)]
+
+        pairs, fail1, fail2 = ngsutils.bam.pair.find_pairs(reads1, reads2, 50, 10000, ['AS+'])
+        self.assertEqual([(x[0], x[1], x[2].pos, x[3].pos) for x in pairs], [([-15.0], 250, 100, 300), ([-10.0], 70, 100, 120), ([0.0], 850, 1000, 200)])
+        self.assertEqual([(x[0].pos, sorted(x[1])) for x in fail1], [(-1, ['unmapped']), (100, ['chromosome'])])
+        self.assertEqual([(x[0].pos, sorted(x[1])) for x in fail2], [(50000, ['chromosome', 'orientation', 'size', 'unmapped'])])
+
+    def testFindPairsRandom(self):
+        ''' Indexed mate matching finds the same pairs/reasons as checking every pair '''
+        rand = random.Random(1)
+
+        def reads():
+            return [_read('foo', rand.choice([-1, 0, 0, 0, 1]), rand.randint(0, 2000), rand.random() < 0.5, rand.randint(0, 5), rand.randint(0, 2)) for i in xrange(rand.randint(1, 20))]
+
+        def result(possible, fail1, fail2):
+            return ([(x[0], x[1], id(x[2]), id(x[3])) for x in possible], [(id(x[0]), x[1]) for x in fail1], [(id(x[0]), x[1]) for x in fail2])
+
+        for i in xrange(200):
+            reads1 = reads()
+            reads2 = reads()
+            min_size, max_size = rand.choice([(50, 10000), (50, 500), (300, 400)])
+
+            self.assertEqual(result(*ngsutils.bam.pair.find_pairs(reads1, reads2, min_size, max_size, ['AS+', 'NM-'])), result(*_find_pairs_all(reads1, reads2, min_size, max_size, ['AS+', 'NM-'])))
+
+
+class PairPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.read1 = os.path.join(path, 'tmp-pair-read1.bam')
+        self.read2 = os.path.join(path, 'tmp-pair-read2.bam')
+        self.fnames = [self.read1, self.read2]
+        write_mappings(self.read1, 200, seed=1)
+        write_mappings(self.read2, 200, seed=2)
+
+    def tearDown(self):
+        for fname in self.fnames:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def _pair(self, same_fail, **kwargs):
+        names = [os.path.join(path, 'tmp-pair%s-%s.bam' % (len(self.fnames), x)) for x in ['out', 'fail1', 'fail2']]
+        self.fnames.extend(names)
+        if same_fail:
+            names[2] = names[1]
+
+        ngsutils.bam.pair.bam_pair(names[0], self.read1, self.read2, fail1_fname=names[1], fail2_fname=names[2], reason_tag='ZR', quiet=True, **kwargs)
+
+        out = []
+        for fname in names:
+            bam = ngsutils.bam.bam_open(fname)
+            out.append([str(read) for read in bam])
+            bam.close()
+        return out
+
+    def testPool(self):
+        ''' The output (and failed reads) from a pool of processes is the same as running serially '''
+        for same_fail in [False, True]:
+            expected = self._pair(same_fail)
+            self.assertTrue(expected[0] and expected[1] and expected[2])
+            self.assertEqual(self._pair(same_fail, procs=2, batch_size=10), expected)
+            self.assertEqual(self._pair(same_fail, procs=3, batch_size=1), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils pipeline
+'''
+
+import os
+import unittest
+
+import ngsutils.bam
+import ngsutils.bam.pipeline
+
+
+class PipelineTest(unittest.TestCase):
+    def testPipeline(self):
+        fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        outname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+
+        specs = [('cleancigar', []), ('mapped', []), ('mask', ['0x10']), ('suffix', ['.1']), ('renamepair', ['.']), ('tag', ['XX:Z:foo'])]
+        stages = ngsutils.bam.pipeline.bam_pipeline(fname, outname, specs, out=None)
+
+        bam = ngsutils.bam.bam_open(outname)
+        reads = [(x.qname, x.opt('ZN'), x.opt('XX')) for x in bam]
+        bam.close()
+        os.unlink(outname)
+
+        self.assertEqual(reads, [('A', '1', 'foo'), ('B', '1', 'foo'), ('E', '1', 'foo'), ('C', '1', 'foo'), ('D', '1', 'foo')])
+
+        # the two criteria are one stage
+        self.assertEqual([x.name for x in stages], ['-cleancigar', '-mapped -mask 0x10', '-suffix .1', '-renamepair .', '-tag XX:Z:foo'])
+        self.assertEqual([(x.reads_in, x.reads_out, x.altered) for x in stages], [(7, 7, 0), (7, 5, None), (5, 5, None), (5, 5, 5), (5, 5, None)])
+
+    def testUnknownStage(self):
+        self.assertRaises(ValueError, ngsutils.bam.pipeline.build_pipeline, [('foo', [])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils sort
+'''
+
+import os
+import unittest
+import doctest
+
+import pysam
+
+import ngsutils.bam
+import ngsutils.bam.sort
+
+inname = os.path.join(os.path.dirname(__file__), 'tmp-sort-in.bam')
+outname = os.path.join(os.path.dirname(__file__), 'tmp-sort.bam')
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.sort))
+    return tests
+
+
+class SortTest(unittest.TestCase):
+    def setUp(self):
+        # test.bam, with new names and the mapped reads in reverse order
+        bam = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+        out = pysam.Samfile(inname, 'wb', template=bam)
+        for read, name, pos in zip(bam, ['r10', 'r2', 'r1', 'r20', 'r2', 'r11', 'r5'], [500, 400, 300, 300, 200, 100, -1]):
+            read.qname = name
+            read.pos = pos
+            out.write(read)
+        out.close()
+        bam.close()
+
+    def tearDown(self):
+        for fname in [inname, outname, '%s.bai' % outname]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def _sort(self, order, **kwargs):
+        ngsutils.bam.sort.bam_sort(inname, outname, order, quiet=True, **kwargs)
+        bam = ngsutils.bam.bam_open(outname)
+        reads = [(x.qname, x.pos) for x in bam]
+        so = bam.header['HD']['SO']
+        bam.close()
+        return reads, so
+
+    def testSortCoordinate(self):
+        expected = [('r11', 100), ('r2', 200), ('r1', 300), ('r20', 300), ('r2', 400), ('r10', 500), ('r5', -1)]
+        self.assertEqual(self._sort('coordinate'), (expected, 'coordinate'))
+        self.assertTrue(os.path.exists('%s.bai' % outname))
+
+        # one read per run, merged in more than one pass
+        self.assertEqual(self._sort('coordinate', mem=1, max_files=2), (expected, 'coordinate'))
+        self.assertEqual(self._sort('coordinate', mem=2, procs=2), (expected, 'coordinate'))
+
+    def testSortName(self):
+        expected = [('r1', 300), ('r10', 500), ('r11', 100), ('r2', 400), ('r2', 200), ('r20', 300), ('r5', -1)]
+        self.assertEqual(self._sort('name'), (expected, 'queryname'))
+        self.assertEqual(self._sort('name', mem=1, max_files=3), (expected, 'queryname'))
+        self.assertFalse(os.path.exists('%s.bai' % outname))
+
+    def testSortNatural(self):
+        expected = [('r1', 300), ('r2', 400), ('r2', 200), ('r5', -1), ('r10', 500), ('r11', 100), ('r20', 300)]
+        self.assertEqual(self._sort('natural'), (expected, 'queryname'))
+        self.assertEqual(self._sort('natural', mem=1, procs=2), (expected, 'queryname'))
+
+    def testSortedHeader(self):
+        bam = ngsutils.bam.RawBamReader(inname)
+        header = ngsutils.bam.sort._sorted_header(bam.header_data, 'queryname')
+        bam.close()
+
+        self.assertEqual(header[-8:], bam.header_data[-8:])
+        self.assertTrue('@HD\tVN:0.1.2\tGO:none\tSO:queryname\n@PG' in header)
+        self.assertFalse('unsorted' in header)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,21 @@ Tests for bamutils split
 '''
 
 import os
+import shutil
 import unittest
+import doctest
+
+import pysam
 
 import ngsutils.bam
 import ngsutils.bam.split
 
 
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.split))
+    return tests
+
+
 class SplitTest(unittest.TestCase):
     def testSplit(self):
         '''
@@ -50,12 +59,109 @@ class SplitTest(unittest.TestCase):
         self.assertTrue(foundE)
         self.assertFalse(foundOther)
 
+    def testSplitCount(self):
+        fname1 = os.path.join(os.path.dirname(__file__), 'test.bam')
+        outfname = os.path.join(os.path.dirname(__file__), 'tmp')
+        outfname1 = os.path.join(os.path.dirname(__file__), 'tmp.1.bam')
+        outfname2 = os.path.join(os.path.dirname(__file__), 'tmp.2.bam')
+
+        ngsutils.bam.split.bam_split(fname1, outfname, 4, quiet=True)
+
+        bam = ngsutils.bam.bam_open(outfname1)
+        self.assertEqual([x.qname for x in bam], ['A', 'B', 'E', 'C'])
+        bam.close()
+
+        bam = ngsutils.bam.bam_open(outfname2)
+        self.assertEqual([x.qname for x in bam], ['D', 'F', 'Z'])
+        bam.close()
+
+    def testSplitRef(self):
+        fname1 = os.path.join(os.path.dirname(__file__), 'test.bam')
+        outfname = os.path.join(os.path.dirname(__file__), 'tmp')
+
+        # with and without the index
+        tmpname = os.path.join(os.path.dirname(__file__), 'tmp.noindex.bam')
+        shutil.copy(fname1, tmpname)
+
+        for fname in [fname1, tmpname]:
+            bam = ngsutils.bam.bam_open(fname)
+            expected = {}
+            for read in bam:
+                if read.tid >= 0:
+                    expected.setdefault(bam.getrname(read.tid), []).append(read.qname)
+            bam.close()
+
+            ngsutils.bam.split.bam_split(fname, outfname, reference=True, quiet=True)
+            for ref in expected:
+                bam = ngsutils.bam.bam_open('%s.%s.bam' % (outfname, ref))
+                self.assertEqual([x.qname for x in bam], expected[ref])
+                bam.close()
+                os.unlink('%s.%s.bam' % (outfname, ref))
+
+        os.unlink(tmpname)
+
+    def testSplitTag(self):
+        fname = os.path.join(os.path.dirname(__file__), 'tmp.rg.bam')
+        outfname = os.path.join(os.path.dirname(__file__), 'tmp')
+
+        src = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+        out = pysam.Samfile(fname, 'wb', template=src)
+        expected = {'a': [], 'b': [], 'other': [], 'untagged': []}
+        for i, read in enumerate(src):
+            if i % 4 == 3:
+                read.tags = []
+                expected['untagged'].append(read.qname)
+            else:
+                read.tags = [('RG', 'abc'[i % 4])]
+                expected['other' if i % 4 == 2 else 'abc'[i % 4]].append(read.qname)
+            out.write(read)
+        out.close()
+        src.close()
+
+        # only one open file at a time, so each switch closes/re-opens
+        ngsutils.bam.split.bam_split_tag(fname, outfname, 'RG', max_files=2, max_open=1, quiet=True)
+
+        for val in expected:
+            bam = ngsutils.bam.bam_open('%s.%s.bam' % (outfname, val))
+            self.assertEqual([x.qname for x in bam], expected[val])
+            bam.close()
+            os.unlink('%s.%s.bam' % (outfname, val))
+
+        self.assertRaises(ValueError, ngsutils.bam.split.bam_split_tag, fname, outfname, 'RG', max_open=0, quiet=True)
+        os.unlink(fname)
+
+    def testSplitTagNames(self):
+        ''' Values that give the same file name (or the untagged name) go to separate files '''
+        fname = os.path.join(os.path.dirname(__file__), 'tmp.rg.bam')
+        outfname = os.path.join(os.path.dirname(__file__), 'tmp')
+
+        src = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+        out = pysam.Samfile(fname, 'wb', template=src)
+        expected = {'a_b': [], 'a_b.2': [], 'untagged': [], 'untagged.2': []}
+        for read, val, name in zip(src, ['a/b', 'a:b', None, 'untagged', 'a/b', 'a:b', None], ['a_b', 'a_b.2', 'untagged', 'untagged.2', 'a_b', 'a_b.2', 'untagged']):
+            read.tags = [('RG', val)] if val else []
+            expected[name].append(read.qname)
+            out.write(read)
+        out.close()
+        src.close()
+
+        ngsutils.bam.split.bam_split_tag(fname, outfname, 'RG', quiet=True)
+
+        for val in expected:
+            bam = ngsutils.bam.bam_open('%s.%s.bam' % (outfname, val))
+            self.assertEqual([x.qname for x in bam], expected[val])
+            bam.close()
+            os.unlink('%s.%s.bam' % (outfname, val))
+
+        os.unlink(fname)
+
     def tearDown(self):
         outfname1 = os.path.join(os.path.dirname(__file__), 'tmp.1.bam')
         outfname2 = os.path.join(os.path.dirname(__file__), 'tmp.2.bam')
 
-        os.unlink(outfname1)
-        os.unlink(outfname2)
+        for fname in [outfname1, outfname2]:
+            if os.path.exists(fname):
+                os.unlink(fname)
 
 if __name__ == '__main__':
     unittest.main()
@@ -14,18 +14,22 @@ Currently supported tags:
 '''
 import sys
 import os
-from ngsutils.bam import bam_iter, cigar_tostr
-import pysam
+from ngsutils.bam import bam_iter, cigar_tostr, bam_open, bam_open_writer, bam_exists
 
 
 class BamWriter(object):
-    def __init__(self, outname, infname):
+    def __init__(self, outname, infname, threads=1, level=None):
         self.outname = outname
-        self.inbam = pysam.Samfile(infname, "rb")
+        self.inbam = bam_open(infname)
+        self.threads = threads
+        self.level = level
 
     def run_chain(self, chain):
-        tmp = os.path.join(os.path.dirname(self.outname), '.tmp.%s' % os.path.basename(self.outname))
-        outbam = pysam.Samfile(tmp, 'wb', template=self.inbam)
+        if self.outname == '-':
+            tmp = self.outname
+        else:
+            tmp = os.path.join(os.path.dirname(self.outname), '.tmp.%s' % os.path.basename(self.outname))
+        outbam = bam_open_writer(tmp, self.threads, self.level, template=self.inbam)
 
         for read in chain.filter(self.inbam):
             outbam.write(read)
@@ -33,9 +37,10 @@ class BamWriter(object):
         self.inbam.close()
         outbam.close()
 
-        if os.path.exists(outfname):
-            os.unlink(outfname)  # Not really needed on *nix
-        os.rename(tmp, outfname)
+        if tmp != self.outname:
+            if os.path.exists(self.outname):
+                os.unlink(self.outname)  # Not really needed on *nix
+            os.rename(tmp, self.outname)
 
 
 
@@ -164,8 +169,8 @@ def usage():
 Usage: bamutils tag {opts} in.bamfile out.bamfile
 
 Arguments:
-  in.bamfile    The input BAM file
-  out.bamfile   The name of the new output BAM file
+  in.bamfile    The input BAM file (or '-' for stdin)
+  out.bamfile   The name of the new output BAM file (or '-' for stdout)
 
 Options:
   -suffix suff     A suffix to add to each read name
@@ -185,6 +190,13 @@ Options:
   -orig-cigar tag  Add a new tag with the original CIGAR alignment
 
   -f               Force overwriting the output BAM file if it exists
+
+  -threads N       Use N threads to compress the output BAM file
+                   [default: 1]
+
+  -level N         Compression level for the output BAM file (0-9). Use 0
+                   for uncompressed output that will be piped to another
+                   program. [default: 6]
 """
     sys.exit(1)
 
@@ -192,6 +204,8 @@ if __name__ == "__main__":
     infname = None
     outfname = None
     force = False
+    threads = 1
+    level = None
     last = None
 
     args = []
@@ -217,11 +231,17 @@ if __name__ == "__main__":
         elif last == '-junction':
             args.append([PredictJunction, arg])
             last = None
-        elif arg in ['-suffix', '-tag', '-orig-ref', '-orig-pos', '-orig-cigar', '-junction']:
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            last = None
+        elif arg in ['-suffix', '-tag', '-orig-ref', '-orig-pos', '-orig-cigar', '-junction', '-threads', '-level']:
             last = arg
         elif arg == '-xs':
             args.append([CufflinksXS, ])
-        elif not infname and os.path.exists(arg):
+        elif not infname and bam_exists(arg):
             infname = arg
         elif not outfname:
             outfname = arg
@@ -233,7 +253,7 @@ if __name__ == "__main__":
         sys.stderr.write('ERROR: %s already exists! Not overwriting without force (-f)\n\n' % outfname)
         sys.exit(1)
 
-    writer = BamWriter(outfname, infname)
+    writer = BamWriter(outfname, infname, threads, level)
 
     chain = BamReader()
     for arg in args:
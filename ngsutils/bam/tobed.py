@@ -5,16 +5,15 @@
 Convert BAM reads to BED regions
 '''
 import sys
-import os
-from ngsutils.bam import bam_iter
-import pysam
+from ngsutils.bam import bam_iter, bam_open, bam_exists
 
 
 def bam_tobed(fname, out=sys.stdout):
-    bamfile = pysam.Samfile(fname, "rb")
+    bamfile = bam_open(fname)
 
     for read in bam_iter(bamfile):
-        write_read(read, bamfile.getrname(read.rname), out)
+        if not read.is_unmapped:
+            write_read(read, bamfile.getrname(read.rname), out)
     bamfile.close()
 
 
@@ -28,11 +27,12 @@ def usage():  # pragma: no cover
     print """\
 Usage: bamutils tobed bamfile
 
-Ouputs the read positions of all mapped reads in BED6 format.
+Ouputs the read positions of all mapped reads in BED6 format. Use '-' to read
+from stdin.
 """
 
 if __name__ == "__main__":  # pragma: no cover
-    if len(sys.argv) < 2 or not os.path.exists(sys.argv[-1]):
+    if len(sys.argv) < 2 or not bam_exists(sys.argv[-1]):
         usage()
         sys.exit(1)
 
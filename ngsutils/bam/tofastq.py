@@ -6,8 +6,7 @@ Convert BAM reads back to FASTA/FASTQ sequences (mapped or unmapped)
 '''
 
 import sys
-import os
-from ngsutils.bam import bam_iter, bam_open
+from ngsutils.bam import bam_iter, bam_open, bam_exists
 from ngsutils.support import revcomp
 
 
@@ -93,6 +92,8 @@ def usage(fastq=True):
         print "Usage: bamutils tofasta {opts} file.bam"
 
     print """
+Use '-' to read from stdin.
+
 Options:
     -cs        Output color-space sequences
     -mapped    Only output mapped sequences
@@ -134,7 +135,7 @@ def main(fastq=True):
             if not mapped:
                 usage()
             unmapped = False
-        elif os.path.exists(arg):
+        elif bam_exists(arg):
             samf = arg
     if not samf:
         usage()
@@ -10,11 +10,11 @@ class BedStreamer(object):
     Note - this can only be used once! There is no mechanism to seek the stream.
     '''
 
-    def __init__(self, fname=None, fileobj=None, quiet=False):
+    def __init__(self, fname=None, fileobj=None, quiet=False, threads=1):
         if not fname and not fileobj:
             raise ValueError("You must specify either fname or fileobj!")
 
-        self.reader = ngsutils.support.gzip_reader(fname=fname, quiet=quiet, fileobj=fileobj)
+        self.reader = ngsutils.support.gzip_reader(fname=fname, quiet=quiet, fileobj=fileobj, threads=threads)
 
     def __iter__(self):
         return self
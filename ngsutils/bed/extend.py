@@ -20,6 +20,8 @@ Usage: bedutils extend {opts} bedfile
 Options:
     -5 SIZE     Extend the region SIZE bases in the 5' direction
     -3 SIZE     Extend the region SIZE bases in the 5' direction
+    -threads N  Use N threads to decompress a BGZF (bgzip) compressed
+                bedfile [default: 1]
 
 SIZE is how much the region should be extended in the corresponding
 direction. If the first character of SIZE is '=', then the region is
@@ -74,6 +76,7 @@ if __name__ == '__main__':
     ext_5 = None
     ext_3 = None
     exact = False
+    threads = 1
 
     last = None
 
@@ -94,7 +97,10 @@ if __name__ == '__main__':
             else:
                 ext_3 = int(arg)
             last = None
-        elif arg in ['-5', '-3']:
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif arg in ['-5', '-3', '-threads']:
             last = arg
         elif not fname and (os.path.exists(arg) or arg == '-'):
             fname = arg
@@ -111,4 +117,4 @@ if __name__ == '__main__':
     if ext_5 and ext_3 and exact:
         usage("You can't specify an exact length and 5' and 3' extensions!")
 
-    bed_extend(BedStreamer(fname), ext_5, ext_3, exact)
+    bed_extend(BedStreamer(fname, threads=threads), ext_5, ext_3, exact)
@@ -30,6 +30,9 @@ Usage: bedutils reduce {opts} bedfile
                     together.
 
 -nostrand           Ignore strand information when merging regions
+
+-threads N          Use N threads to decompress a BGZF (bgzip) compressed
+                    bedfile [default: 1]
 """
     sys.exit(1)
 
@@ -160,6 +163,7 @@ if __name__ == '__main__':
     count = False
     last = None
     clip = False
+    threads = 1
 
     for arg in sys.argv[1:]:
         if arg == '-h':
@@ -170,7 +174,10 @@ if __name__ == '__main__':
             else:
                 extend = [int(arg), ] * 2
             last = None
-        elif arg in ['-extend']:
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif arg in ['-extend', '-threads']:
             last = arg
         elif arg == '-clip':
             clip = True
@@ -187,4 +194,4 @@ if __name__ == '__main__':
     if not fname:
         usage()
 
-    bed_reduce(BedStreamer(fname), extend, stranded, count, clip)
+    bed_reduce(BedStreamer(fname, threads=threads), extend, stranded, count, clip)
@@ -12,14 +12,15 @@ import sys
 import os
 from ngsutils.bed import BedFile
 from ngsutils.support import revcomp
+from ngsutils.support.refcache import CachedFastaFile
 import pysam
 
 
-def bed_tofasta(bed, ref_fasta, min_size=50, stranded=True, include_name=False, out=sys.stdout):
+def bed_tofasta(bed, ref_fasta, min_size=50, stranded=True, include_name=False, out=sys.stdout, verbose=False):
     if not os.path.exists('%s.fai' % ref_fasta):
         pysam.faidx(ref_fasta)
 
-    fasta = pysam.Fastafile(ref_fasta)
+    fasta = CachedFastaFile(ref_fasta)
 
     refs = set()
     with open('%s.fai' % ref_fasta) as f:
@@ -40,13 +41,15 @@ def bed_tofasta(bed, ref_fasta, min_size=50, stranded=True, include_name=False,
             else:
                 out.write('>%s%s:%d-%d\n%s\n' % (name, region.chrom, region.start, region.end, seq))
 
+    if verbose:
+        sys.stderr.write('Reference cache: %s\n' % fasta.stats())
     fasta.close()
 
 
 def usage():
     print __doc__
     print """\
-Usage: bedutils tofasta {-min size} {-name} {-ns} bedfile ref.fasta
+Usage: bedutils tofasta {-min size} {-name} {-ns} {-v} bedfile ref.fasta
 
 Outputs the sequences of each BED region to FASTA format.
 
@@ -61,6 +64,8 @@ Option:
         coordinates will be exported).
 
 -ns     Ignore the strand of a region (always return seq from the + strand)
+
+-v      Verbose (show the reference cache statistics)
 """
 
 if __name__ == "__main__":
@@ -70,6 +75,7 @@ if __name__ == "__main__":
     ref = None
     stranded = True
     include_name = False
+    verbose = False
 
     last = None
     for arg in sys.argv[1:]:
@@ -82,6 +88,8 @@ if __name__ == "__main__":
             include_name = True
         elif arg == '-ns':
             stranded = False
+        elif arg == '-v':
+            verbose = True
         elif not bed and os.path.exists(arg):
             bed = arg
         elif not ref and os.path.exists(arg):
@@ -91,4 +99,4 @@ if __name__ == "__main__":
         usage()
         sys.exit(1)
 
-    bed_tofasta(BedFile(bed), ref, min_size=min_size, stranded=stranded, include_name=include_name)
+    bed_tofasta(BedFile(bed), ref, min_size=min_size, stranded=stranded, include_name=include_name, verbose=verbose)
@@ -1,11 +1,11 @@
 
 import sys
 import os
-import gzip
 import re
 import math
 import collections
 from eta import ETA
+from ngsutils.support.bgzip import bgzf_open, progress_fileobj
 
 
 class FASTQRead(collections.namedtuple('FASTQRead', 'name comment seq qual')):
@@ -59,7 +59,7 @@ def fastq_read_file(fileobj):
 
 
 class FASTQ(object):
-    def __init__(self, fname=None, fileobj=None):
+    def __init__(self, fname=None, fileobj=None, threads=1):
         self.fname = fname
         self._is_paired = None
         self._is_colorspace = None
@@ -70,14 +70,14 @@ class FASTQ(object):
             if fname == '-':
                 self.fileobj = sys.stdin
             elif fname[-3:] == '.gz' or fname[-4:] == '.bgz':
-                self.fileobj = gzip.open(os.path.expanduser(fname))
+                self.fileobj = bgzf_open(fname, threads)
             else:
                 self.fileobj = open(os.path.expanduser(fname))
         else:
             raise ValueError("Must pass either a fileobj or fname!")
 
     def tell(self):
-        # always relative to uncompressed...
+        # relative to uncompressed, or a virtual offset for BGZF files
         return self.fileobj.tell()
 
     def seek(self, pos, whence=0):
@@ -85,7 +85,7 @@ class FASTQ(object):
 
     def fetch(self, quiet=False, callback=None):
         if self.fname and not quiet:
-            eta = ETA(os.stat(self.fname).st_size, fileobj=self.fileobj)
+            eta = ETA(os.stat(self.fname).st_size, fileobj=progress_fileobj(self.fileobj))
         else:
             eta = None
 
@@ -10,6 +10,7 @@ import sys
 import os
 
 from ngsutils.fastq import FASTQ
+from ngsutils.support.nameset import NameSet, read_names
 
 
 def fastq_filter(filter_chain, stats_fname=None, out=sys.stdout, quiet=False):
@@ -393,13 +394,7 @@ class WhitelistFilter(object):
         self.verbose = verbose
         self.discard = discard
 
-        self.whitelist = set()
-        with open(fname) as f:
-            for line in f:
-                name = line.strip()
-                if name[0] == '@':
-                    name = name[1:]
-                self.whitelist.add(name)
+        self.whitelist = NameSet(name[1:] if name[0] == '@' else name for name in read_names(fname))
         sys.stderr.write('%s reads in whitelist\n' % len(self.whitelist))
 
     def filter(self):
@@ -424,6 +419,8 @@ Options:
   -illumina                   Use Illumina scaling for quality values
                               (-qual filter) [default: Sanger-scale]
   -stats filename             Write filter stats out to a file
+  -threads N                  Use N threads to decompress a BGZF (bgzip)
+                              compressed file [default: 1]
   -v                          Verbose
 
 Filters:
@@ -464,6 +461,7 @@ if __name__ == '__main__':
     veryverbose = False
     illumina = False
     filters_config = []
+    threads = 1
 
     last = None
     args = None
@@ -518,7 +516,10 @@ if __name__ == '__main__':
         elif last == '-discard':
             discard_fname = arg
             last = None
-        elif arg in ['-wildcard', '-size', '-qual', '-suffixqual', '-trim', '-stats', '-discard', '-whitelist', '-truncate', '-prefix']:
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif arg in ['-wildcard', '-size', '-qual', '-suffixqual', '-trim', '-stats', '-discard', '-whitelist', '-truncate', '-prefix', '-threads']:
             last = arg
         elif arg == '-illumina':
             illumina = True
@@ -546,7 +547,7 @@ if __name__ == '__main__':
 
         discard = _callback
 
-    fq = FASTQ(fname)
+    fq = FASTQ(fname, threads=threads)
 
     chain = FASTQReader(fq, veryverbose)
     for config in filters_config:
@@ -21,22 +21,35 @@ def export_names(fastq, include_comment=False, out=sys.stdout, quiet=False):
 
 def usage():
     print __doc__
-    print "Usage: fastqutils names {-comment} filename.fastq{.gz}"
+    print """Usage: fastqutils names {opts} filename.fastq{.gz}
+
+Options:
+  -comment    Include the comment with the read name
+  -threads N  Use N threads to decompress a BGZF (bgzip) compressed file
+              [default: 1]
+"""
     sys.exit(1)
 
 if __name__ == '__main__':
     fname = None
     include_comment = False
+    threads = 1
+    last = None
 
     for arg in sys.argv[1:]:
-        if arg == '-comment':
+        if last == '-threads':
+            threads = int(arg)
+            last = None
+        elif arg == '-comment':
             include_comment = True
+        elif arg == '-threads':
+            last = arg
         elif os.path.exists(arg):
             fname = arg
 
     if not fname:
         usage()
 
-    fq = FASTQ(fname)
+    fq = FASTQ(fname, threads=threads)
     export_names(fq, include_comment)
     fq.close()
@@ -217,26 +217,39 @@ def stats_counts(counts):
 
 def usage():
     print __doc__
-    print "Usage: fastqutils stats filename.fastq{.gz}"
+    print """Usage: fastqutils stats {opts} filename.fastq{.gz}
+
+Options:
+  -v          Verbose output
+  -threads N  Use N threads to decompress a BGZF (bgzip) compressed file
+              [default: 1]
+"""
     sys.exit(1)
 
 
 if __name__ == '__main__':
     fname = None
     verbose = False
+    threads = 1
+    last = None
 
     for arg in sys.argv[1:]:
-        if arg == '-v':
+        if last == '-threads':
+            threads = int(arg)
+            last = None
+        elif arg == '-v':
             verbose = True
         elif arg == '-h':
             usage()
+        elif arg == '-threads':
+            last = arg
         elif os.path.exists(arg):
             fname = arg
 
     if not fname:
         usage()
 
-    fq = FASTQ(fname)
+    fq = FASTQ(fname, threads=threads)
     stats = fastq_stats(fq)
     stats.dump(verbose=verbose)
     fq.close()
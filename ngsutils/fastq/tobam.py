@@ -54,7 +54,9 @@ def usage():
 Note: If two FASTQ files are given, they are assumed to be paired end reads.
 
 Options:
-  -f    Force overwriting output file
+  -f            Force overwriting output file
+  -threads N    Use N threads to decompress BGZF (bgzip) compressed files
+                [default: 1]
 
 """
     sys.exit(1)
@@ -65,10 +67,17 @@ if __name__ == '__main__':
     read2_fname = None
 
     force = False
+    threads = 1
+    last = None
 
     for arg in sys.argv[1:]:
-        if arg == '-f':
+        if last == '-threads':
+            threads = int(arg)
+            last = None
+        elif arg == '-f':
             force = True
+        elif arg == '-threads':
+            last = arg
         elif not outname:
             if not force and os.path.exists(arg):
                 usage('Output file exists! (Use -f to force overwriting): %s' % arg)
@@ -81,8 +90,8 @@ if __name__ == '__main__':
     if not outname or not read1_fname:
         usage()
 
-    read1 = FASTQ(read1_fname)
-    read2 = FASTQ(read2_fname) if read2_fname else None
+    read1 = FASTQ(read1_fname, threads=threads)
+    read2 = FASTQ(read2_fname, threads=threads) if read2_fname else None
 
     bam = pysam.Samfile(outname, 'wb')
     export_bam(bam, read1, read2)
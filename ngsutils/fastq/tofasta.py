@@ -23,25 +23,34 @@ def export_fasta(fastq, qual=False, out=sys.stdout, quiet=False):
 
 
 def usage():
-    print """Usage: fastqutils tofasta {-qual} filename.fastq{.gz}
+    print """Usage: fastqutils tofasta {opts} filename.fastq{.gz}
 Options:
-  -qual    Export the quality values (space separated numbers)
+  -qual       Export the quality values (space separated numbers)
+  -threads N  Use N threads to decompress a BGZF (bgzip) compressed file
+              [default: 1]
 """
     sys.exit(1)
 
 if __name__ == '__main__':
     qual = False
     fname = None
+    threads = 1
+    last = None
 
     for arg in sys.argv[1:]:
-        if arg == '-qual':
+        if last == '-threads':
+            threads = int(arg)
+            last = None
+        elif arg == '-qual':
             qual = True
+        elif arg == '-threads':
+            last = arg
         elif os.path.exists(arg):
             fname = arg
 
     if not fname:
         usage()
 
-    fq = FASTQ(fname)
+    fq = FASTQ(fname, threads=threads)
     export_fasta(fq, qual)
     fq.close()
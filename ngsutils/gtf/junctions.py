@@ -18,19 +18,15 @@ sufficient overlap with the junction is established when reads are mapped.
 
 import os
 import sys
-import pysam
 from ngsutils.gtf import GTF
+from ngsutils.support.refcache import CachedFastaFile
 from eta import ETA
 
 
 def gtf_junctions(gtf, refname, fragment_size, min_size, max_exons=5, known=False, out=sys.stdout, quiet=False, scramble=False, retain_introns=False):
-    ref = pysam.Fastafile(refname)
+    ref = CachedFastaFile(refname)
 
-    references = []
-    with open('%s.fai' % refname) as f:
-        for line in f:
-            cols = line.split('\t')
-            references.append(cols[0])
+    references = ref.references
 
     if not quiet:
         eta = ETA(gtf.fsize(), fileobj=gtf)
@@ -76,6 +72,8 @@ def gtf_junctions(gtf, refname, fragment_size, min_size, max_exons=5, known=Fals
 
     if eta:
         eta.done()
+    if not quiet:
+        sys.stderr.write('Reference cache: %s\n' % ref.stats())
     ref.close()
 
 
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+## category Misc
+## desc Converts a UCSC dbSNP dump into a binary index
+'''
+Converts a UCSC dbSNP dump into a binary index
+
+The index holds the position, class and alleles of each dbSNP variation that
+can be used to check mismatches (see: bamutils filter -mismatch_dbsnp). It can
+be used in place of the Tabix-indexed dump. The index is memory-mapped, so it
+is only read once, even if it is used by more than one process.
+
+The dump must be sorted by chromosome and position (as needed for Tabix). It
+can be uncompressed or gzip/bgzip compressed.
+'''
+
+import os
+import sys
+
+from ngsutils.support.dbsnp import build_snp_index
+
+
+def usage(msg=None):
+    if msg:
+        sys.stdout.write('%s\n' % msg)
+    sys.stdout.write(__doc__)
+    sys.stdout.write('Usage: ngsutils dbsnpindex snp.txt.gz output.snpidx\n\n')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    fname = None
+    outname = None
+
+    for arg in sys.argv[1:]:
+        if arg == '-h':
+            usage()
+        elif not fname:
+            if os.path.exists(arg):
+                fname = arg
+            else:
+                usage('%s missing!' % arg)
+        elif not outname:
+            outname = arg
+
+    if not fname or not outname:
+        usage()
+
+    count = build_snp_index(fname, outname)
+    sys.stderr.write('%s variations\n' % count)
@@ -1,9 +1,9 @@
 import collections
-import gzip
 import os
 import sys
 import re
 from eta import ETA
+from ngsutils.support.bgzip import bgzf_open, progress_fileobj
 
 
 class FASTARead(collections.namedtuple('FASTARecord', 'name comment seq')):
@@ -30,7 +30,7 @@ class FASTARead(collections.namedtuple('FASTARecord', 'name comment seq')):
 
 
 class FASTA(object):
-    def __init__(self, fname=None, fileobj=None, qual=False):
+    def __init__(self, fname=None, fileobj=None, qual=False, threads=1):
         self.fname = fname
         self.qual = qual
         if fileobj:
@@ -39,7 +39,7 @@ class FASTA(object):
             if self.fname == '-':
                 self.fileobj = sys.stdin
             elif self.fname[-3:] == '.gz' or self.fname[-4:] == '.bgz':
-                self.fileobj = gzip.open(os.path.expanduser(self.fname))
+                self.fileobj = bgzf_open(self.fname, threads)
             else:
                 self.fileobj = open(os.path.expanduser(self.fname))
 
@@ -51,7 +51,7 @@ class FASTA(object):
             self.fileobj.close()
 
     def tell(self):
-        # always relative to uncompressed...
+        # relative to uncompressed, or a virtual offset for BGZF files
         return self.fileobj.tell()
 
     def seek(self, pos, whence=0):
@@ -63,7 +63,7 @@ class FASTA(object):
         seq = ''
 
         if not quiet and self.fname and self.fname != '-':
-            eta = ETA(os.stat(self.fname).st_size, fileobj=self.fileobj)
+            eta = ETA(os.stat(self.fname).st_size, fileobj=progress_fileobj(self.fileobj))
         else:
             eta = None
 
@@ -103,20 +103,20 @@ class FASTA(object):
             eta.done()
 
 
-def gzip_reader(fname, quiet=False, callback=None, done_callback=None, fileobj=None):
+def gzip_reader(fname, quiet=False, callback=None, done_callback=None, fileobj=None, threads=1):
     if fileobj:
         f = fileobj
     elif fname == '-':
         f = sys.stdin
     elif fname[-3:] == '.gz' or fname[-4:] == '.bgz':
-        f = gzip.open(os.path.expanduser(fname))
+        f = bgzf_open(fname, threads)
     else:
         f = open(os.path.expanduser(fname))
 
     if quiet or fname == '-':
         eta = None
     else:
-        eta = ETA(os.stat(fname).st_size, fileobj=f)
+        eta = ETA(os.stat(fname).st_size, fileobj=progress_fileobj(f))
 
     for line in f:
         if eta:
@@ -8,7 +8,19 @@ will load the bgzip archive and output the block information.
 
 import sys
 import os
+import gzip
 import struct
+import zlib
+import collections
+from multiprocessing.pool import ThreadPool
+
+# The standard empty block that marks the end of a BGZF file
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# Maximum amount of uncompressed data in a block (same as htslib), so that
+# the compressed block is always smaller than 64K
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_MAX_BLOCK = 0x10000
 
 
 class BGZip(object):
@@ -133,5 +145,404 @@ class BGZip(object):
         self.pos += size
         return struct.unpack(field_types, self.fileobj.read(size))
 
+def compress_block(data, level=-1):
+    '''
+    Compresses data (at most BGZF_BLOCK_SIZE bytes) into a complete BGZF block
+
+    If the data doesn't compress well enough to fit into a block, it is stored
+    uncompressed.
+    '''
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = comp.compress(data) + comp.flush()
+
+    if len(cdata) + 26 > BGZF_MAX_BLOCK:
+        comp = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = comp.compress(data) + comp.flush()
+
+    return pack_block(cdata, zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def pack_block(cdata, crc, isize):
+    'Builds a BGZF block from already compressed data (see: read_block)'
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', crc, isize)
+
+
+def read_block(fileobj):
+    '''
+    Reads the next BGZF block from a file object.
+
+    Returns (block_size, cdata, crc, isize), or None at the end of the file.
+    cdata is the raw deflated data (see: inflate_block)
+    '''
+    header = fileobj.read(12)
+    if not header:
+        return None
+
+    if len(header) < 12:
+        raise ValueError("Truncated BGZF block header")
+
+    id1, id2, cm, flg, mtime, xfl, os_, xlen = struct.unpack('<BBBBIBBH', header)
+    if id1 != 31 or id2 != 139 or not flg & 4:
+        raise ValueError("Invalid BGZF block header")
+
+    extra = fileobj.read(xlen)
+    bsize = None
+    subpos = 0
+
+    while subpos < xlen:
+        si1, si2, slen = struct.unpack('<BBH', extra[subpos:subpos + 4])
+        if si1 == 66 and si2 == 67:
+            bsize, = struct.unpack('<H', extra[subpos + 4:subpos + 6])
+        subpos += 4 + slen
+
+    if bsize is None:
+        raise ValueError("Missing BGZF block size (BC) field")
+
+    cdata = fileobj.read(bsize - xlen - 19)
+    footer = fileobj.read(8)
+    if len(footer) < 8:
+        raise ValueError("Truncated BGZF block")
+
+    crc, isize = struct.unpack('<II', footer)
+    return (bsize + 1, cdata, crc, isize)
+
+
+def inflate_block(cdata):
+    return zlib.decompress(cdata, -15)
+
+
+class BGZFWriter(object):
+    '''
+    Writes a BGZF compressed file.
+
+    Data is split into blocks that are compressed in a pool of threads (zlib
+    releases the GIL while compressing). The blocks are written in order.
+
+    A ThreadPool can be given to share one pool between many writers (it
+    won't be closed with the writer).
+    '''
+    def __init__(self, fname=None, fileobj=None, level=-1, threads=1, pool=None):
+        if fileobj:
+            self.fileobj = fileobj
+        elif fname == '-':
+            self.fileobj = sys.stdout
+        else:
+            self.fileobj = open(fname, 'wb')
+
+        self.level = level
+        self.threads = threads
+        self._own_pool = False
+
+        if pool:
+            self._pool = pool
+            self._maxpending = threads * 4
+        elif threads > 1:
+            self._pool = ThreadPool(threads)
+            self._own_pool = True
+            self._maxpending = threads * 4
+        else:
+            self._pool = None
+            self._maxpending = 0
+
+        self._pending = collections.deque()
+        self._buf = []
+        self._buflen = 0
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buflen += len(data)
+
+        if self._buflen >= BGZF_BLOCK_SIZE:
+            data = ''.join(self._buf)
+            pos = 0
+            while len(data) - pos >= BGZF_BLOCK_SIZE:
+                self._submit(data[pos:pos + BGZF_BLOCK_SIZE])
+                pos += BGZF_BLOCK_SIZE
+
+            self._buf = [data[pos:]]
+            self._buflen = len(data) - pos
+
+    def write_block(self, cdata, crc, isize):
+        '''
+        Writes an already compressed block (from read_block) without
+        inflating it. Any buffered data is written as a (short) block first.
+        '''
+        self._flush_buf()
+        self._pending.append(pack_block(cdata, crc, isize))
+        self._drain(self._maxpending)
+
+    def _submit(self, data):
+        if not self._pool:
+            self._pending.append(compress_block(data, self.level))
+        else:
+            self._pending.append(self._pool.apply_async(compress_block, (data, self.level)))
+
+        # limit the number of blocks in memory
+        self._drain(self._maxpending)
+
+    def _drain(self, maxpending=0):
+        while len(self._pending) > maxpending:
+            block = self._pending.popleft()
+            if isinstance(block, str):
+                self.fileobj.write(block)
+            else:
+                self.fileobj.write(block.get())
+
+    def _flush_buf(self):
+        if self._buflen:
+            self._submit(''.join(self._buf))
+            self._buf = []
+            self._buflen = 0
+
+    def flush(self):
+        self._flush_buf()
+        self._drain()
+        self.fileobj.flush()
+
+    def close(self, eof=True):
+        '''
+        Writes any remaining data and closes the file. If eof is False, the
+        EOF marker isn't written (so that more blocks can be appended to the
+        file later).
+        '''
+        self.flush()
+        if eof:
+            self.fileobj.write(BGZF_EOF)
+
+        if self.fileobj != sys.stdout:
+            self.fileobj.close()
+
+        if self._own_pool:
+            self._pool.close()
+            self._pool.join()
+
+
+def is_bgzf(fname):
+    '''
+    Returns True if the file starts with a BGZF block header (a gzip header
+    with the 'BC' extra subfield).
+    '''
+    with open(fname) as f:
+        header = f.read(16)
+
+    if len(header) < 16:
+        return False
+
+    return header[:4] == '\x1f\x8b\x08\x04' and header[12:14] == 'BC'
+
+
+def _inflate_checked(block, check=False):
+    bsize, cdata, crc, isize = block
+    data = zlib.decompress(cdata, -15)
+    if check:
+        if len(data) != isize:
+            raise ValueError("BGZF block ISIZE mismatch (expected %s, got %s)" % (isize, len(data)))
+        if zlib.crc32(data) & 0xffffffff != crc:
+            raise ValueError("BGZF block CRC32 mismatch")
+    return data
+
+
+class BGZFReader(object):
+    '''
+    Reads a BGZF compressed file as a stream of uncompressed data.
+
+    Block headers are read sequentially from the file, but the blocks are
+    inflated ahead of the consumer in a pool of threads (up to 'readahead'
+    blocks at a time). Data is returned in order through read(), readline()
+    or by iterating over lines.
+
+    tell() and seek() use BAM-style virtual offsets:
+        (compressed block offset << 16) | offset within the uncompressed block
+
+    If check is True, each block's CRC32 and ISIZE are verified.
+    '''
+    def __init__(self, fname=None, fileobj=None, threads=1, readahead=None, check=False):
+        if fileobj:
+            self.fileobj = fileobj
+        elif fname == '-':
+            self.fileobj = sys.stdin
+        else:
+            self.fileobj = open(fname, 'rb')
+
+        self.threads = threads
+        self.readahead = readahead if readahead else threads * 4
+        self.check = check
+
+        if threads > 1:
+            self._pool = ThreadPool(threads)
+        else:
+            self._pool = None
+
+        self._pending = collections.deque()
+        self._next_coffset = 0  # offset of the next block to read from the file
+        self._eof = False
+
+        self._block_offset = 0
+        self._block_end = 0
+        self._data = ''
+        self._pos = 0
+
+    def _fill(self):
+        while not self._eof and len(self._pending) < self.readahead:
+            block = read_block(self.fileobj)
+            if block is None:
+                self._eof = True
+                break
+
+            offset = self._next_coffset
+            self._next_coffset += block[0]
+
+            if self._pool:
+                self._pending.append((offset, block[0], self._pool.apply_async(_inflate_checked, (block, self.check))))
+            else:
+                self._pending.append((offset, block[0], block))
+
+    def _next_block(self):
+        self._fill()
+        if not self._pending:
+            return False
+
+        offset, bsize, res = self._pending.popleft()
+        if self._pool:
+            self._data = res.get()
+        else:
+            self._data = _inflate_checked(res, self.check)
+
+        self._block_offset = offset
+        self._block_end = offset + bsize
+        self._pos = 0
+        return True
+
+    def iter_blocks(self):
+        '''
+        Yields (block offset, uncompressed data) for the remaining blocks in
+        the file (including empty blocks, such as the EOF marker).
+        '''
+        if self._pos < len(self._data):
+            yield (self._block_offset, self._data[self._pos:])
+            self._pos = len(self._data)
+
+        while self._next_block():
+            self._pos = len(self._data)
+            yield (self._block_offset, self._data)
+
+    def read(self, size=-1):
+        bufs = []
+        while size != 0:
+            if self._pos >= len(self._data):
+                if not self._next_block():
+                    break
+                continue
+
+            if size < 0:
+                bufs.append(self._data[self._pos:])
+                self._pos = len(self._data)
+            else:
+                chunk = self._data[self._pos:self._pos + size]
+                self._pos += len(chunk)
+                size -= len(chunk)
+                bufs.append(chunk)
+
+        return ''.join(bufs)
+
+    def readline(self):
+        bufs = []
+        while True:
+            if self._pos >= len(self._data):
+                if not self._next_block():
+                    break
+                continue
+
+            idx = self._data.find('\n', self._pos)
+            if idx > -1:
+                bufs.append(self._data[self._pos:idx + 1])
+                self._pos = idx + 1
+                break
+
+            bufs.append(self._data[self._pos:])
+            self._pos = len(self._data)
+
+        return ''.join(bufs)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def tell(self):
+        if self._pos >= len(self._data):
+            # at the end of a block, point to the start of the next one
+            return self._block_end << 16
+        return (self._block_offset << 16) | self._pos
+
+    def seek(self, offset, whence=0):
+        if whence != 0:
+            raise ValueError("BGZFReader only supports absolute (virtual offset) seeks")
+
+        coffset = offset >> 16
+        uoffset = offset & 0xFFFF
+
+        self.fileobj.seek(coffset)
+        self._pending.clear()
+        self._next_coffset = coffset
+        self._eof = False
+        self._data = ''
+        self._pos = 0
+        self._block_offset = coffset
+        self._block_end = coffset
+
+        if uoffset:
+            if not self._next_block() or uoffset > len(self._data):
+                raise ValueError("Invalid virtual offset: %s" % offset)
+            self._pos = uoffset
+
+    def close(self):
+        if self.fileobj != sys.stdin:
+            self.fileobj.close()
+
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def bgzf_open(fname, threads=1):
+    '''
+    Opens a gzip compressed file for reading. If more than one thread is
+    requested and the file is BGZF compressed, blocks are inflated in
+    parallel with a BGZFReader. Otherwise, the gzip module is used.
+    '''
+    fname = os.path.expanduser(fname)
+    if threads > 1 and is_bgzf(fname):
+        return BGZFReader(fname, threads=threads)
+    return gzip.open(fname)
+
+
+
+class _CompressedPosition(object):
+    'tell() is the offset of the current block in a BGZFReader\'s file'
+    def __init__(self, reader):
+        self.reader = reader
+
+    def tell(self):
+        return self.reader.tell() >> 16
+
+
+def progress_fileobj(f):
+    '''
+    Returns an object to pass to ETA to follow the progress of reading f
+    through the compressed file. For a BGZFReader this is the block offset
+    from its virtual offset (tell() >> 16); other files are returned as-is.
+    '''
+    if isinstance(f, BGZFReader):
+        return _CompressedPosition(f)
+    return f
+
+
 if __name__ == '__main__':
     print BGZip(sys.argv[1]).dump()
@@ -1,11 +1,38 @@
 '''
 Support package for processing a dbSNP tabix dump from UCSC.
+
+The dump can also be converted to a binary index (see: build_snp_index), that
+is memory-mapped and searched without parsing any text.
 '''
 
 import pysam
+import array
+import bisect
 import collections
+import mmap
+import struct
 import sys
 from ngsutils.support import revcomp
+from ngsutils.support.ngs_utils import gzip_aware_open
+
+
+class _SNPAlleles(object):
+    __slots__ = ()
+
+    @property
+    def alleles(self):
+        alts = []
+        for alt in self.observed.split('/'):
+            if alt != '-' and self.strand == '-':
+                alt = revcomp(alt)
+
+            alts.append(alt)
+
+        return alts
+
+    @property
+    def snp_length(self):
+        return self.chromEnd - self.chromStart
 
 
 class SNPRecord(collections.namedtuple('SNPRecord', '''bin
@@ -34,23 +61,18 @@ alleles
 alleleNs
 alleleFreqs
 bitfields
-''')):
+'''), _SNPAlleles):
     __slots__ = ()
 
-    @property
-    def alleles(self):
-        alts = []
-        for alt in self.observed.split('/'):
-            if alt != '-' and self.strand == '-':
-                alt = revcomp(alt)
-
-            alts.append(alt)
+    alleles = _SNPAlleles.alleles
 
-        return alts
 
-    @property
-    def snp_length(self):
-        return self.chromEnd - self.chromStart
+class SNPVariant(collections.namedtuple('SNPVariant', 'chrom chromStart chromEnd strand observed clazz'), _SNPAlleles):
+    '''
+    The columns from a dbSNP record that are needed to check a variation
+    (see: DBSNP.is_valid_variation)
+    '''
+    __slots__ = ()
 
 
 def autotype(ar, length=26):
@@ -75,14 +97,264 @@ def autotype(ar, length=26):
     return out
 
 
-class DBSNP(object):
+# the variation classes that is_valid_variation can check (the order is
+# used for the class codes in a binary index)
+_variant_class_codes = ['single', 'mixed', 'in-del', 'insertion', 'deletion']
+_variant_classes = set(_variant_class_codes)
+
+SNPINDEX_MAGIC = 'NGSDBSNP'
+
+_uint32 = struct.Struct('<I')
+
+
+def _normalize_observed(strand, observed):
+    'Returns the observed alleles on the + strand'
+    if strand != '-':
+        return observed
+
+    alts = []
+    for alt in observed.split('/'):
+        if alt != '-':
+            alt = revcomp(alt)
+        alts.append(alt)
+    return '/'.join(alts)
+
+
+def _write_array(out, arr):
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    out.write(arr.tostring())
+
+
+def build_snp_index(fname, outname):
+    '''
+    Converts a UCSC dbSNP dump (text, gzip or bgzip) into a binary index
+    (see: SNPIndex). The dump must be sorted by chrom and position (as it is
+    for Tabix). Only the variations that is_valid_variation can check are
+    kept. Returns the number of variations written.
+
+    The file is (little-endian):
+        'NGSDBSNP'
+        for each chrom:
+            uint32 starts[n], uint32 ends[n], uint32 alleles[n], uint8 classes[n]
+        string table (alleles): uint32 count, then (uint16 len, str) * count
+        directory: uint32 count, then (uint16 len, chrom, uint64 offset, uint64 n) * count
+        uint64 string table offset, uint64 directory offset
+
+    The alleles are the '/' separated observed alleles on the + strand.
+    '''
+    strings = []
+    string_ids = {}
+    chroms = []
+
+    out = open(outname, 'wb')
+    out.write(SNPINDEX_MAGIC)
+
+    def flush(chrom, starts, ends, alleles, classes):
+        if chrom is not None and starts:
+            chroms.append((chrom, out.tell(), len(starts)))
+            _write_array(out, starts)
+            _write_array(out, ends)
+            _write_array(out, alleles)
+            _write_array(out, classes)
+
+    chrom = None
+    last_start = -1
+    total = 0
+    starts = ends = alleles = classes = None
+
+    f = gzip_aware_open(fname)
+    for line in f:
+        if not line.strip() or line[0] == '#':
+            continue
+
+        cols = line.rstrip('\n').split('\t')
+        if len(cols) < 12:
+            raise TypeError("Invalid dbSNP file! We need at least 12 columns to work with.")
+
+        if cols[1] != chrom:
+            flush(chrom, starts, ends, alleles, classes)
+            if cols[1] in [x[0] for x in chroms]:
+                raise ValueError("dbSNP file must be sorted (%s found again)" % cols[1])
+
+            chrom = cols[1]
+            last_start = -1
+            starts = array.array('I')
+            ends = array.array('I')
+            alleles = array.array('I')
+            classes = array.array('B')
+
+        start = int(cols[2])
+        if start < last_start:
+            raise ValueError("dbSNP file must be sorted (%s:%s)" % (chrom, start))
+        last_start = start
+
+        observed = cols[9]
+        clazz = cols[11]
+        if not '/' in observed or not clazz in _variant_classes:
+            continue
+
+        # zero-length records (chromStart == chromEnd) are never returned by
+        # a Tabix fetch of their start position, so DBSNP doesn't use them
+        end = int(cols[3])
+        if end <= start:
+            continue
+
+        observed = _normalize_observed(cols[6], observed)
+        if not observed in string_ids:
+            string_ids[observed] = len(strings)
+            strings.append(observed)
+
+        starts.append(start)
+        ends.append(end)
+        alleles.append(string_ids[observed])
+        classes.append(_variant_class_codes.index(clazz))
+        total += 1
+
+    if f != sys.stdin:
+        f.close()
+
+    flush(chrom, starts, ends, alleles, classes)
+
+    strings_offset = out.tell()
+    out.write(_uint32.pack(len(strings)))
+    for val in strings:
+        out.write(struct.pack('<H', len(val)))
+        out.write(val)
+
+    dir_offset = out.tell()
+    out.write(_uint32.pack(len(chroms)))
+    for name, offset, n in chroms:
+        out.write(struct.pack('<H', len(name)))
+        out.write(name)
+        out.write(struct.pack('<QQ', offset, n))
+
+    out.write(struct.pack('<QQ', strings_offset, dir_offset))
+    out.close()
+
+    return total
+
+
+def is_snp_index(fname):
+    'Is this file a binary dbSNP index? (see: build_snp_index)'
+    with open(fname, 'rb') as f:
+        return f.read(len(SNPINDEX_MAGIC)) == SNPINDEX_MAGIC
+
+
+class _MappedArray(object):
+    'A read-only uint32 array in a buffer (so that it can be bisected)'
+    __slots__ = ('buf', 'offset', 'n')
+
+    def __init__(self, buf, offset, n):
+        self.buf = buf
+        self.offset = offset
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return _uint32.unpack_from(self.buf, self.offset + 4 * i)[0]
+
+
+class SNPIndex(object):
+    '''
+    A binary dbSNP index (see: build_snp_index).
+
+    The file is memory-mapped read-only, so several processes can share the
+    same pages. Positions are found with a binary search over the starts for
+    each chrom.
+    '''
     def __init__(self, fname):
-        self.dbsnp = pysam.Tabixfile(fname)
-        self.asTup = pysam.asTuple()
+        self.filename = fname
+        self._fileobj = open(fname, 'rb')
+        self._mmap = mmap.mmap(self._fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(SNPINDEX_MAGIC)] != SNPINDEX_MAGIC:
+            raise ValueError("%s is not a dbSNP index" % fname)
+
+        strings_offset, dir_offset = struct.unpack_from('<QQ', self._mmap, len(self._mmap) - 16)
+
+        self._strings = []
+        count, = _uint32.unpack_from(self._mmap, strings_offset)
+        pos = strings_offset + 4
+        for i in xrange(count):
+            size, = struct.unpack_from('<H', self._mmap, pos)
+            self._strings.append(self._mmap[pos + 2:pos + 2 + size])
+            pos += 2 + size
+
+        self._chroms = {}
+        self.chroms = []
+        count, = _uint32.unpack_from(self._mmap, dir_offset)
+        pos = dir_offset + 4
+        for i in xrange(count):
+            size, = struct.unpack_from('<H', self._mmap, pos)
+            name = self._mmap[pos + 2:pos + 2 + size]
+            offset, n = struct.unpack_from('<QQ', self._mmap, pos + 2 + size)
+            pos += 18 + size
+
+            self._chroms[name] = (offset, n, _MappedArray(self._mmap, offset, n))
+            self.chroms.append(name)
+
+    def __len__(self):
+        return sum([n for offset, n, starts in self._chroms.values()])
+
+    def variants(self, chrom, pos):
+        'Returns the variations (SNPVariant) that start at chrom:pos (0-based)'
+        if not chrom in self._chroms:
+            return []
+
+        offset, n, starts = self._chroms[chrom]
+        i = bisect.bisect_left(starts, pos)
+
+        out = []
+        while i < n and starts[i] == pos:
+            end, = _uint32.unpack_from(self._mmap, offset + 4 * (n + i))
+            allele, = _uint32.unpack_from(self._mmap, offset + 4 * (2 * n + i))
+            code = ord(self._mmap[offset + 12 * n + i])
+            out.append(SNPVariant(chrom, pos, end, '+', self._strings[allele], _variant_class_codes[code]))
+            i += 1
+
+        return out
+
+    def close(self):
+        self._mmap.close()
+        self._fileobj.close()
+
+
+class DBSNP(object):
+    '''
+    A Tabix indexed dbSNP dump from UCSC, or a binary index of one (see:
+    build_snp_index).
+
+    For is_valid_variation, all of the SNPs in a window (window bp) are
+    loaded at once, keyed by position, and only the columns needed are kept
+    (see: SNPVariant). When reads are sorted, each window is only loaded
+    once. Up to max_windows are kept (the least recently used is removed).
+    If window is 0 or None, each position is looked up separately.
+
+    A binary index is searched directly (full records aren't available from
+    fetch()).
+    '''
+    def __init__(self, fname, window=100000, max_windows=4):
+        self.window = window
+        self.max_windows = max_windows
+        self._windows = collections.OrderedDict()
+
+        if is_snp_index(fname):
+            self.index = SNPIndex(fname)
+            self.dbsnp = None
+        else:
+            self.index = None
+            self.dbsnp = pysam.Tabixfile(fname)
+            self.asTup = pysam.asTuple()
 
     def fetch(self, chrom, pos):
         'Note: pos is 0-based'
 
+        if not self.dbsnp:
+            raise ValueError("Full dbSNP records aren't available from a binary index")
+
         # Note: tabix the command uses 1-based positions, but
         #       pysam.Tabixfile uses 0-based positions
 
@@ -91,8 +363,64 @@ class DBSNP(object):
             if snp.chromStart == pos:
                 yield snp
 
+    def _load_window(self, chrom, start, end):
+        'Returns the usable variations in chrom:start-end (0-based), as pos => [SNPVariant, ...]'
+        snps = {}
+        if not chrom in self.dbsnp.contigs:
+            return snps
+
+        for tup in self.dbsnp.fetch(chrom, start, end, parser=self.asTup):
+            if len(tup) < 12:
+                raise TypeError("Invalid dbSNP file! We need at least 12 columns to work with.")
+
+            # skip odd variations that we can't deal with... (microsatellites,
+            # tooLongToDisplay members, etc)
+            observed = tup[9]
+            clazz = tup[11]
+            if not '/' in observed or not clazz in _variant_classes:
+                continue
+
+            # Use the same overlap rule as fetch(chrom, pos, pos + 1): zero-length
+            # records (insertions with chromStart == chromEnd) aren't returned
+            # for their start position.
+            pos = int(tup[2])
+            if start <= pos < end and int(tup[3]) > pos:
+                if not pos in snps:
+                    snps[pos] = []
+                snps[pos].append(SNPVariant(chrom, pos, int(tup[3]), tup[6], observed, clazz))
+
+        return snps
+
+    def variants(self, chrom, pos):
+        '''
+        Returns the usable variations (SNPVariant) that start at chrom:pos
+        (0-based).
+        '''
+        if self.index:
+            return self.index.variants(chrom, pos)
+
+        if not self.window:
+            if not chrom in self.dbsnp.contigs:
+                return []
+            return [SNPVariant(snp.chrom, snp.chromStart, snp.chromEnd, snp.strand, snp.observed, snp.clazz) for snp in self.fetch(chrom, pos) if '/' in snp.observed and snp.clazz in _variant_classes]
+
+        key = (chrom, pos / self.window)
+        if key in self._windows:
+            snps = self._windows.pop(key)
+        else:
+            snps = self._load_window(chrom, key[1] * self.window, (key[1] + 1) * self.window)
+            while len(self._windows) >= self.max_windows:
+                self._windows.popitem(False)
+
+        self._windows[key] = snps
+        return snps.get(pos, [])
+
     def close(self):
-        self.dbsnp.close()
+        self._windows.clear()
+        if self.index:
+            self.index.close()
+        else:
+            self.dbsnp.close()
 
     def dump(self, chrom, op, pos, base, snp, exit=True):
         print
@@ -103,11 +431,7 @@ class DBSNP(object):
             sys.exit(1)
 
     def is_valid_variation(self, chrom, op, pos, seq, verbose=False):
-        for snp in self.fetch(chrom, pos):
-            if not '/' in snp.observed or snp.clazz not in ['single', 'mixed', 'in-del', 'insertion', 'deletion']:
-                # these are odd variations that we can't deal with... (microsatellites, tooLongToDisplay members, etc)
-                continue
-
+        for snp in self.variants(chrom, pos):
             if op == 0:
                 if snp.clazz in ['single', 'mixed'] and seq in snp.alleles:
                     return True
@@ -0,0 +1,287 @@
+'''
+Compact sets of read names.
+
+A Python set of read names uses 50-100 bytes per name, so whitelists (or
+lists of multi-mapped reads) with hundreds of millions of names don't fit in
+memory. Once a NameSet is larger than max_set names, it only stores a
+64-bit hash of each name (8 bytes/name), so there is a very small chance
+(~n / 2^64 for each lookup) that a name that isn't in the set will be found.
+If exact is True, the names are also kept (as one block of bytes, not as
+Python strings) and checked. (On platforms where a C long is 32-bit, the
+names are always kept, see _name_hash.)
+
+Smaller sets are kept as a regular Python set, which is much faster to
+search (~0.05us vs ~2us per lookup).
+'''
+
+import array
+import bisect
+import hashlib
+import heapq
+import itertools
+import struct
+
+# The hashes are stored as signed C longs. These are 64-bit on 64-bit
+# Linux/OS X, but 32-bit on Windows and 32-bit builds (and array has no
+# 64-bit type in Python 2). There, the hashes are 32-bit and the names are
+# always kept and checked (exact), so a smaller hash can't cause false matches.
+_HASH_TYPE = 'l'
+_hash_struct = struct.Struct('<q' if array.array(_HASH_TYPE).itemsize >= 8 else '<i')
+_HASH_EXACT = _hash_struct.size < 8
+
+
+def _name_hash(name):
+    '''
+    The first 8 bytes of the MD5 digest of a name, as a signed integer.
+    Unlike hash(), this is the same on every platform and Python build.
+
+    >>> _name_hash('foo') == (6699318081062747564 if not _HASH_EXACT else -619135572)
+    True
+    '''
+    # 0 marks an empty slot in the hash table
+    return _hash_struct.unpack_from(hashlib.md5(name).digest())[0] or 1
+
+
+def read_names(fname):
+    '''
+    Yields the read names from a text file (the first column of each line,
+    so names can be followed by other whitespace-delimited columns).
+    '''
+    with open(fname) as f:
+        for line in f:
+            cols = line.split()
+            if cols:
+                yield cols[0]
+
+
+class _Chunk(object):
+    'A sorted block of hashes (and names), used while building a NameSet'
+    def __init__(self, vals, exact):
+        self.hashes = array.array(_HASH_TYPE)
+        self.offsets = None
+        self.names = None
+
+        vals.sort()
+        if exact:
+            self.offsets = array.array('L', [0])
+            self.names = bytearray()
+            for h, name in vals:
+                self.hashes.append(h)
+                self.names.extend(name)
+                self.offsets.append(len(self.names))
+        else:
+            self.hashes.extend([h for h, dups in itertools.groupby(vals)])
+
+    def __iter__(self):
+        if self.names is None:
+            for h in self.hashes:
+                yield h
+        else:
+            for i, h in enumerate(self.hashes):
+                yield (h, str(self.names[self.offsets[i]:self.offsets[i + 1]]))
+
+
+class NameSet(object):
+    '''
+    A set of read names.
+
+    Up to max_set names are kept in a Python set. After that, the names are
+    stored as hashes. Names given when the set is created (or with update)
+    are kept in a sorted array and found with a binary search. They are
+    sorted chunk_size names at a time and merged, so loading a large file
+    only needs ~8 bytes/name (plus the names themselves if exact). Names
+    added with add() go into an open-addressing hash table.
+
+    >>> names = NameSet(['foo', 'bar', 'foo'])
+    >>> 'foo' in names, 'baz' in names, len(names)
+    (True, False, 2)
+    >>> names.add('baz')
+    >>> names.add('foo')
+    >>> 'baz' in names, len(names)
+    (True, 3)
+    '''
+    def __init__(self, names=None, exact=False, max_set=1000000, chunk_size=1000000):
+        self.exact = exact or _HASH_EXACT
+        self.max_set = max_set
+        self.chunk_size = chunk_size
+
+        self._set = set()
+
+        self._hashes = array.array(_HASH_TYPE)
+        self._offsets = array.array('L', [0])
+        self._names = bytearray()
+
+        self._slots = array.array(_HASH_TYPE, [0] * 1024)
+        self._slot_idx = array.array('L', [0] * 1024)
+        self._added_offsets = array.array('L', [0])
+        self._added_names = bytearray()
+        self._added = 0
+
+        if names is not None:
+            self.update(names)
+
+    def update(self, names):
+        'Adds names in bulk (to the sorted array)'
+        names = iter(names)
+        if self._set is not None:
+            for name in names:
+                self._set.add(name)
+                if len(self._set) > self.max_set:
+                    break
+            else:
+                return
+
+            # too many names for a set, switch to hashes
+            names = itertools.chain(self._set, names)
+            self._set = None
+
+        chunks = []
+        if self._hashes:
+            chunks.append(self._current_chunk())
+
+        while True:
+            if self.exact:
+                vals = [(_name_hash(name), name) for name in itertools.islice(names, self.chunk_size)]
+            else:
+                vals = [_name_hash(name) for name in itertools.islice(names, self.chunk_size)]
+
+            if not vals:
+                break
+            chunks.append(_Chunk(vals, self.exact))
+
+        if len(chunks) == 1 and not self.exact:
+            # already sorted and unique
+            self._hashes = chunks[0].hashes
+            return
+
+        hashes = array.array(_HASH_TYPE)
+        offsets = array.array('L', [0])
+        buf = bytearray()
+
+        last = None
+        if self.exact:
+            merged = heapq.merge(*chunks)
+        else:
+            merged = heapq.merge(*[chunk.hashes for chunk in chunks])
+
+        for val in merged:
+            if val == last:
+                continue
+            last = val
+
+            if self.exact:
+                hashes.append(val[0])
+                buf.extend(val[1])
+                offsets.append(len(buf))
+            else:
+                hashes.append(val)
+
+        self._hashes = hashes
+        if self.exact:
+            self._offsets = offsets
+            self._names = buf
+
+    def _current_chunk(self):
+        chunk = _Chunk([], self.exact)
+        chunk.hashes = self._hashes
+        if self.exact:
+            chunk.offsets = self._offsets
+            chunk.names = self._names
+        return chunk
+
+    def _in_sorted(self, h, name):
+        hashes = self._hashes
+        i = bisect.bisect_left(hashes, h)
+        while i < len(hashes) and hashes[i] == h:
+            if not self.exact or self._names[self._offsets[i]:self._offsets[i + 1]] == name:
+                return True
+            i += 1
+        return False
+
+    def _find_slot(self, h, name):
+        'Returns (found, slot) for a name in the hash table (linear probing)'
+        slots = self._slots
+        mask = len(slots) - 1
+        i = h & mask
+        while True:
+            val = slots[i]
+            if val == 0:
+                return False, i
+            if val == h:
+                if not self.exact:
+                    return True, i
+                idx = self._slot_idx[i]
+                if self._added_names[self._added_offsets[idx]:self._added_offsets[idx + 1]] == name:
+                    return True, i
+            i = (i + 1) & mask
+
+    def _grow(self):
+        old_slots = self._slots
+        old_idx = self._slot_idx
+
+        size = len(old_slots) * 2
+        self._slots = array.array(_HASH_TYPE, [0]) * size
+        self._slot_idx = array.array('L', [0]) * size
+
+        mask = size - 1
+        for h, idx in zip(old_slots, old_idx):
+            if h:
+                i = h & mask
+                while self._slots[i]:
+                    i = (i + 1) & mask
+                self._slots[i] = h
+                self._slot_idx[i] = idx
+
+    def add(self, name):
+        if self._set is not None:
+            self._set.add(name)
+            if len(self._set) > self.max_set:
+                names = self._set
+                self._set = None
+                self.update(names)
+            return
+
+        h = _name_hash(name)
+        if self._hashes and self._in_sorted(h, name):
+            return
+
+        # (inlined _find_slot for the common case)
+        slots = self._slots
+        mask = len(slots) - 1
+        i = h & mask
+        while slots[i]:
+            if slots[i] == h and (not self.exact or self._find_slot(h, name)[0]):
+                return
+            i = (i + 1) & mask
+
+        self._slots[i] = h
+        if self.exact:
+            self._slot_idx[i] = self._added
+            self._added_names.extend(name)
+            self._added_offsets.append(len(self._added_names))
+
+        self._added += 1
+        if self._added * 2 > len(self._slots):
+            self._grow()
+
+    def __contains__(self, name):
+        if self._set is not None:
+            return name in self._set
+
+        h = _name_hash(name)
+        if self._added and self._find_slot(h, name)[0]:
+            return True
+
+        hashes = self._hashes
+        i = bisect.bisect_left(hashes, h)
+        if i < len(hashes) and hashes[i] == h:
+            return not self.exact or self._in_sorted(h, name)
+        return False
+
+    def __len__(self):
+        if self._set is not None:
+            return len(self._set)
+        return len(self._hashes) + self._added
+
+    def __nonzero__(self):
+        return len(self) > 0
@@ -6,9 +6,9 @@ Common util classes / functions for the NGS project
 """
 import sys
 import os
-import gzip
 import re
 import collections
+from ngsutils.support.bgzip import bgzf_open
 
 
 def format_number(n):
@@ -91,11 +91,11 @@ def dictify(values, colnames):
     return d
 
 
-def gzip_aware_open(fname):
+def gzip_aware_open(fname, threads=1):
     if fname == '-':
         f = sys.stdin
     elif fname[-3:] == '.gz' or fname[-4:] == '.bgz':
-        f = gzip.open(os.path.expanduser(fname))
+        f = bgzf_open(fname, threads)
     else:
         f = open(os.path.expanduser(fname))
     return f
@@ -106,11 +106,12 @@ class gzip_opener:
     A Python 2.6 class to handle 'with' opening of text files that may
     or may not be gzip compressed.
     '''
-    def __init__(self, fname):
+    def __init__(self, fname, threads=1):
         self.fname = fname
+        self.threads = threads
 
     def __enter__(self):
-        self.f = gzip_aware_open(self.fname)
+        self.f = gzip_aware_open(self.fname, self.threads)
         return self.f
 
     def __exit__(self, type, value, traceback):
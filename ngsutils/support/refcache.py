@@ -0,0 +1,128 @@
+'''
+Cached access to a reference FASTA file.
+
+Many commands fetch reference bases one small interval at a time (a single
+base, a read's worth, a junction fragment). Each of these calls to
+pysam.Fastafile pays for a FAI lookup and a seek. CachedFastaFile wraps a
+FASTA file and keeps aligned chunks of sequence in a bounded LRU cache so that nearby
+fetches are served from memory. The hit/miss counts (stats()) are reported by
+the commands that use it.
+'''
+
+import collections
+import os
+import pysam
+
+
+class CachedFastaFile(object):
+    '''
+    Drop-in replacement for pysam.Fastafile.fetch() with a chunk cache.
+
+    chunk_size  - size (bp) of the aligned chunks that are cached
+    max_chunks  - maximum number of chunks to keep (LRU eviction)
+
+    Missing references return an empty string (like older versions of pysam),
+    so that callers can test for "if not seq".
+    '''
+    def __init__(self, fname, chunk_size=65536, max_chunks=256):
+        self.filename = fname
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists('%s.fai' % fname):
+            pysam.faidx(fname)
+
+        self._index = {}
+        self.references = []
+
+        with open('%s.fai' % fname) as f:
+            for line in f:
+                cols = line.rstrip('\n').split('\t')
+                if len(cols) < 5:
+                    continue
+                self.references.append(cols[0])
+                self._index[cols[0]] = (int(cols[1]), int(cols[2]), int(cols[3]), int(cols[4]))
+
+        self._cache = collections.OrderedDict()
+        self._fasta = pysam.Fastafile(fname)
+
+    @property
+    def lengths(self):
+        return [self._index[ref][0] for ref in self.references]
+
+    def get_reference_length(self, chrom):
+        if chrom in self._index:
+            return self._index[chrom][0]
+        return 0
+
+    def fetch(self, chrom, start=None, end=None):
+        'Note: start/end are 0-based, half-open'
+
+        if chrom not in self._index:
+            return ''
+
+        reflen = self._index[chrom][0]
+
+        if start is None or start < 0:
+            start = 0
+        if end is None or end > reflen:
+            end = reflen
+
+        if start >= end:
+            return ''
+
+        first = start / self.chunk_size
+        last = (end - 1) / self.chunk_size
+
+        if first == last:
+            chunk = self._get_chunk(chrom, first)
+            offset = first * self.chunk_size
+            return chunk[start - offset:end - offset]
+
+        buf = []
+        for idx in xrange(first, last + 1):
+            chunk = self._get_chunk(chrom, idx)
+            offset = idx * self.chunk_size
+            buf.append(chunk[max(start - offset, 0):end - offset])
+
+        return ''.join(buf)
+
+    def _get_chunk(self, chrom, idx):
+        k = (chrom, idx)
+        if k in self._cache:
+            self.hits += 1
+            chunk = self._cache.pop(k)
+            self._cache[k] = chunk
+            return chunk
+
+        self.misses += 1
+
+        start = idx * self.chunk_size
+        end = min(start + self.chunk_size, self._index[chrom][0])
+
+        chunk = self._fasta.fetch(chrom, start, end)
+
+        self._cache[k] = chunk
+        while len(self._cache) > self.max_chunks:
+            self._cache.popitem(last=False)
+
+        return chunk
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def stats(self):
+        return 'hits: %s, misses: %s, cached chunks: %s, hit rate: %.3f' % (self.hits, self.misses, len(self._cache), self.hit_rate())
+
+    def close(self):
+        self._cache.clear()
+
+        if self._fasta:
+            self._fasta.close()
+            self._fasta = None
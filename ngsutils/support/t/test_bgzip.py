@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.bgzip
+'''
+
+import gzip
+import os
+import tempfile
+import unittest
+
+from ngsutils.support.bgzip import BGZFWriter, BGZFReader, BGZF_EOF, read_block, inflate_block, is_bgzf, progress_fileobj
+
+
+class BGZFWriterTest(unittest.TestCase):
+    def _roundtrip(self, threads, level):
+        data = ''.join(['line %s\n' % i for i in xrange(30000)])
+        fd, fname = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        try:
+            out = BGZFWriter(fname, level=level, threads=threads)
+            out.write(data[:1000])
+            out.write(data[1000:])
+            out.close()
+
+            f = gzip.open(fname)
+            self.assertEqual(f.read(), data)
+            f.close()
+
+            f = open(fname)
+            blocks = []
+            while True:
+                block = read_block(f)
+                if not block:
+                    break
+                blocks.append(block)
+            f.seek(-len(BGZF_EOF), 2)
+            self.assertEqual(f.read(), BGZF_EOF)
+            f.close()
+
+            self.assertTrue(len(blocks) > 2)
+            self.assertEqual(''.join([inflate_block(b[1]) for b in blocks]), data)
+        finally:
+            os.unlink(fname)
+
+    def testSerial(self):
+        self._roundtrip(1, -1)
+
+    def testThreaded(self):
+        self._roundtrip(4, 6)
+
+    def testUncompressed(self):
+        self._roundtrip(2, 0)
+
+
+class BGZFReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.lines = ['line %s\n' % i for i in xrange(30000)]
+        fd, self.fname = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        out = BGZFWriter(self.fname)
+        for line in self.lines:
+            out.write(line)
+        out.close()
+
+    def tearDown(self):
+        os.unlink(self.fname)
+
+    def testIsBGZF(self):
+        self.assertTrue(is_bgzf(self.fname))
+        self.assertFalse(is_bgzf(__file__))
+
+    def testLines(self):
+        for threads in [1, 3]:
+            reader = BGZFReader(self.fname, threads=threads)
+            self.assertEqual(list(reader), self.lines)
+            self.assertEqual(reader.read(), '')
+            reader.close()
+
+    def testRead(self):
+        reader = BGZFReader(self.fname, threads=2)
+        data = ''.join(self.lines)
+        self.assertEqual(reader.read(10), data[:10])
+        self.assertEqual(reader.read(100000), data[10:100010])
+        self.assertEqual(reader.read(), data[100010:])
+        reader.close()
+
+    def testSeek(self):
+        reader = BGZFReader(self.fname, threads=2)
+        offsets = []
+        for i in xrange(len(self.lines)):
+            offsets.append(reader.tell())
+            self.assertEqual(reader.readline(), self.lines[i])
+
+        for i in [25000, 0, 12345, 29999]:
+            reader.seek(offsets[i])
+            self.assertEqual(reader.readline(), self.lines[i])
+            self.assertEqual(reader.readline(), self.lines[i + 1] if i + 1 < len(self.lines) else '')
+
+        reader.close()
+
+    def testBlocks(self):
+        reader = BGZFReader(self.fname, threads=2, check=True)
+        blocks = list(reader.iter_blocks())
+        self.assertEqual(''.join([x[1] for x in blocks]), ''.join(self.lines))
+        self.assertEqual(blocks[0][0], 0)
+        self.assertEqual(blocks[-1][1], '')
+        self.assertEqual(blocks[-1][0], os.stat(self.fname).st_size - len(BGZF_EOF))
+        reader.close()
+
+    def testProgress(self):
+        size = os.stat(self.fname).st_size
+        reader = BGZFReader(self.fname, threads=2)
+        pos = progress_fileobj(reader)
+        positions = []
+        for line in reader:
+            positions.append(pos.tell())
+
+        self.assertEqual(positions, sorted(positions))
+        self.assertTrue(0 < positions[len(positions) / 2] < size)
+        self.assertEqual(positions[-1], size - len(BGZF_EOF))
+        reader.close()
+
+        f = open(self.fname)
+        self.assertTrue(progress_fileobj(f) is f)
+        f.close()
+
+    def testBadCRC(self):
+        f = open(self.fname, 'r+b')
+        f.seek(-len(BGZF_EOF) - 8, 2)
+        f.write('\0\0\0\0')
+        f.close()
+
+        reader = BGZFReader(self.fname)
+        self.assertEqual(reader.read(), ''.join(self.lines))
+        reader.close()
+
+        reader = BGZFReader(self.fname, threads=2, check=True)
+        self.assertRaises(ValueError, reader.read)
+        reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
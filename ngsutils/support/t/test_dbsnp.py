@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.dbsnp
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pysam
+
+from ngsutils.support.dbsnp import DBSNP, SNPIndex, build_snp_index, is_snp_index
+
+# bin, chrom, chromStart, chromEnd, name, score, strand, refNCBI, refUCSC, observed, molType, class
+_snps = [
+    ('chr1', 10, 11, 'rs1', '+', 'A', 'A/G', 'single'),
+    ('chr1', 10, 11, 'rs2', '-', 'A', 'A/C', 'single'),
+    ('chr1', 25, 25, 'rs3', '+', '-', '-/TT', 'insertion'),
+    ('chr1', 40, 42, 'rs4', '+', 'AC', 'AC/-', 'deletion'),
+    ('chr1', 55, 56, 'rs5', '+', 'A', '(A)5/6', 'microsatellite'),
+    ('chr1', 70, 71, 'rs6', '-', 'C', '-/A/G', 'mixed'),
+    ('chr2', 5, 6, 'rs7', '+', 'T', 'T/C', 'single'),
+]
+
+
+class DBSNPTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        fname = os.path.join(self.tmpdir, 'snp.txt')
+        with open(fname, 'w') as f:
+            for chrom, start, end, name, strand, ref, observed, clazz in _snps:
+                f.write('585\t%s\t%s\t%s\t%s\t0\t%s\t%s\t%s\t%s\tgenomic\t%s\tunknown\t0\t0\tintergenic\texact\t1\n' % (chrom, start, end, name, strand, ref, ref, observed, clazz))
+
+        self.txtname = fname
+        self.fname = pysam.tabix_index(fname, seq_col=1, start_col=2, end_col=3, zerobased=True, keep_original=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testFetch(self):
+        dbsnp = DBSNP(self.fname)
+        self.assertEqual([x.name for x in dbsnp.fetch('chr1', 10)], ['rs1', 'rs2'])
+        self.assertEqual([x.alleles for x in dbsnp.fetch('chr1', 10)], [['A', 'G'], ['T', 'G']])
+        self.assertEqual([x.name for x in dbsnp.fetch('chr1', 11)], [])
+        dbsnp.close()
+
+    def _check_valid(self, dbsnp):
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 0, 10, 'G'))
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 0, 10, 'T'))
+        self.assertFalse(dbsnp.is_valid_variation('chr1', 0, 10, 'C'))
+        self.assertFalse(dbsnp.is_valid_variation('chr1', 0, 11, 'G'))
+        # zero-length insertions aren't found by a Tabix fetch of their position
+        self.assertFalse(dbsnp.is_valid_variation('chr1', 1, 25, 'TT'))
+        self.assertFalse(dbsnp.is_valid_variation('chr1', 1, 25, 'T'))
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 2, 40, 'AC'))
+        self.assertFalse(dbsnp.is_valid_variation('chr1', 0, 55, 'A'))
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 0, 70, 'C'))
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 1, 70, 'T'))
+        self.assertTrue(dbsnp.is_valid_variation('chr2', 0, 5, 'C'))
+        self.assertFalse(dbsnp.is_valid_variation('chr2', 0, 10, 'C'))
+        self.assertFalse(dbsnp.is_valid_variation('chr3', 0, 10, 'C'))
+
+    def testValidWindow(self):
+        dbsnp = DBSNP(self.fname)
+        self._check_valid(dbsnp)
+        dbsnp.close()
+
+    def testValidSmallWindows(self):
+        dbsnp = DBSNP(self.fname, window=16, max_windows=2)
+        self._check_valid(dbsnp)
+        self.assertTrue(len(dbsnp._windows) <= 2)
+        dbsnp.close()
+
+    def testValidNoWindow(self):
+        dbsnp = DBSNP(self.fname, window=None)
+        self._check_valid(dbsnp)
+        dbsnp.close()
+
+    def testIndex(self):
+        idxname = os.path.join(self.tmpdir, 'snp.idx')
+        self.assertEqual(build_snp_index(self.fname, idxname), 5)
+        self.assertTrue(is_snp_index(idxname))
+        self.assertFalse(is_snp_index(self.fname))
+
+        index = SNPIndex(idxname)
+        self.assertEqual(index.chroms, ['chr1', 'chr2'])
+        self.assertEqual(len(index), 5)
+        self.assertEqual([(x.chromStart, x.chromEnd, x.alleles, x.clazz) for x in index.variants('chr1', 10)], [(10, 11, ['A', 'G'], 'single'), (10, 11, ['T', 'G'], 'single')])
+        self.assertEqual(index.variants('chr1', 11), [])
+        self.assertEqual(index.variants('chr1', 25), [])
+        self.assertEqual(index.variants('chr1', 1000), [])
+        self.assertEqual(index.variants('chr3', 10), [])
+        index.close()
+
+        dbsnp = DBSNP(idxname)
+        self._check_valid(dbsnp)
+        self.assertRaises(ValueError, lambda: list(dbsnp.fetch('chr1', 10)))
+        dbsnp.close()
+
+    def testIndexUnsorted(self):
+        unsorted = os.path.join(self.tmpdir, 'unsorted.txt')
+        with open(self.txtname) as f:
+            lines = f.readlines()
+        with open(unsorted, 'w') as f:
+            f.writelines(lines[::-1])
+
+        self.assertRaises(ValueError, build_snp_index, unsorted, os.path.join(self.tmpdir, 'snp.idx'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.nameset
+'''
+
+import os
+import tempfile
+import unittest
+import doctest
+
+import ngsutils.support.nameset
+from ngsutils.support.nameset import NameSet, read_names
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.support.nameset))
+    return tests
+
+
+class NameSetTest(unittest.TestCase):
+    def _check(self, names, missing, exact):
+        for chunk_size in [1000000, 7]:
+            nameset = NameSet(names, exact=exact, max_set=0, chunk_size=chunk_size)
+            self.assertEqual(len(nameset), len(set(names)))
+            for name in names:
+                self.assertTrue(name in nameset)
+            for name in missing:
+                self.assertFalse(name in nameset)
+
+    def testNameSet(self):
+        names = ['read%s' % i for i in xrange(0, 1000, 3)] + ['read3', 'read6']
+        missing = ['read%s' % i for i in xrange(1, 1000, 3)] + ['']
+        self._check(names, missing, False)
+        self._check(names, missing, True)
+
+    def testAdd(self):
+        for exact in [False, True]:
+            nameset = NameSet(['read%s' % i for i in xrange(0, 100)], exact=exact, max_set=0)
+            for i in xrange(50, 5000):
+                nameset.add('read%s' % i)
+            self.assertEqual(len(nameset), 5000)
+            self.assertTrue(len(nameset._slots) > 1024)
+            for i in xrange(0, 5000):
+                self.assertTrue('read%s' % i in nameset)
+            self.assertFalse('read5000' in nameset)
+
+            nameset.update(['foo', 'read1'])
+            self.assertTrue('foo' in nameset)
+            self.assertTrue('read4999' in nameset)
+            self.assertEqual(len(nameset), 5001)
+
+    def testSwitchToHashes(self):
+        ''' Small sets are Python sets, larger ones are stored as hashes '''
+        nameset = NameSet(['foo', 'bar'], max_set=3)
+        self.assertTrue(nameset._set is not None)
+        nameset.add('baz')
+        nameset.add('foo')
+        self.assertTrue(nameset._set is not None)
+        nameset.add('qux')
+        self.assertTrue(nameset._set is None)
+        self.assertEqual(len(nameset), 4)
+        for name in ['foo', 'bar', 'baz', 'qux']:
+            self.assertTrue(name in nameset)
+        self.assertFalse('quux' in nameset)
+
+        nameset = NameSet(['read%s' % i for i in xrange(100)] * 2, max_set=50, chunk_size=30)
+        self.assertTrue(nameset._set is None)
+        self.assertEqual(len(nameset), 100)
+        self.assertTrue('read99' in nameset)
+        self.assertFalse('read100' in nameset)
+
+    def testEmpty(self):
+        nameset = NameSet()
+        self.assertFalse(nameset)
+        self.assertFalse('foo' in nameset)
+        nameset.add('foo')
+        self.assertTrue(nameset)
+
+    def testExactCollision(self):
+        ''' Only exact sets check the names when the hashes match '''
+        orig = ngsutils.support.nameset._name_hash
+        ngsutils.support.nameset._name_hash = lambda name: 42
+        try:
+            self.assertTrue('bar' in NameSet(['foo'], max_set=0))
+            self.assertFalse('bar' in NameSet(['foo'], exact=True, max_set=0))
+            self.assertTrue('foo' in NameSet(['bar', 'foo'], exact=True, max_set=0))
+
+            nameset = NameSet(exact=True, max_set=0)
+            nameset.add('foo')
+            nameset.add('bar')
+            self.assertEqual(len(nameset), 2)
+            self.assertTrue('bar' in nameset)
+            self.assertFalse('baz' in nameset)
+        finally:
+            ngsutils.support.nameset._name_hash = orig
+
+    def testReadNames(self):
+        fd, fname = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('foo\nbar\textra column\n\nbaz  \n')
+        self.assertEqual(list(read_names(fname)), ['foo', 'bar', 'baz'])
+        os.unlink(fname)
+
+
+if __name__ == '__main__':
+    unittest.main()
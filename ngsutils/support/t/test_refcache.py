@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.refcache
+'''
+
+import os
+import unittest
+
+from ngsutils.support.refcache import CachedFastaFile
+
+fname = os.path.join(os.path.dirname(__file__), '..', '..', 'bam', 't', 'test.fa')
+
+
+class CachedFastaFileTest(unittest.TestCase):
+    def _check_fetch(self, ref):
+        self.assertEqual(ref.fetch('test1', 0, 10), 'aaaaaaaaaa')
+        self.assertEqual(ref.fetch('test2', 0, 16), 'atcgatcgatcgatcg')
+        self.assertEqual(ref.fetch('test2', 2, 9), 'cgatcga')
+        self.assertEqual(ref.fetch('test2', 15, 16), 'g')
+        self.assertEqual(ref.fetch('test2', -2, 3), 'atc')
+        self.assertEqual(ref.fetch('test2', 14, 20), 'cg')
+        self.assertEqual(ref.fetch('test2'), 'atcgatcgatcgatcg')
+        self.assertEqual(ref.fetch('missing', 0, 10), '')
+
+    def testFetch(self):
+        ref = CachedFastaFile(fname)
+        self._check_fetch(ref)
+        ref.close()
+
+    def testFetchSmallChunks(self):
+        ref = CachedFastaFile(fname, chunk_size=3, max_chunks=2)
+        self._check_fetch(ref)
+        self.assertTrue(len(ref._cache) <= 2)
+        ref.close()
+
+    def testStats(self):
+        ref = CachedFastaFile(fname, chunk_size=4)
+        ref.fetch('test2', 0, 1)
+        ref.fetch('test2', 1, 2)
+        ref.fetch('test2', 2, 6)
+        self.assertEqual(ref.misses, 2)
+        self.assertEqual(ref.hits, 2)
+        self.assertEqual(ref.hit_rate(), 0.5)
+        self.assertEqual(ref.stats(), 'hits: 2, misses: 2, cached chunks: 2, hit rate: 0.500')
+        ref.close()
+
+    def testReferences(self):
+        ref = CachedFastaFile(fname)
+        self.assertEqual(ref.references, ['test1', 'test2'])
+        self.assertEqual(ref.lengths, [10, 16])
+        ref.close()
+
+
+if __name__ == '__main__':
+    unittest.main()